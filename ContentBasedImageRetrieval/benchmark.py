@@ -0,0 +1,362 @@
+""" Search benchmark and recall harness on synthetic corpora. Needs no model, database or network:
+the encoder is utils.StubEncoder, the database an in-process stand-in and the image host a local HTTP stub.
+
+    python benchmark.py [--sizes 10000 100000] [--dim 1024] [--k 5 10] [--sim-func cosine euclidean]
+                        [--nprobe 1 4 16] [--queries 200] [--json results.json]
+    python benchmark.py --check
+
+--check runs the regression checks instead: each asserts on a small synthetic corpus and prints 'ok'.
+
+For every corpus size, k and sim_func, the exact scan, the kmeans-restricted scan and the IVF index
+at each nprobe report QPS, p50/p95/p99 latency, peak traced memory and recall@k against the exact scan.
+The per-stage section times decode, resize, the fused preprocess path, encode, cluster, score, DB and fetch.
+"""
+import argparse
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import feature_store
+import image_fetcher
+import ingest
+import ivf_index
+import preprocess
+import utils
+
+
+class CentroidModel:
+    """ Nearest-centroid stand-in for the pickled KMeans model """
+
+    def __init__(self, centers):
+        self.cluster_centers_ = np.asarray(centers, dtype='float32')
+        self._sq = (self.cluster_centers_ ** 2).sum(axis=1)
+
+    def predict(self, x):
+        x = np.asarray(x, dtype='float32')
+        return (self._sq[None, :] - 2 * x @ self.cluster_centers_.T).argmin(axis=1)
+
+
+def synthetic_corpus(size, dim, n_clusters, seed=0):
+    """ Returns (features FeatureMatrix, kmeans, kclusters) drawn from 'n_clusters' gaussian blobs """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype('float32') * 2
+    keys = np.empty(size, dtype=object)
+    keys[:] = [f'M{i:09d}' for i in range(size)]
+    vectors = np.empty((size, dim), dtype='float16')
+    norms = np.empty(size, dtype='float32')
+    labels = rng.integers(0, n_clusters, size)
+    for start in range(0, size, utils.FeatureMatrix.block_rows):
+        stop = min(start + utils.FeatureMatrix.block_rows, size)
+        block = centers[labels[start:stop]] + rng.standard_normal((stop - start, dim)).astype('float32')
+        vectors[start:stop], norms[start:stop] = utils.normalize_rows(block)
+
+    features = utils.FeatureMatrix(keys, vectors, norms)
+    kmeans = CentroidModel(centers)
+    kclusters = {}
+    for k, c in zip(keys.tolist(), labels.tolist()):
+        kclusters.setdefault(c, []).append(k)
+    return features, kmeans, kclusters
+
+
+def synthetic_queries(features, n, seed=1):
+    """ Perturbed corpus vectors, so every query has true near neighbours """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(features), n, replace=False)
+    q = features.vectors[rows].astype('float32') * features.norms[rows, None]
+    return (q + rng.standard_normal(q.shape).astype('float32') * 0.3).astype('float16')
+
+
+def percentiles(latencies):
+    ms = np.asarray(latencies) * 1000
+    return {'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)),
+            'p99_ms': float(np.percentile(ms, 99))}
+
+
+def run_mode(name, search_one, queries, exact=None):
+    """ Times 'search_one' per query and scores recall@k against 'exact' """
+    latencies, results = [], []
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    for q in queries:
+        t0 = time.perf_counter()
+        results.append(search_one(q[None, :])[0])
+        latencies.append(time.perf_counter() - t0)
+    wall = time.perf_counter() - t_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    row = {'mode': name, 'qps': len(queries) / wall, 'peak_mb': peak / 2 ** 20}
+    row.update(percentiles(latencies))
+    if exact is not None:
+        hits = sum(len({k for _, k in r} & {k for _, k in e}) for r, e in zip(results, exact))
+        row['recall'] = hits / max(1, sum(len(e) for e in exact))
+    return row, results
+
+
+def benchmark_search(size, dim, k, sim_func, nprobes, n_queries, n_clusters):
+    features, kmeans, kclusters = synthetic_corpus(size, dim, n_clusters)
+    queries = synthetic_queries(features, n_queries)
+    rows = []
+
+    row, exact = run_mode('exact', lambda q: utils.search_features(q, features, k, sim_func), queries)
+    row['recall'] = 1.0
+    rows.append(row)
+
+    row, _ = run_mode('kmeans', lambda q: utils.search_features(q, features, k, sim_func, kmeans=kmeans,
+                                                                kclusters=kclusters), queries, exact)
+    rows.append(row)
+
+    index = ivf_index.IVFIndex.build(kmeans, features)
+    for nprobe in nprobes:
+        row, _ = run_mode(f'ivf nprobe={nprobe}', lambda q: utils.search_features(
+            q, features, k, sim_func, index=index, nprobe=nprobe), queries, exact)
+        rows.append(row)
+
+    for row in rows:
+        row.update(size=size, dim=dim, k=k, sim_func=sim_func)
+    return rows
+
+
+class InMemoryConnection:
+    """ psycopg2-like connection answering the metadata PREPARE/EXECUTE from a dict """
+
+    closed = 0
+
+    def __init__(self, table):
+        self.table = table
+
+    def cursor(self):
+        return InMemoryCursor(self.table)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class InMemoryCursor:
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.rows = [self.table[k] for k in params[0] if k in self.table] if sql.startswith('EXECUTE') else []
+
+    def fetchall(self):
+        return self.rows
+
+
+def serve_images(content):
+    """ Starts a local HTTP server returning 'content' for any path; returns (server, base url) """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/'
+
+
+def benchmark_stages(size, dim, k, n_queries, n_clusters, input_shape=(224, 224, 3), source_shape=(768, 1024)):
+    """ Times each stage of a search request separately, one query image at a time """
+    features, kmeans, kclusters = synthetic_corpus(size, dim, n_clusters)
+    encoder = utils.StubEncoder(input_shape, dim=dim)
+    rng = np.random.default_rng(2)
+    image = cv2.imencode('.jpg', (rng.random((*source_shape, 3)) * 255).astype('uint8'))[1].tobytes()
+
+    table = {key: (key, 'Collection', 'Ref', f'{key}.jpg', f'{key}.jpg', 'L1', 'A1', 'C1', None)
+             for key in features.keys[:max(1000, k)].tolist()}
+    server, base_url = serve_images(image)
+    table = {key: row[:8] + (base_url + key,) for key, row in table.items()}
+    db = utils.PGdB({'hostName': '', 'dbName': '', 'userName': '', 'password': ''},
+                    connect=lambda: InMemoryConnection(table))
+    keys = list(table)
+    # a zero-byte cache keeps nothing, so every fetch goes over HTTP
+    fetcher = image_fetcher.ImageFetcher(max_workers=k, cache=image_fetcher.ImageCache(0))
+
+    timings = {stage: [] for stage in ['decode', 'resize', 'preprocess', 'encode', 'cluster', 'score', 'db', 'fetch']}
+
+    def timed(stage, fn, *args):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        timings[stage].append(time.perf_counter() - t0)
+        return out
+
+    try:
+        for i in range(n_queries):
+            decoded = timed('decode', lambda: cv2.cvtColor(cv2.imdecode(np.frombuffer(image, np.uint8),
+                                                                        cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB))
+            prepared = timed('resize', lambda: utils.standardize(utils.resize(decoded, input_shape[:2])))
+            timed('preprocess', preprocess.preprocess, image, input_shape)  # fused decode + resize path
+            vector = timed('encode', lambda: encoder.predict(prepared[None]).astype('float16'))
+            timed('cluster', utils.kmeans_cluster, kmeans, vector)
+            timed('score', utils.search_features, vector, features, k, 'cosine')
+            result_keys = keys[i * k % len(keys):][:k]
+            rows = timed('db', db.select_rows_by_key, result_keys)
+            timed('fetch', fetcher.fetch_many, [r[8] for r in rows.values()])
+    finally:
+        server.shutdown()
+
+    return [dict(stage=stage, size=size, dim=dim, k=k, **percentiles(t)) for stage, t in timings.items()]
+
+
+def check_empty_query():
+    """ search_features with no query vectors returns [] in every search mode """
+    features, kmeans, kclusters = synthetic_corpus(500, 32, 4)
+    index = ivf_index.IVFIndex.build(kmeans, features)
+    empty = np.empty((0, 32), dtype='float16')
+    for sim_func in ['cosine', 'euclidean']:
+        assert utils.search_features(empty, features, 5, sim_func) == []
+        assert utils.search_features(empty, features, 5, sim_func, kmeans=kmeans, kclusters=kclusters) == []
+        assert utils.search_features(empty, features, 5, sim_func, index=index) == []
+
+
+def check_empty_search():
+    """ search() with no images returns [] without encoding anything """
+    features, kmeans, kclusters = synthetic_corpus(500, 32, 4)
+    encoder = utils.StubEncoder((64, 64, 3), dim=32)
+    assert utils.search([], features, encoder, (64, 64, 3), 5, 'cosine') == []
+    assert utils.search(iter([]), features, encoder, (64, 64, 3), 5, 'cosine', kmeans=kmeans,
+                        kclusters=kclusters) == []
+
+
+def check_ivf_replaced_key():
+    """ A key replaced through SegmentedStore.add is found at its new vector by an IVF index built on the
+    base, even when the new vector lies in another cluster """
+    features, kmeans, kclusters = synthetic_corpus(2000, 32, 8)
+    index = ivf_index.IVFIndex.build(kmeans, features)
+    key = features.keys[0]
+    old_cluster = int(kmeans.predict(features.vectors[:1].astype('float32'))[0])
+    new_cluster = (old_cluster + 1) % len(kmeans.cluster_centers_)
+    vector = kmeans.cluster_centers_[new_cluster] * 3
+
+    directory = tempfile.mkdtemp()
+    try:
+        feature_store.save(os.path.join(directory, 'base'), features)
+        store = ingest.SegmentedStore.create(os.path.join(directory, 'store'), os.path.join(directory, 'base'),
+                                             kclusters)
+        store.add([key], [vector], [new_cluster])
+        snapshot = store.snapshot()
+        query = vector[None, :].astype('float16')
+        for sim_func in ['cosine', 'euclidean']:
+            assert utils.search_features(query, snapshot, 1, sim_func)[0][0][1] == key
+            assert utils.search_features(query, snapshot, 1, sim_func, index=index, nprobe=1)[0][0][1] == key
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_ivf_pq_metric():
+    """ With PQ codes, rerank=0 over every list matches the exact search, and the default preselection
+    ranks by the requested metric: cosine recall stays high when vector norms vary widely """
+    features, kmeans, kclusters = synthetic_corpus(5000, 32, 8)
+    features.norms *= np.random.default_rng(3).uniform(0.3, 3, len(features)).astype('float32')
+    index = ivf_index.IVFIndex.build(kmeans, features, pq_subspaces=8)
+    queries = synthetic_queries(features, 100)
+    for sim_func in ['cosine', 'euclidean']:
+        exact = utils.search_features(queries, features, 10, sim_func)
+        full = index.search(queries, 10, sim_func, nprobe=8, rerank=0)
+        assert [[k for _, k in r] for r in full] == [[k for _, k in r] for r in exact]
+        approx = index.search(queries, 10, sim_func, nprobe=8)
+        recall = np.mean([len({k for _, k in a} & {k for _, k in e}) / 10 for a, e in zip(approx, exact)])
+        assert recall > 0.7, f'{sim_func} recall@10 {recall:.3f} with every list probed'
+
+
+def check_image_cache_disk_budget():
+    """ The files behind an ImageCache stay within max_disk_bytes, also across restarts """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = image_fetcher.ImageCache(100, cache_dir, max_disk_bytes=250)
+        for i in range(5):
+            cache.put(f'url{i}', bytes(100))
+        cache.get('url3')  # url3 is now more recent than url4
+        cache.put('url5', bytes(100))
+        on_disk = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+        assert on_disk == cache.disk_size == 200
+        assert cache.get('url0') is None and cache.get('url3') is not None
+
+        reopened = image_fetcher.ImageCache(100, cache_dir, max_disk_bytes=100)
+        assert len(os.listdir(cache_dir)) == 1 and reopened.disk_size == 100
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+CHECKS = [check_empty_query, check_empty_search, check_ivf_replaced_key, check_ivf_pq_metric,
+          check_image_cache_disk_budget]
+
+
+def run_checks():
+    for check in CHECKS:
+        check()
+        print(f'{check.__name__:<32} ok')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks utils.search on synthetic corpora.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--k', type=int, nargs='+', default=[5])
+    parser.add_argument('--sim-func', nargs='+', default=['cosine', 'euclidean'])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--clusters', type=int, default=64)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--stage-queries', type=int, default=20)
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--check', action='store_true', help='run the regression checks instead')
+    args = parser.parse_args(argv)
+    if args.check:
+        run_checks()
+        return
+
+    report = {'search': [], 'stages': []}
+    for size in args.sizes:
+        for k in args.k:
+            for sim_func in args.sim_func:
+                for row in benchmark_search(size, args.dim, k, sim_func, args.nprobe, args.queries, args.clusters):
+                    report['search'].append(row)
+                    print(f"size={size:<9} k={k:<3} {sim_func:<9} {row['mode']:<14} qps={row['qps']:>9.1f} "
+                          f"p50={row['p50_ms']:.2f}ms p95={row['p95_ms']:.2f}ms p99={row['p99_ms']:.2f}ms "
+                          f"peak={row['peak_mb']:.1f}MB recall@{k}={row['recall']:.3f}")
+
+    for row in benchmark_stages(args.sizes[0], args.dim, args.k[0], args.stage_queries, args.clusters):
+        report['stages'].append(row)
+        print(f"stage {row['stage']:<8} p50={row['p50_ms']:.2f}ms p95={row['p95_ms']:.2f}ms p99={row['p99_ms']:.2f}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -0,0 +1,134 @@
+""" Two-level query cache for repeated searches with the same images.
+
+The feature cache maps the sha256 of the query bytes to its encoded vector, skipping decode and the
+encoder. The result cache maps (vector hash, search parameters, corpus version) to the ranked
+(score, key) list, skipping the scan. Both are LRU caches bounded in bytes with an optional TTL.
+The result cache is cleared whenever the corpus version changes, i.e. a new ingest generation,
+another feature store or IVF index. A SearchCache belongs to one encoder and input_shape.
+"""
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache:
+    """ Thread-safe LRU mapping bounded by 'max_bytes', with entries expiring 'ttl' seconds after insertion """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, ttl=None, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._items = OrderedDict()  # key: (value, size, expires)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[2] is not None and item[2] <= self.clock():
+                self._pop(key)
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            self._items[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._items)))
+                self.evictions += 1
+
+    def _pop(self, key):
+        self.size -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'entries': len(self._items), 'bytes': self.size}
+
+
+class SearchCache:
+    """ Feature cache in front of get_features_batch and result cache in front of search_features """
+
+    def __init__(self, feature_bytes=64 * 2 ** 20, result_bytes=64 * 2 ** 20, ttl=3600):
+        self.features = LRUCache(feature_bytes, ttl)
+        self.results = LRUCache(result_bytes, ttl)
+        self.version = None
+        self._lock = threading.Lock()
+
+    def get_vector(self, image):
+        return self.features.get(hashlib.sha256(image).digest())
+
+    def put_vector(self, image, vector):
+        vector = np.array(vector, dtype='float16')  # a copy, so later writes to the source cannot leak in
+        self.features.put(hashlib.sha256(image).digest(), vector, vector.nbytes + 100)
+
+    def encode(self, queries, encode):
+        """ Returns the vectors of 'queries', calling encode(images) once for the distinct misses """
+        queries = list(queries)
+        vectors = [self.get_vector(q) for q in queries]
+        missing = list(dict.fromkeys(q for q, v in zip(queries, vectors) if v is None))
+        if missing:
+            encoded = dict(zip(missing, encode(missing)))
+            for q, v in encoded.items():
+                self.put_vector(q, v)
+            vectors = [encoded[q] if v is None else v for q, v in zip(queries, vectors)]
+        if not vectors:
+            return np.empty((0, 0), dtype='float16')
+        return np.stack(vectors).astype('float16')
+
+    def check_version(self, version):
+        """ Clears the result cache when the corpus it was filled from has changed """
+        with self._lock:
+            if version != self.version:
+                self.results.clear()
+                self.version = version
+
+    def search(self, query_features, version, params, search):
+        """ Returns the ranked results of every query vector, calling search(vectors) once for the distinct misses """
+        self.check_version(version)
+        keys = [(hashlib.sha256(np.asarray(q, dtype='float16').tobytes()).digest(), params, version)
+                for q in query_features]
+        results = [self.results.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, r in zip(keys, results) if r is None))
+        if missing:
+            rows = {key: i for i, key in reversed(list(enumerate(keys)))}
+            found = dict(zip(missing, search(np.stack([query_features[rows[key]] for key in missing]))))
+            for key, r in found.items():
+                self.results.put(key, r, 64 + sum(72 + sys.getsizeof(k) for _, k in r))
+            results = [found[key] if r is None else r for key, r in zip(keys, results)]
+        return [list(r) for r in results]
+
+    def invalidate(self):
+        self.features.clear()
+        self.results.clear()
+
+    def stats(self):
+        return {'features': self.features.stats(), 'results': self.results.stats()}
+
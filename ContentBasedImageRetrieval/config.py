@@ -2,8 +2,25 @@ root_dir = 'ROOT/DIR'
 kmeans_path = 'path/to/cluster/model'
 encoder_path = 'path/to/encoder'
 input_shape = (224, 224, 3)
+batch_size = 32  # query images per encoder forward pass
 kcluster_path = 'path/to/clusters'
 features_path = 'path/to/image/vectors'
+feature_store_path = 'path/to/feature/store'  # memory-mapped store from feature_store.py; used instead of features_path if present
+quantized_path = 'path/to/quantized.npz'  # int8 features from quantize.py; scanned instead of feature_store_path if both exist
+ingest_store_path = 'path/to/ingest/store'  # segmented store from ingest.py; used instead of the above if present
+ivf_index_path = 'path/to/ivf/index.npz'  # built by ivf_index.py; searched instead of kclusters if present
+search_shards = 0  # worker processes scanning slices of the feature store (not the quantized one); 0 scans in-process
+nprobe = 8  # clusters probed per query; higher is slower with better recall
+# query cache
+feature_cache_bytes = 64 * 2 ** 20  # encoded vectors of recently searched images, keyed by their content hash
+result_cache_bytes = 64 * 2 ** 20  # ranked results of recently searched vectors
+cache_ttl = 3600  # seconds a cached vector or result stays valid; None keeps them until evicted
+# result image fetching
+fetch_workers = 16  # concurrent image downloads
+image_cache_bytes = 256 * 2 ** 20  # in-memory LRU budget for fetched images
+image_cache_dir = None  # directory backing the image cache on disk; None keeps it in memory only
+image_cache_disk_bytes = 2 ** 30  # budget for the files in image_cache_dir; least recently used are removed first
+thumbnail_size = None  # (height, width) to return shrunk thumbnails instead of originals
 # database credentials
 db_cred = {'hostName': 'sql-server',
            'dbName': 'db-name',
@@ -0,0 +1,216 @@
+""" Bulk offline encoding of an image corpus into a feature store.
+
+Image files are decoded, resized and standardized in a process pool, handed to the encoder in
+fixed-size batches through a bounded prefetch queue, and appended straight to a feature store.
+Rerunning with --resume skips every key already written.
+
+    python encode_corpus.py path/to/images [--manifest] [--out path/to/feature/store] [--resume]
+
+A manifest is a text file with one image per line, either 'path' or 'key<TAB>path'.
+Keys default to the file name without its extension.
+"""
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+import config
+import feature_store
+import preprocess
+import utils
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def list_images(source, manifest=False):
+    """ Returns sorted [(key, path)] from a directory tree or a manifest file """
+    items = []
+    if manifest:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line.strip():
+                    continue
+                key, path = line.split('\t', 1) if '\t' in line else (None, line)
+                path = os.path.join(base, path)
+                items.append((key or os.path.splitext(os.path.basename(path))[0], path))
+    else:
+        for root, _, files in os.walk(source):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    items.append((os.path.splitext(name)[0], os.path.join(root, name)))
+    return sorted(items)
+
+
+def prepare(item, input_shape):
+    """ Runs in a worker process: returns (key, standardized float32 image or None, seconds) """
+    key, path = item
+    t0 = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            image = preprocess.preprocess(f.read(), input_shape)
+    except Exception as e:
+        print(f'Skipping {path}: {e}')
+        image = None
+    return key, image, time.perf_counter() - t0
+
+
+class StageTimer:
+    """ Accumulates busy seconds and item counts per pipeline stage.
+    Preprocessing seconds are summed over the worker processes, so its rate is per worker. """
+
+    def __init__(self):
+        self.seconds = {}
+        self.items = {}
+
+    def add(self, stage, seconds, items=1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    def report(self, wall):
+        lines = []
+        for stage, seconds in self.seconds.items():
+            if not self.items[stage]:  # idle time, e.g. the encoder waiting on preprocessing
+                lines.append(f'{stage:<12} {"":>15} {seconds:>9.1f}s idle')
+                continue
+            rate = self.items[stage] / seconds if seconds else float('inf')
+            lines.append(f'{stage:<12} {self.items[stage]:>9} items {seconds:>9.1f}s busy {rate:>9.1f} img/s')
+        total = self.items.get('write', 0)
+        lines.append(f'{"overall":<12} {total:>9} items {wall:>9.1f}s wall  {total / max(wall, 1e-9):>9.1f} img/s')
+        return '\n'.join(lines)
+
+
+def encode_corpus(items, encoder, input_shape, out_path, batch_size=32, workers=None, prefetch=4,
+                  resume=False, dtype='float16', timer=None):
+    """ Encodes [(key, path)] into the feature store at 'out_path'; returns the number of new vectors """
+    timer = timer or StageTimer()
+    writer = None
+    if resume and os.path.exists(os.path.join(out_path, feature_store.KEYS_PARTIAL)):
+        writer = feature_store.StoreWriter(out_path, resume=True)
+        done = set(writer.keys)
+        items = [item for item in items if item[0] not in done]
+        print(f'Resuming after {len(done)} encoded images')
+    elif resume and os.path.exists(os.path.join(out_path, feature_store.HEADER)):
+        print(f'{out_path} is already complete')
+        return 0
+
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    failure = []
+
+    def put(batch):
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # at most 'prefetch' batches of images are in flight or decoded ahead of the encoder
+                pending = deque()
+                remaining = iter(items)
+                for item in islice(remaining, prefetch * batch_size):
+                    pending.append(pool.submit(prepare, item, input_shape))
+
+                keys, images = [], []
+                while pending and not stop.is_set():
+                    key, image, seconds = pending.popleft().result()
+                    item = next(remaining, None)
+                    if item is not None:
+                        pending.append(pool.submit(prepare, item, input_shape))
+                    timer.add('preprocess', seconds)
+                    if image is None:
+                        continue
+                    keys.append(key)
+                    images.append(image)
+                    if len(images) == batch_size:
+                        put((keys, np.stack(images)))
+                        keys, images = [], []
+                if images:
+                    put((keys, np.stack(images)))
+                for future in pending:
+                    future.cancel()
+        except Exception as e:
+            failure.append(e)
+        finally:
+            put(None)
+
+    producer = threading.Thread(target=produce, name='preprocess', daemon=True)
+    producer.start()
+
+    written = 0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            batch = batches.get()
+            timer.add('wait', time.perf_counter() - t0, 0)  # encoder starved by preprocessing
+            if batch is None:
+                break
+            keys, images = batch
+
+            t0 = time.perf_counter()
+            vectors = np.asarray(encoder.predict(images)).reshape(len(images), -1)
+            timer.add('encode', time.perf_counter() - t0, len(images))
+
+            t0 = time.perf_counter()
+            if writer is None:
+                writer = feature_store.StoreWriter(out_path, vectors.shape[1], dtype)
+            writer.append(keys, *utils.normalize_rows(vectors))
+            writer.checkpoint()
+            timer.add('write', time.perf_counter() - t0, len(images))
+            written += len(keys)
+    finally:
+        stop.set()
+
+    producer.join()
+    if failure:
+        raise failure[0]
+    if writer is not None:
+        writer.close()
+    return written
+
+
+def main(argv=None):
+    root = config.root_dir
+    parser = argparse.ArgumentParser(description='Encodes an image corpus into a feature store.')
+    parser.add_argument('source', help='image directory, or manifest file with --manifest')
+    parser.add_argument('--manifest', action='store_true')
+    parser.add_argument('--out', default=os.path.join(root, config.feature_store_path))
+    parser.add_argument('--batch-size', type=int, default=config.batch_size)
+    parser.add_argument('--workers', type=int, default=None, help='preprocessing processes; defaults to the CPU count')
+    parser.add_argument('--prefetch', type=int, default=4, help='batches queued ahead of the encoder')
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--stub-encoder', action='store_true')
+    args = parser.parse_args(argv)
+
+    items = list_images(args.source, args.manifest)
+    if args.stub_encoder:
+        encoder = utils.StubEncoder(config.input_shape)
+    else:
+        encoder = utils.load_model(os.path.join(root, config.encoder_path), compiled=True)
+
+    timer = StageTimer()
+    t0 = time.perf_counter()
+    written = encode_corpus(items, encoder, config.input_shape, args.out, args.batch_size, args.workers,
+                            args.prefetch, args.resume, timer=timer)
+    print(f'Encoded {written} of {len(items)} images into {args.out}')
+    print(timer.report(time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
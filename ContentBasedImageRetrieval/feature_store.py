@@ -0,0 +1,208 @@
+""" On-disk feature store opened with np.memmap instead of unpickling the FEATURES dict.
+
+A store is a directory holding:
+    header.json  {"version", "count", "dim", "dtype"}
+    vectors.bin  (count, dim) unit-length rows, 'dtype' (float16 by default), C order
+    norms.bin    (count,) float32 norms of the original vectors
+    keys.npy     (count,) keys, in row order
+
+Opened read-only, the pages are shared through the OS page cache by every process that opens the store.
+
+    python feature_store.py convert path/to/image/vectors path/to/feature/store
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+import utils
+
+VERSION = 1
+HEADER = 'header.json'
+VECTORS = 'vectors.bin'
+NORMS = 'norms.bin'
+KEYS = 'keys.npy'
+KEYS_PARTIAL = 'keys.partial'
+HEADER_PARTIAL = 'header.partial'
+
+
+class FeatureStore(utils.FeatureMatrix):
+    """ FeatureMatrix whose vectors and norms are memory-mapped from a store directory """
+
+    def __init__(self, path, keys, vectors, norms, header):
+        super().__init__(keys, vectors, norms)
+        self.path = path
+        self.header = header
+
+    @classmethod
+    def open(cls, path):
+        header = read_header(path)
+        count, dim = header['count'], header['dim']
+        if count:
+            vectors = np.memmap(os.path.join(path, VECTORS), dtype=header['dtype'], mode='r', shape=(count, dim))
+            norms = np.memmap(os.path.join(path, NORMS), dtype='float32', mode='r', shape=(count,))
+        else:
+            vectors, norms = np.empty((0, dim), dtype=header['dtype']), np.empty(0, dtype='float32')
+        keys = load_keys(path)
+        if len(keys) != count:
+            raise ValueError(f'{path}: {len(keys)} keys for {count} vectors')
+        return cls(path, keys, vectors, norms, header)
+
+
+def read_header(path):
+    with open(os.path.join(path, HEADER)) as f:
+        header = json.load(f)
+    if header.get('version') != VERSION:
+        raise ValueError(f'{path}: unsupported feature store version {header.get("version")}')
+    return header
+
+
+def load_keys(path):
+    keys_path = os.path.join(path, KEYS)
+    try:
+        return np.load(keys_path, mmap_mode='r')
+    except ValueError:  # object keys are pickled and cannot be mapped
+        return np.load(keys_path, allow_pickle=True)
+
+
+def save_keys(path, keys):
+    keys = list(keys)
+    packed = np.asarray(keys)
+    if packed.dtype.kind not in 'iuU' or packed.tolist() != keys:
+        packed = np.empty(len(keys), dtype=object)
+        packed[:] = keys
+    np.save(os.path.join(path, KEYS), packed, allow_pickle=True)
+
+
+def write_header(path, count, dim, dtype):
+    header = {'version': VERSION, 'count': int(count), 'dim': int(dim), 'dtype': np.dtype(dtype).name}
+    tmp = os.path.join(path, HEADER + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp, os.path.join(path, HEADER))  # the header is written last and marks the store complete
+    return header
+
+
+class StoreWriter:
+    """ Appends rows to a store directory. Keys are kept in 'keys.partial' (dim and dtype in 'header.partial')
+    until close() writes keys.npy and the header; with resume=True an unfinished store is reopened
+    after its last complete row. """
+
+    def __init__(self, path, dim=None, dtype='float16', resume=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        keys = self._read_partial_keys() if resume else None
+        if keys is None:
+            with open(os.path.join(path, HEADER_PARTIAL), 'w') as f:
+                json.dump({'dim': int(dim), 'dtype': np.dtype(dtype).name}, f)
+        with open(os.path.join(path, HEADER_PARTIAL)) as f:
+            partial = json.load(f)
+        self.dim = partial['dim']
+        self.dtype = np.dtype(partial['dtype'])
+        self.keys = keys or []
+        mode = 'wb' if keys is None else 'r+b'
+        self._vectors = open(os.path.join(path, VECTORS), mode)
+        self._norms = open(os.path.join(path, NORMS), mode)
+        self._keys = open(os.path.join(path, KEYS_PARTIAL), mode)
+        # a torn final key record and rows past the last recorded key were not checkpointed
+        self._keys.truncate(self._keys_end if keys is not None else 0)
+        self._keys.seek(0, os.SEEK_END)
+        self._vectors.truncate(len(self.keys) * self.dim * self.dtype.itemsize)
+        self._norms.truncate(len(self.keys) * 4)
+        self._vectors.seek(0, os.SEEK_END)
+        self._norms.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _read_partial_keys(self):
+        """ Returns the recorded keys and sets '_keys_end' to the offset after the last complete record """
+        keys = []
+        self._keys_end = 0
+        try:
+            with open(os.path.join(self.path, KEYS_PARTIAL), 'rb') as f:
+                while True:
+                    try:
+                        keys.extend(pickle.load(f))
+                    except Exception:  # end of file, or a torn final record, which can fail in any way
+                        break
+                    self._keys_end = f.tell()
+        except FileNotFoundError:
+            return None
+        return keys
+
+    def append(self, keys, vectors, norms):
+        """ Appends unit 'vectors' (n, dim) with their original 'norms' """
+        keys = list(keys)
+        self._vectors.write(np.ascontiguousarray(vectors, dtype=self.dtype).tobytes())
+        self._norms.write(np.ascontiguousarray(norms, dtype='float32').tobytes())
+        self._vectors.flush()
+        self._norms.flush()
+        pickle.dump(keys, self._keys)  # recorded last: a crash before this drops the block on resume
+        self._keys.flush()
+        self.keys.extend(keys)
+
+    def checkpoint(self):
+        """ Forces appended rows to disk """
+        for f in (self._vectors, self._norms, self._keys):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.checkpoint()
+        for f in (self._vectors, self._norms, self._keys):
+            f.close()
+        save_keys(self.path, self.keys)
+        os.remove(os.path.join(self.path, KEYS_PARTIAL))
+        os.remove(os.path.join(self.path, HEADER_PARTIAL))
+        return write_header(self.path, len(self.keys), self.dim, self.dtype)
+
+
+def save(path, features, dtype='float16'):
+    """ Writes a {key: vector} dict or FeatureMatrix as a store at 'path' """
+    if isinstance(features, utils.FeatureMatrix):
+        keys = features.keys_at(np.arange(len(features)))
+        dim = features.dim
+    else:
+        keys = list(features.keys())
+        dim = np.asarray(features[keys[0]]).size if keys else 0
+
+    writer = StoreWriter(path, dim, dtype)
+    block_rows = utils.FeatureMatrix.block_rows
+    for start in range(0, len(keys), block_rows):
+        block_keys = keys[start:start + block_rows]
+        if isinstance(features, utils.FeatureMatrix):
+            writer.append(block_keys, features.vectors[start:start + block_rows],
+                          features.norms[start:start + block_rows])
+        else:
+            writer.append(block_keys, *utils.normalize_rows([features[k] for k in block_keys]))
+    return writer.close()
+
+
+def convert(pickle_path, store_path, dtype='float16'):
+    """ Converts the pickled FEATURES dict into a feature store """
+    return save(store_path, utils.load_pickle(pickle_path), dtype)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Converts the pickled image vectors into a feature store.')
+    parser.add_argument('command', choices=['convert'])
+    parser.add_argument('pickle_path')
+    parser.add_argument('store_path')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    args = parser.parse_args(argv)
+
+    header = convert(args.pickle_path, args.store_path, args.dtype)
+    print(f"Wrote {header['count']} x {header['dim']} {header['dtype']} vectors to {args.store_path}")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
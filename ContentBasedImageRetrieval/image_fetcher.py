@@ -0,0 +1,165 @@
+""" Fetches result images for display_results in parallel over a pooled HTTP session,
+with a byte-budgeted LRU cache keyed by ImageUrl and optional resized thumbnails. """
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ImageCache:
+    """ LRU cache of image bytes bounded by 'max_bytes', optionally backed by files in 'cache_dir'.
+    The files are bounded separately by 'max_disk_bytes', evicting the least recently used first;
+    files left by an earlier run count towards it, oldest mtime first. """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, cache_dir=None, max_disk_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = cache_dir
+        self.size = 0
+        self.disk_size = 0
+        self._items = OrderedDict()
+        self._files = OrderedDict()  # file name -> size, least recently used first
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        if self.cache_dir:
+            name = self._name(key)
+            try:
+                with open(os.path.join(self.cache_dir, name), 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                with self._lock:
+                    self.disk_size -= self._files.pop(name, 0)
+                return None
+            with self._lock:
+                if name in self._files:
+                    self._files.move_to_end(name)
+            try:
+                os.utime(os.path.join(self.cache_dir, name))  # keeps the order for the next _scan
+            except OSError:
+                pass
+            self._remember(key, content)
+            return content
+        return None
+
+    def put(self, key, content):
+        self._remember(key, content)
+        if self.cache_dir and len(content) <= self.max_disk_bytes:
+            name = self._name(key)
+            tmp = os.path.join(self.cache_dir, f'{name}.{threading.get_ident()}.tmp')
+            with open(tmp, 'wb') as f:
+                f.write(content)
+            with self._lock:
+                os.replace(tmp, os.path.join(self.cache_dir, name))
+                self.disk_size += len(content) - self._files.pop(name, 0)
+                self._files[name] = len(content)
+                self._evict_files()
+
+    def _remember(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def _scan(self):
+        """ Accounts for the files already in cache_dir """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        with self._lock:
+            for _, name, size in sorted(files):
+                self._files[name] = size
+                self.disk_size += size
+            self._evict_files()
+
+    def _evict_files(self):
+        """ Removes the least recently used files until the disk budget holds; call with the lock held """
+        while self.disk_size > self.max_disk_bytes:
+            name, size = self._files.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _name(self, key):
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+
+class ImageFetcher:
+    """ Downloads images on a bounded thread pool sharing one keep-alive session.
+    With 'thumbnail_size' (height, width), images are shrunk to fit and re-encoded as JPEG. """
+
+    def __init__(self, max_workers=16, timeout=(3.05, 10), retries=2, cache=None, thumbnail_size=None,
+                 session=None):
+        self.timeout = timeout
+        self.thumbnail_size = thumbnail_size
+        self.cache = cache if cache is not None else ImageCache()
+        self.session = session or requests.Session()
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retries)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch')
+
+    def fetch(self, image_url):
+        """ Returns the (thumbnail) bytes of 'image_url' """
+        key = image_url if self.thumbnail_size is None else f'{image_url}#{self.thumbnail_size}'
+        content = self.cache.get(key)
+        if content is not None:
+            return content
+
+        response = self.session.get(image_url, timeout=self.timeout)
+        content = response.content
+        if not response.ok:  # served as before, but not cached
+            return content
+        if self.thumbnail_size is not None:
+            content = make_thumbnail(content, self.thumbnail_size)
+        self.cache.put(key, content)
+        return content
+
+    def fetch_string(self, image_url):
+        """ Returns the image as base64 ascii, as get_img_string does """
+        return base64.b64encode(self.fetch(image_url)).decode('ascii')
+
+    def submit_many(self, image_urls):
+        """ Starts fetching every distinct url; returns {url: Future of the base64 string} """
+        return {url: self._pool.submit(self.fetch_string, url) for url in dict.fromkeys(image_urls)}
+
+    def fetch_many(self, image_urls):
+        return {url: future.result() for url, future in self.submit_many(image_urls).items()}
+
+
+def make_thumbnail(content, size, quality=85):
+    """ Shrinks an encoded image to fit inside size=(height, width); undecodable bytes are returned as is """
+    image = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return content
+    scale = min(size[0] / image.shape[0], size[1] / image.shape[1])
+    if scale < 1:
+        image = cv2.resize(image, (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale))),
+                           interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if ok else content
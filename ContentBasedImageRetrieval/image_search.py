@@ -1,6 +1,13 @@
 """ Performs search using an image. Top N similar images are returned. """
 import utils
 import config
+import cache
+import ivf_index
+import feature_store
+import image_fetcher
+import ingest
+import quantize
+import sharded
 import sys
 import os
 
@@ -10,13 +17,40 @@ ENCODER_PATH = os.path.join(ROOT_DIR, config.encoder_path)
 INPUT_SHAPE = config.input_shape
 KCLUSTER_PATH = os.path.join(ROOT_DIR, config.kcluster_path)
 FEATURE_PATH = os.path.join(ROOT_DIR, config.features_path)
+FEATURE_STORE_PATH = os.path.join(ROOT_DIR, config.feature_store_path)
+QUANTIZED_PATH = os.path.join(ROOT_DIR, config.quantized_path)
+INGEST_STORE_PATH = os.path.join(ROOT_DIR, config.ingest_store_path)
+IVF_INDEX_PATH = os.path.join(ROOT_DIR, config.ivf_index_path)
+SEARCH_SHARDS = config.search_shards
+NPROBE = config.nprobe
+BATCH_SIZE = config.batch_size
 DB_CRED = config.db_cred
+FETCHER = image_fetcher.ImageFetcher(max_workers=config.fetch_workers,
+                                     cache=image_fetcher.ImageCache(config.image_cache_bytes, config.image_cache_dir,
+                                                                    config.image_cache_disk_bytes),
+                                     thumbnail_size=config.thumbnail_size)
+CACHE = cache.SearchCache(config.feature_cache_bytes, config.result_cache_bytes, config.cache_ttl)
 
 try:
-    KMEANS = utils.load_pickle(KMEANS_PATH)
-    ENCODER = utils.load_model(ENCODER_PATH)
     KCLUSTER = utils.load_pickle(KCLUSTER_PATH)
-    FEATURES = utils.load_pickle(FEATURE_PATH)
+    if os.path.exists(os.path.join(INGEST_STORE_PATH, ingest.MANIFEST)):
+        FEATURES = ingest.SegmentedStore(INGEST_STORE_PATH, KCLUSTER).snapshot()
+        KCLUSTER = FEATURES.kclusters
+    elif os.path.exists(FEATURE_STORE_PATH):
+        if SEARCH_SHARDS and not os.path.exists(QUANTIZED_PATH):
+            FEATURES = sharded.ShardedStore.open(FEATURE_STORE_PATH).start(SEARCH_SHARDS, KCLUSTER, KCLUSTER_PATH)
+        else:
+            FEATURES = feature_store.FeatureStore.open(FEATURE_STORE_PATH)
+        if os.path.exists(QUANTIZED_PATH):  # int8 scan, reranked against the memory-mapped store
+            FEATURES = quantize.QuantizedMatrix.load(QUANTIZED_PATH, exact=FEATURES)
+    else:
+        FEATURES = utils.FeatureMatrix.from_dict(utils.load_pickle(FEATURE_PATH))
+    INDEX = None
+    if os.path.exists(IVF_INDEX_PATH):
+        INDEX = ivf_index.IVFIndex.load(IVF_INDEX_PATH).bind(FEATURES)
+    # loaded after the shard workers are forked: forking once TensorFlow has started its threads can deadlock
+    KMEANS = utils.load_pickle(KMEANS_PATH)
+    ENCODER = utils.load_model(ENCODER_PATH, compiled=True)
 except Exception as e:
     print(e)
     sys.exit(-1)
@@ -39,7 +73,11 @@ try:
                            max_results=5,
                            sim_func='cosine',
                            kmeans=KMEANS,
-                           kclusters=KCLUSTER
+                           kclusters=KCLUSTER,
+                           index=INDEX,
+                           nprobe=NPROBE,
+                           batch_size=BATCH_SIZE,
+                           cache=CACHE
                            )
 
 except Exception as e:
@@ -50,7 +88,8 @@ except Exception as e:
 try:
     json_dump = utils.display_results(query=queries,
                                       results=results,
-                                      db_cred=DB_CRED
+                                      db_cred=DB_CRED,
+                                      fetcher=FETCHER
                                       )
     print(json_dump)
 except Exception as e:
@@ -0,0 +1,322 @@
+""" Incremental updates to the search corpus.
+
+New images are encoded with the ENCODER, assigned with KMEANS and appended to a segmented store:
+an immutable base feature store plus small append-only segments, with per-segment deletion tombstones.
+Every change publishes a new manifest generation with an atomic rename, so a search holding a
+Snapshot never sees a half-applied change. compact() merges the live rows into a new base.
+
+    python ingest.py init                             # wraps feature_store_path as generation 0
+    python ingest.py add img1.jpg img2.jpg [--keys K1 K2]
+    python ingest.py delete K1 K2
+    python ingest.py compact
+
+Keys must be JSON serializable (str or int), as the tombstones are kept in the manifest.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+
+import numpy as np
+
+import config
+import feature_store
+import utils
+
+MANIFEST = 'manifest.json'
+CLUSTERS = 'clusters.npy'
+
+
+class Snapshot(utils.RankedRows):
+    """ Read-only view of one manifest generation: the base and segment stores laid end to end,
+    with tombstoned rows scoring inf, plus the matching kclusters dict. It ranks like a FeatureMatrix
+    but has no vectors or norms of its own; those stay in the parts. """
+
+    def __init__(self, generation, parts, deleted, kclusters):
+        self.generation = generation
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(p) for p in parts])
+        self.deleted = deleted
+        self.kclusters = kclusters
+        self._keys = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def base_rows(self):
+        """ Rows of the base store; segment rows follow them """
+        return int(self.offsets[1])
+
+    @property
+    def dim(self):
+        return self.parts[0].dim
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = np.empty(len(self), dtype=object)
+            self._keys[:] = self.keys_at(np.arange(len(self)))
+        return self._keys
+
+    def _split(self, rows):
+        """ Yields (part number, positions in 'rows', part-local rows) """
+        part = np.searchsorted(self.offsets, rows, side='right') - 1
+        for p in np.unique(part):
+            positions = np.flatnonzero(part == p)
+            yield p, positions, rows[positions] - self.offsets[p]
+
+    def keys_at(self, rows):
+        rows = np.asarray(rows, dtype='int64')
+        keys = [None] * len(rows)
+        for p, positions, local in self._split(rows):
+            for i, k in zip(positions.tolist(), self.parts[p].keys_at(local)):
+                keys[i] = k
+        return keys
+
+    def lookup(self, keys):
+        keys = list(keys)
+        rows = np.full(len(keys), -1, dtype='int64')
+        for p, part in enumerate(self.parts):
+            local = part.lookup(keys)
+            found = local >= 0
+            found[found] = ~np.isin(local[found] + self.offsets[p], self.deleted)
+            rows[found] = local[found] + self.offsets[p]
+        return rows
+
+    def distances(self, query_features, sim_func, rows=None):
+        if rows is None:
+            out = np.concatenate([p.distances(query_features, sim_func) for p in self.parts], axis=1)
+            out[:, self.deleted] = np.inf
+            return out
+
+        rows = np.asarray(rows, dtype='int64')
+        out = np.empty((len(query_features), len(rows)), dtype='float32')
+        for p, positions, local in self._split(rows):
+            out[:, positions] = self.parts[p].distances(query_features, sim_func, local)
+        out[:, np.isin(rows, self.deleted)] = np.inf
+        return out
+
+
+class SegmentedStore:
+    """ Directory of feature stores described by manifest.json:
+    {"generation", "base", "segments": [names], "tombstones": {part name: [keys]}}
+    Writers in one process are serialized; run a single writer process per store. """
+
+    def __init__(self, path, kclusters=None, max_segments=16):
+        self.path = path
+        self.base_kclusters = kclusters or {}  # clusters of a base without its own clusters.npy
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._parts = {}
+        self._clusters = {}
+        self._snapshot = None
+
+    @classmethod
+    def create(cls, path, base_path, kclusters=None, max_segments=16):
+        """ Starts a store whose generation 0 is the existing feature store at 'base_path' """
+        os.makedirs(path, exist_ok=True)
+        store = cls(path, kclusters, max_segments)
+        store._write_manifest({'generation': 0, 'base': os.path.abspath(base_path),
+                               'segments': [], 'tombstones': {}})
+        return store
+
+    def read_manifest(self):
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def _part(self, name):
+        if name not in self._parts:
+            self._parts[name] = feature_store.FeatureStore.open(os.path.join(self.path, name))
+        return self._parts[name]
+
+    def _part_clusters(self, name):
+        """ Returns the cluster id of every row of part 'name', or None if it has no clusters.npy """
+        if name not in self._clusters:
+            path = os.path.join(self.path, name, CLUSTERS)
+            self._clusters[name] = np.load(path) if os.path.exists(path) else None
+        return self._clusters[name]
+
+    def _cluster_lists(self, name):
+        part, clusters = self._part(name), self._part_clusters(name)
+        if clusters is None:
+            return self.base_kclusters
+        lists = {}
+        keys = part.keys_at(np.arange(len(part)))
+        for k, c in zip(keys, clusters.tolist()):
+            lists.setdefault(c, []).append(k)
+        return lists
+
+    def snapshot(self):
+        """ Returns the Snapshot of the current generation """
+        while True:
+            manifest = self.read_manifest()
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.generation == manifest['generation']:
+                return snapshot
+            try:
+                self._snapshot = self._load_snapshot(manifest)
+                return self._snapshot
+            except FileNotFoundError:  # compacted away between reading the manifest and opening its parts
+                continue
+
+    def _load_snapshot(self, manifest):
+        names = [manifest['base']] + manifest['segments']
+        parts = [self._part(name) for name in names]
+        offsets = np.cumsum([0] + [len(p) for p in parts])
+        deleted = [parts[names.index(name)].rows_for(keys) + offsets[names.index(name)]
+                   for name, keys in manifest['tombstones'].items()]
+        deleted = np.unique(np.concatenate(deleted)) if deleted else np.empty(0, dtype='int64')
+
+        kclusters = dict(self._cluster_lists(manifest['base']))
+        for name in manifest['segments']:
+            for c, keys in self._cluster_lists(name).items():
+                kclusters[c] = list(kclusters.get(c, [])) + keys
+
+        return Snapshot(manifest['generation'], parts, deleted, kclusters)
+
+    def _tombstone(self, manifest, snapshot, keys):
+        """ Records the live rows of 'keys' as deleted; returns how many were live """
+        rows = snapshot.lookup(keys)
+        names = [manifest['base']] + manifest['segments']
+        live = rows >= 0
+        for row, key in zip(rows[live].tolist(), np.asarray(keys, dtype=object)[live].tolist()):
+            part = int(np.searchsorted(snapshot.offsets, row, side='right') - 1)
+            manifest['tombstones'].setdefault(names[part], []).append(key)
+        return int(live.sum())
+
+    def add(self, keys, vectors, clusters):
+        """ Appends raw 'vectors' (n, dim) assigned to 'clusters' as one segment.
+        Keys already present are replaced. Returns the new generation. """
+        keys = list(keys)
+        with self._lock:
+            manifest = self.read_manifest()
+            snapshot = self.snapshot()
+            generation = manifest['generation'] + 1
+            name = f'seg-{generation:06d}'
+
+            writer = feature_store.StoreWriter(os.path.join(self.path, name), snapshot.dim,
+                                               snapshot.parts[0].header['dtype'])
+            writer.append(keys, *utils.normalize_rows(vectors))
+            np.save(os.path.join(self.path, name, CLUSTERS), np.asarray(clusters, dtype='int64'))
+            writer.close()
+
+            self._tombstone(manifest, snapshot, keys)
+            manifest.update(generation=generation, segments=manifest['segments'] + [name])
+            self._write_manifest(manifest)
+
+        if len(manifest['segments']) > self.max_segments:
+            self.compact()
+        return generation
+
+    def delete(self, keys):
+        """ Tombstones 'keys'; returns how many were live """
+        with self._lock:
+            manifest = self.read_manifest()
+            deleted = self._tombstone(manifest, self.snapshot(), list(keys))
+            if deleted:
+                manifest['generation'] += 1
+                self._write_manifest(manifest)
+        return deleted
+
+    def compact(self):
+        """ Rewrites the live rows of every part into a new base and drops the old segments """
+        with self._lock:
+            manifest = self.read_manifest()
+            snapshot = self.snapshot()
+            generation = manifest['generation'] + 1
+            name = f'base-{generation:06d}'
+            names = [manifest['base']] + manifest['segments']
+            key_cluster = None
+
+            writer = feature_store.StoreWriter(os.path.join(self.path, name), snapshot.dim,
+                                               snapshot.parts[0].header['dtype'])
+            clusters = []
+            for p, part in enumerate(snapshot.parts):
+                live = np.setdiff1d(np.arange(len(part)), snapshot.deleted - snapshot.offsets[p])
+                part_clusters = self._part_clusters(names[p])
+                for start in range(0, len(live), utils.FeatureMatrix.block_rows):
+                    rows = live[start:start + utils.FeatureMatrix.block_rows]
+                    keys = part.keys_at(rows)
+                    writer.append(keys, part.vectors[rows], part.norms[rows])
+                    if part_clusters is not None:
+                        clusters.append(part_clusters[rows])
+                    else:
+                        if key_cluster is None:
+                            key_cluster = {k: c for c, ks in self.base_kclusters.items() for k in ks}
+                        clusters.append(np.asarray([key_cluster.get(k, -1) for k in keys], dtype='int64'))
+            np.save(os.path.join(self.path, name, CLUSTERS),
+                    np.concatenate(clusters) if clusters else np.empty(0, dtype='int64'))
+            writer.close()
+
+            self._write_manifest({'generation': generation, 'base': name, 'segments': [], 'tombstones': {}})
+
+            # searches holding an older snapshot keep their mapped files (POSIX unlink semantics)
+            for old in names:
+                if not os.path.isabs(old):  # an external generation-0 base is never removed
+                    shutil.rmtree(os.path.join(self.path, old), ignore_errors=True)
+                self._parts.pop(old, None)
+                self._clusters.pop(old, None)
+        return generation
+
+
+def ingest(store, images, encoder, input_shape, kmeans, batch_size=32):
+    """ Encodes {key: image bytes}, assigns each vector to its KMeans cluster and appends them to 'store' """
+    keys = list(images)
+    vectors = utils.get_features_batch([images[k] for k in keys], encoder, input_shape, batch_size)
+    clusters = [utils.kmeans_cluster(kmeans, v) for v in vectors]
+    return store.add(keys, vectors, clusters)
+
+
+def main(argv=None):
+    root = config.root_dir
+    parser = argparse.ArgumentParser(description='Adds or removes images from the search corpus.')
+    parser.add_argument('command', choices=['init', 'add', 'delete', 'compact'])
+    parser.add_argument('items', nargs='*', help='image files to add, or keys to delete')
+    parser.add_argument('--keys', nargs='*', help='keys of the added images; defaults to the file names')
+    parser.add_argument('--store', default=os.path.join(root, config.ingest_store_path))
+    args = parser.parse_args(argv)
+
+    kclusters = utils.load_pickle(os.path.join(root, config.kcluster_path))
+    if args.command == 'init':
+        SegmentedStore.create(args.store, os.path.join(root, config.feature_store_path), kclusters)
+        print(f'Created {args.store}')
+        return
+
+    store = SegmentedStore(args.store, kclusters)
+    if args.command == 'add':
+        keys = args.keys or [os.path.splitext(os.path.basename(p))[0] for p in args.items]
+        if len(keys) != len(args.items):
+            raise ValueError('--keys must name every image')
+        images = {}
+        for key, image_path in zip(keys, args.items):
+            with open(image_path, 'rb') as f:
+                images[key] = f.read()
+        generation = ingest(store, images,
+                            encoder=utils.load_model(os.path.join(root, config.encoder_path), compiled=True),
+                            input_shape=config.input_shape,
+                            kmeans=utils.load_pickle(os.path.join(root, config.kmeans_path)),
+                            batch_size=config.batch_size)
+        print(f'Added {len(images)} images (generation {generation})')
+    elif args.command == 'delete':
+        print(f'Deleted {store.delete(args.items)} images')
+    else:
+        print(f'Compacted into generation {store.compact()}')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -0,0 +1,259 @@
+""" Inverted-file (IVF) index over the KMeans clusters, with optional product-quantized residuals.
+A query probes its 'nprobe' closest clusters instead of only one, trading recall for latency.
+
+    python ivf_index.py build [--pq 16]
+    python ivf_index.py evaluate --nprobe 1 2 4 8 16 --k 5
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+
+import config
+import utils
+
+
+class IVFIndex:
+    """ Keys grouped by KMeans cluster. List 'l' holds keys[offsets[l]:offsets[l + 1]].
+    With PQ, each key also carries 'codes': its residual from the cluster centroid
+    quantized against one 256-entry codebook per subspace. """
+
+    version = 1
+
+    def __init__(self, centroids, offsets, keys, norms, codebooks=None, codes=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.keys = keys
+        self.norms = norms
+        self.codebooks = codebooks
+        self.codes = codes
+        self.matrix = None
+        self.rows = None
+        self.extra_rows = None
+        self._bound = None
+
+    @classmethod
+    def build(cls, kmeans, features, pq_subspaces=0, pq_train=100000, seed=0):
+        """ Assigns every vector of 'features' to its KMeans cluster and optionally trains PQ codes """
+        matrix = utils.as_feature_matrix(features)
+        centroids = np.asarray(kmeans.cluster_centers_, dtype='float32')
+
+        assignment = np.empty(len(matrix), dtype='int64')
+        for start in range(0, len(matrix), matrix.block_rows):
+            block = _raw_vectors(matrix, np.arange(start, min(start + matrix.block_rows, len(matrix))))
+            assignment[start:start + len(block)] = kmeans.predict(block.astype(kmeans.cluster_centers_.dtype))
+
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=len(centroids))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+
+        codebooks = codes = None
+        if pq_subspaces:
+            residuals = lambda rows: _raw_vectors(matrix, rows) - centroids[assignment[rows]]
+            codebooks = train_pq(residuals, order, centroids.shape[1], pq_subspaces, pq_train, seed)
+            codes = np.empty((len(order), pq_subspaces), dtype='uint8')
+            for start in range(0, len(order), matrix.block_rows):
+                rows = order[start:start + matrix.block_rows]
+                codes[start:start + len(rows)] = encode_pq(codebooks, residuals(rows))
+
+        index = cls(centroids, offsets, matrix.keys[order], matrix.norms[order].astype('float32'),
+                    codebooks, codes)
+        index.bind(matrix)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as f:
+            if int(f['version']) != cls.version:
+                raise ValueError(f'Unsupported index version {int(f["version"])}')
+            pq = 'codes' in f.files
+            return cls(f['centroids'], f['offsets'], f['keys'], f['norms'],
+                       f['codebooks'] if pq else None, f['codes'] if pq else None)
+
+    def save(self, path):
+        arrays = {'version': self.version, 'centroids': self.centroids, 'offsets': self.offsets,
+                  'keys': self.keys, 'norms': self.norms}
+        if self.codes is not None:
+            arrays.update(codebooks=self.codebooks, codes=self.codes)
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def bind(self, features):
+        """ Attaches the full-precision vectors used to re-rank candidates exactly.
+        Rows of 'features' missing from the lists (ingested after the build) are scored on every search.
+        So are all segment rows of an ingest.Snapshot: a key replaced there keeps its old list position,
+        which may be the wrong cluster for its new vector. """
+        self.matrix = utils.as_feature_matrix(features)
+        self.rows = self.matrix.lookup(self.keys)
+        self.rows[self.rows >= getattr(self.matrix, 'base_rows', len(self.matrix))] = -1
+        covered = np.zeros(len(self.matrix), dtype=bool)
+        covered[self.rows[self.rows >= 0]] = True
+        self.extra_rows = np.flatnonzero(~covered)
+        return self
+
+    def bound_to(self, features):
+        """ Returns a copy of the index bound to 'features', leaving this one untouched
+        for searches still running against the previous features """
+        matrix = utils.as_feature_matrix(features)
+        bound = self._bound
+        if bound is None or bound.matrix is not matrix:
+            bound = copy.copy(self)
+            bound._bound = None
+            bound.bind(matrix)
+            self._bound = bound
+        return bound
+
+    def probe(self, query, nprobe):
+        """ Returns the 'nprobe' lists whose centroids are closest to 'query' """
+        d = ((self.centroids - query) ** 2).sum(axis=1)
+        nprobe = min(nprobe, len(d))
+        lists = np.argpartition(d, nprobe - 1)[:nprobe]
+        return lists[np.argsort(d[lists])]
+
+    def search(self, query_features, max_results, sim_func, nprobe=8, rerank=None):
+        """ Returns the 'max_results' closest (score, key) pairs per query among the probed lists.
+        With PQ codes and bound vectors, the probed keys are first ranked by their approximate 'sim_func'
+        score and only the best 'rerank' (default 10 * max_results, 0 for all) are re-scored exactly, so
+        even with every list probed the result is exact only when rerank=0 or the true neighbours survive
+        the approximate ranking. """
+        if self.matrix is None and self.codes is None:
+            raise ValueError('Index has no PQ codes; bind() the feature vectors before searching')
+        query = np.asarray(query_features, dtype='float32').reshape(len(query_features), -1)
+        rerank = 10 * max_results if rerank is None else rerank
+        results = []
+        for q in query:
+            lists = self.probe(q, nprobe)
+            positions = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+
+            if self.codes is not None:
+                approx = self._approx_scores(q, self.adc(q, lists), positions, sim_func)
+                if self.matrix is None:
+                    results.append(self._approx_top_k(approx, positions, max_results))
+                    continue
+                if 0 < rerank < len(positions):
+                    keep = np.argpartition(approx, rerank - 1)[:rerank]
+                    positions = np.sort(positions[keep])
+
+            rows = self.rows[positions]
+            rows = np.concatenate([rows[rows >= 0], self.extra_rows])
+            d = self.matrix.distances(q[None, :], sim_func, rows)
+            results.extend(self.matrix.top_k(d, max_results, rows))
+        return results
+
+    def adc(self, query, lists):
+        """ Asymmetric squared euclidean distances between 'query' and the PQ codes of 'lists' """
+        m, ksub, dsub = self.codebooks.shape
+        out = []
+        for l in lists:
+            residual = (query - self.centroids[l]).reshape(m, 1, dsub)
+            table = ((self.codebooks - residual) ** 2).sum(axis=2)  # (m, ksub)
+            codes = self.codes[self.offsets[l]:self.offsets[l + 1]]
+            out.append(table[np.arange(m), codes].sum(axis=1))
+        return np.concatenate(out)
+
+    def _approx_scores(self, query, sq_dist, positions, sim_func):
+        """ Cosine or euclidean distances of 'positions' from their ADC squared euclidean distances """
+        sq_dist = np.maximum(sq_dist, 0)
+        if sim_func == 'cosine':
+            q_norm = np.linalg.norm(query)
+            norms = self.norms[positions]
+            dot = (q_norm ** 2 + norms ** 2 - sq_dist) / 2
+            return 1 - dot / np.maximum(q_norm * norms, 1e-12)
+        return np.sqrt(sq_dist)
+
+    def _approx_top_k(self, scores, positions, max_results):
+        k = min(max_results, len(scores))
+        if k <= 0:
+            return []
+        best = np.argpartition(scores, k - 1)[:k]
+        return sorted(zip(scores[best].tolist(), self.keys[positions[best]].tolist()))
+
+
+def _raw_vectors(matrix, rows):
+    return matrix.vectors[rows].astype('float32') * matrix.norms[rows, None]
+
+
+def train_pq(residuals, rows, dim, m, n_train, seed):
+    """ Trains one codebook of up to 256 centroids per each of 'm' subspaces """
+    from sklearn.cluster import KMeans
+
+    if dim % m:
+        raise ValueError(f'Vector dimension {dim} is not divisible by {m} PQ subspaces')
+    rng = np.random.default_rng(seed)
+    sample = residuals(np.sort(rng.choice(rows, min(n_train, len(rows)), replace=False)))
+    sample = sample.reshape(len(sample), m, dim // m)
+    ksub = min(256, len(sample))
+    codebooks = np.empty((m, ksub, dim // m), dtype='float32')
+    for j in range(m):
+        km = KMeans(n_clusters=ksub, n_init=1, random_state=seed).fit(sample[:, j])
+        codebooks[j] = km.cluster_centers_
+    return codebooks
+
+
+def encode_pq(codebooks, vectors):
+    m, ksub, dsub = codebooks.shape
+    vectors = vectors.reshape(len(vectors), m, 1, dsub)
+    return ((vectors - codebooks[None]) ** 2).sum(axis=3).argmin(axis=2).astype('uint8')
+
+
+def evaluate(index, matrix, nprobes, k, sim_func, n_queries=200, seed=0):
+    """ Reports recall@k against exact search and per-query latency for each nprobe """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False)
+    queries = _raw_vectors(matrix, rows)
+    queries += rng.normal(scale=queries.std() * 0.05, size=queries.shape).astype('float32')
+
+    exact = matrix.search(queries, k, sim_func)
+    report = []
+    for nprobe in nprobes:
+        latencies = []
+        hits = 0
+        for q, truth in zip(queries, exact):
+            t0 = time.perf_counter()
+            approx = index.search(q[None, :], k, sim_func, nprobe)[0]
+            latencies.append((time.perf_counter() - t0) * 1000)
+            hits += len({key for _, key in approx} & {key for _, key in truth})
+        report.append({'nprobe': nprobe,
+                       'recall': hits / max(1, sum(len(t) for t in exact)),
+                       'p50_ms': float(np.percentile(latencies, 50)),
+                       'p99_ms': float(np.percentile(latencies, 99))})
+    return report
+
+
+def main(argv=None):
+    root = config.root_dir
+    parser = argparse.ArgumentParser(description='Builds or evaluates the IVF search index.')
+    parser.add_argument('command', choices=['build', 'evaluate'])
+    parser.add_argument('--features', default=os.path.join(root, config.features_path))
+    parser.add_argument('--kmeans', default=os.path.join(root, config.kmeans_path))
+    parser.add_argument('--index', default=os.path.join(root, config.ivf_index_path))
+    parser.add_argument('--pq', type=int, default=0, help='PQ subspaces; 0 stores no codes')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--sim-func', default='cosine')
+    args = parser.parse_args(argv)
+
+    matrix = utils.as_feature_matrix(utils.load_pickle(args.features))
+
+    if args.command == 'build':
+        t0 = time.perf_counter()
+        index = IVFIndex.build(utils.load_pickle(args.kmeans), matrix, pq_subspaces=args.pq)
+        index.save(args.index)
+        print(f'Indexed {len(index.keys)} vectors in {len(index.centroids)} lists '
+              f'({time.perf_counter() - t0:.1f}s) -> {args.index}')
+    else:
+        index = IVFIndex.load(args.index).bind(matrix)
+        for row in evaluate(index, matrix, args.nprobe, args.k, args.sim_func):
+            print(f"nprobe={row['nprobe']:<4} recall@{args.k}={row['recall']:.3f} "
+                  f"p50={row['p50_ms']:.2f}ms p99={row['p99_ms']:.2f}ms")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
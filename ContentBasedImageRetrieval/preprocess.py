@@ -0,0 +1,122 @@
+""" Fast path for utils.standardize(utils.load_image(query, input_shape)).
+
+JPEGs much larger than the target are decoded at 1/2, 1/4 or 1/8 scale by the JPEG decoder itself
+(cv2.IMREAD_REDUCED_COLOR_*), the scale being picked from the SOF header before decoding.
+The letterbox geometry is computed from the full-size dimensions exactly as utils.resize does,
+only the small resized image is converted to RGB, the min/max standardization is written straight
+into a preallocated float32 buffer in two in-place passes, and the padding is left at 0,
+which is what standardize maps the padding to (its min is 0 whenever there is padding).
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+_POOL = None
+
+
+def jpeg_size(data):
+    """ Returns (height, width) from the SOF segment of JPEG bytes, or None for anything else """
+    data = memoryview(data)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # no length field
+            i += 2
+            continue
+        if marker in (0xD9, 0xDA):  # end of image, or scan data before any SOF
+            return None
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker in SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            return (data[i + 5] << 8) | data[i + 6], (data[i + 7] << 8) | data[i + 8]
+        i += 2 + length
+    return None
+
+
+def letterbox_geometry(height, width, shape):
+    """ Returns (resized height, resized width, top, left) of an image letterboxed by utils.resize """
+    if height > width:
+        resized = shape[0], int(shape[1] * (width / height))
+    else:
+        resized = int(shape[0] * (height / width)), shape[1]
+    return resized[0], resized[1], (shape[0] - resized[0]) // 2, (shape[1] - resized[1]) // 2
+
+
+def decode(data, shape, min_oversample=2):
+    """ Returns (BGR uint8 image, full-size height, width). The image is decoded at the smallest
+    JPEG scale that stays 'min_oversample' times larger than its letterboxed size. """
+    buffer = np.frombuffer(data, np.uint8)
+    size = jpeg_size(data)
+    if size is not None and size[0] and size[1]:
+        height, width = size
+        resized_h, resized_w, _, _ = letterbox_geometry(height, width, shape)
+        for factor, flag in REDUCED_FLAGS:
+            reduced = -(-height // factor), -(-width // factor)
+            if reduced[0] < min_oversample * resized_h or reduced[1] < min_oversample * resized_w:
+                continue
+            image = cv2.imdecode(buffer, flag)
+            if image is None:
+                break
+            if image.shape[:2] == reduced:
+                return image, height, width
+            if image.shape[:2] == reduced[::-1]:  # rotated by the EXIF orientation
+                return image, width, height
+            return image, image.shape[0], image.shape[1]
+
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
+    return image, image.shape[0], image.shape[1]
+
+
+def preprocess_into(data, shape, out):
+    """ Writes the standardized, letterboxed RGB image of encoded 'data' into the float32 'out' (h, w, 3) """
+    image, height, width = decode(data, shape)
+    resized_h, resized_w, top, left = letterbox_geometry(height, width, shape)
+    resized = cv2.resize(image, (resized_w, resized_h))
+
+    lo, hi = int(resized.min()), int(resized.max())
+    if resized_h < shape[0] or resized_w < shape[1]:
+        lo = 0  # the zero padding takes part in the min
+        out[:top] = 0
+        out[top + resized_h:] = 0
+        out[top:top + resized_h, :left] = 0
+        out[top:top + resized_h, left + resized_w:] = 0
+
+    region = out[top:top + resized_h, left:left + resized_w]
+    np.subtract(cv2.cvtColor(resized, cv2.COLOR_BGR2RGB), lo, out=region, dtype='float32')
+    with np.errstate(divide='ignore', invalid='ignore'):  # a flat image gives nan, as standardize does
+        np.divide(region, hi - lo, out=region)
+    return out
+
+
+def preprocess(data, shape):
+    """ Returns the standardized, letterboxed RGB float32 image (shape[0], shape[1], 3) """
+    return preprocess_into(data, shape, np.empty((shape[0], shape[1], 3), dtype='float32'))
+
+
+def preprocess_batch(queries, shape, out=None):
+    """ Fills out[:len(queries)] (a float32 (N, h, w, 3) buffer, allocated if None) on a thread pool """
+    if out is None:
+        out = np.empty((len(queries), shape[0], shape[1], 3), dtype='float32')
+    list(_pool().map(lambda i: preprocess_into(queries[i], shape, out[i]), range(len(queries))))
+    return out
+
+
+def _pool():
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor(thread_name_prefix='preprocess')  # cv2 and numpy release the GIL
+    return _POOL
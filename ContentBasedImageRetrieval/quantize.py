@@ -0,0 +1,170 @@
+""" Compact int8 storage of the corpus vectors.
+
+Each unit row is stored as int8 codes with one float32 scale per vector (or per dimension), a quarter
+of the float32 matrix and a fraction of the pickled {key: float16 ndarray} dict. Scoring upcasts one
+block of codes at a time to float32 for the matrix product and applies the scales to the products.
+With an exact matrix attached, the top max_results * rerank candidates are re-scored in full precision.
+
+    python quantize.py build [--per vector|dimension]        # features_path / feature_store_path -> quantized_path
+    python quantize.py evaluate [--rerank 0 4] [--k 5]       # memory and recall@k against the exact scan
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import config
+import feature_store
+import utils
+
+
+class QuantizedMatrix(utils.FeatureMatrix):
+    """ FeatureMatrix of int8 codes: unit row i ~= codes[i] * scales[i] ('vector'),
+    or codes[i] * scales ('dimension'). 'exact' is the full precision matrix used to rerank. """
+
+    block_rows = 16384  # int8 rows upcast per matrix product
+
+    def __init__(self, keys, codes, scales, norms, per='vector', exact=None, rerank=4):
+        super().__init__(keys, None, norms)
+        self.codes = codes
+        self.scales = scales
+        self.per = per
+        self.exact = exact
+        self.rerank = rerank
+
+    @classmethod
+    def quantize(cls, features, per='vector', exact=None, rerank=4):
+        """ Quantizes a FeatureMatrix (or {key: vector} dict) block by block """
+        matrix = utils.as_feature_matrix(features)
+        n, dim = len(matrix), matrix.dim
+        codes = np.empty((n, dim), dtype='int8')
+        if per == 'vector':
+            scales = np.empty(n, dtype='float32')
+        else:
+            scales = np.zeros(dim, dtype='float32')
+            for start in range(0, n, cls.block_rows):
+                block = np.abs(matrix.vectors[start:start + cls.block_rows].astype('float32'))
+                scales = np.maximum(scales, block.max(axis=0))
+            scales /= 127
+
+        for start in range(0, n, cls.block_rows):
+            block = matrix.vectors[start:start + cls.block_rows].astype('float32')
+            if per == 'vector':
+                block_scales = np.abs(block).max(axis=1) / 127
+                scales[start:start + len(block)] = block_scales
+                block /= np.where(block_scales > 0, block_scales, 1)[:, None]
+            else:
+                block /= np.where(scales > 0, scales, 1)[None, :]
+            codes[start:start + len(block)] = np.clip(np.rint(block), -127, 127)
+        return cls(matrix.keys, codes, scales, matrix.norms.astype('float32'), per, exact, rerank)
+
+    @classmethod
+    def load(cls, path, exact=None, rerank=4):
+        data = np.load(path, allow_pickle=True)
+        return cls(data['keys'], data['codes'], data['scales'], data['norms'], str(data['per']), exact, rerank)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, keys=self.keys, codes=self.codes, scales=self.scales, norms=self.norms, per=self.per)
+
+    @property
+    def dim(self):
+        return self.codes.shape[1]
+
+    def cosines(self, q_unit, selection):
+        codes = self.codes[selection].astype('float32')
+        if self.per == 'dimension':
+            return (q_unit * self.scales[None, :]) @ codes.T
+        return (q_unit @ codes.T) * self.scales[selection][None, :]
+
+    def search(self, query_features, max_results, sim_func, restrict=None):
+        """ FeatureMatrix.search on the codes, re-scoring max_results * rerank candidates with 'exact' """
+        if self.exact is None or not self.rerank:
+            return super().search(query_features, max_results, sim_func, restrict)
+
+        candidates = super().search(query_features, max_results * self.rerank, sim_func, restrict)
+        results = []
+        for q, found in zip(query_features, candidates):
+            rows = self.exact.lookup([key for _, key in found])
+            rows = np.sort(rows[rows >= 0])
+            d = self.exact.distances(q[None, :], sim_func, rows)
+            results.append(self.exact.top_k(d, max_results, rows)[0])
+        return results
+
+    def memory_bytes(self):
+        """ Bytes held by the codes, scales, norms and keys """
+        return self.codes.nbytes + self.scales.nbytes + self.norms.nbytes + keys_bytes(self.keys)
+
+
+def keys_bytes(keys):
+    return keys.nbytes + sum(sys.getsizeof(k) for k in keys.tolist())
+
+
+def dict_bytes(features):
+    """ Bytes held by a {key: ndarray} dict: the dict, the keys and one ndarray object per vector """
+    return sys.getsizeof(features) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in features.items())
+
+
+def evaluate(quantized, matrix, k, sim_func, reranks=(0, 4), n_queries=200, seed=0):
+    """ Returns [{'rerank', 'recall', 'ms_per_query'}] of 'quantized' against the exact scan of 'matrix',
+    on corpus vectors used as queries """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False)
+    queries = (matrix.vectors[rows].astype('float32') * matrix.norms[rows, None]).astype('float16')
+    exact = matrix.search(queries, k, sim_func)
+
+    report = []
+    for rerank in reranks:
+        quantized.rerank = rerank
+        t0 = time.perf_counter()
+        found = quantized.search(queries, k, sim_func)
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        hits = sum(len({key for _, key in f} & {key for _, key in e}) for f, e in zip(found, exact))
+        report.append({'rerank': rerank, 'recall': hits / max(1, sum(len(e) for e in exact)), 'ms_per_query': ms})
+    return report
+
+
+def load_exact(root):
+    """ The feature store if present (memory-mapped), else the pickled features """
+    store_path = os.path.join(root, config.feature_store_path)
+    if os.path.exists(store_path):
+        return feature_store.FeatureStore.open(store_path), None
+    features = utils.load_pickle(os.path.join(root, config.features_path))
+    return utils.FeatureMatrix.from_dict(features), features
+
+
+def main(argv=None):
+    root = config.root_dir
+    parser = argparse.ArgumentParser(description='Builds or evaluates the int8 quantized features.')
+    parser.add_argument('command', choices=['build', 'evaluate'])
+    parser.add_argument('--per', choices=['vector', 'dimension'], default='vector')
+    parser.add_argument('--rerank', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--sim-func', default='cosine')
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    matrix, features = load_exact(root)
+    quantized_path = os.path.join(root, config.quantized_path)
+    if args.command == 'build':
+        QuantizedMatrix.quantize(matrix, args.per).save(quantized_path)
+        print(f'Saved {len(matrix)} quantized vectors to {quantized_path}')
+        return
+
+    quantized = QuantizedMatrix.load(quantized_path, exact=matrix)
+    exact_bytes = matrix.vectors.nbytes + matrix.norms.nbytes + keys_bytes(matrix.keys)
+    print(f'quantized {quantized.memory_bytes() / 2 ** 20:.1f} MiB, '
+          f'{matrix.vectors.dtype} matrix {exact_bytes / 2 ** 20:.1f} MiB'
+          + (f', pickled dict {dict_bytes(features) / 2 ** 20:.1f} MiB' if features is not None else ''))
+    for row in evaluate(quantized, matrix, args.k, args.sim_func, args.rerank, args.queries):
+        print(f"rerank={row['rerank']:<3} recall@{args.k}={row['recall']:.3f} {row['ms_per_query']:.2f} ms/query")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -0,0 +1,295 @@
+""" Resident image search service. The encoder, KMeans model, clusters and features are loaded once
+and concurrent queries are micro-batched into shared encoder forward passes.
+
+    python server.py [--host 127.0.0.1] [--port 8080] [--unix-socket /tmp/image_search.sock] [--stub-encoder]
+
+POST /search?max_results=5&sim_func=cosine with the raw image bytes as the request body.
+GET /health returns 200 once the models are loaded. GET /stats returns the query cache hit/miss counters.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+import cache
+import config
+import feature_store
+import image_fetcher
+import ingest
+import ivf_index
+import quantize
+import sharded
+import utils
+
+
+class MicroBatcher:
+    """ Collects queries arriving within 'max_wait' seconds (up to 'max_batch' images)
+    and encodes them with one get_features_batch call """
+
+    def __init__(self, encoder, input_shape, max_batch=32, max_wait=0.005):
+        self.encoder = encoder
+        self.input_shape = input_shape
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+
+    async def encode(self, image):
+        """ Returns the (1024,) float16 vector of 'image' """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((image, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._encode_batch(batch))
+
+    async def _encode_batch(self, batch):
+        images = [image for image, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            vectors = await loop.run_in_executor(None, utils.get_features_batch, images, self.encoder,
+                                                 self.input_shape, self.max_batch)
+        except Exception as e:
+            if len(batch) > 1:  # one bad upload must not fail the others: retry them one at a time
+                for item in batch:
+                    await self._encode_batch([item])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for vector, (_, future) in zip(vectors, batch):
+            if not future.done():
+                future.set_result(vector)
+
+
+class SearchService:
+    """ Serves utils.search_features + utils.display_results over HTTP on a warm model and index.
+    Without 'db_cred' the ranked keys and scores are returned instead of the metadata. """
+
+    def __init__(self, encoder, features, input_shape, kmeans=None, kclusters=None, index=None, nprobe=8,
+                 db_cred=None, fetcher=None, max_batch=32, max_wait=0.005, store=None, cache=None):
+        self.features = utils.as_feature_matrix(features)
+        self.store = store  # ingest.SegmentedStore; each search runs on its current snapshot
+        self.kmeans = kmeans
+        self.kclusters = kclusters
+        self.index = index
+        self.nprobe = nprobe
+        self.db_cred = db_cred
+        self.fetcher = fetcher
+        self.cache = cache  # cache.SearchCache
+        self.batcher = MicroBatcher(encoder, input_shape, max_batch, max_wait)
+
+    async def search(self, image, max_results=5, sim_func='cosine'):
+        """ Yields the search result JSON for one image in pieces, as the result images arrive """
+        vector = None if self.cache is None else self.cache.get_vector(image)
+        if vector is None:
+            vector = await self.batcher.encode(image)
+            if self.cache is not None:
+                self.cache.put_vector(image, vector)
+        loop = asyncio.get_running_loop()
+        features, kclusters = self.features, self.kclusters
+        if self.store is not None:
+            features = self.store.snapshot()
+            kclusters = features.kclusters
+        results = await loop.run_in_executor(None, lambda: utils.search_features(
+            vector[None, :], features, max_results, sim_func,
+            kmeans=self.kmeans, kclusters=kclusters, index=self.index, nprobe=self.nprobe, cache=self.cache))
+
+        if self.db_cred is None:
+            yield json.dumps({'searchresult': [{'similarImages': [{'MediaNumber': key, 'Score': score}
+                                                                  for score, key in results[0]]}]})
+            return
+        async for chunk in iter_in_executor(utils.iter_results_json([image], results, self.db_cred,
+                                                                    self.fetcher)):
+            yield chunk
+
+    async def handle(self, reader, writer):
+        streaming = False
+        try:
+            method, target, body = await read_request(reader)
+            url = urlsplit(target)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+            if method == 'GET' and url.path == '/health':
+                write_response(writer, 200, b'{"status": "ok"}')
+            elif method == 'GET' and url.path == '/stats':
+                write_response(writer, 200, json.dumps(self.cache.stats() if self.cache else {}).encode('utf8'))
+            elif method == 'POST' and url.path == '/search' and body:
+                chunks = self.search(body, int(params.get('max_results', 5)), params.get('sim_func', 'cosine'))
+                first = await chunks.__anext__()  # errors before any output still get a 500
+                streaming = True
+                await write_chunked(writer, first, chunks)
+            elif method == 'POST' and url.path == '/search':
+                write_response(writer, 400, b'{"error": "empty image"}')
+            else:
+                write_response(writer, 404, b'{"error": "not found"}')
+        except Exception as e:
+            if not streaming:  # a broken stream is left unterminated
+                write_response(writer, 500, json.dumps({'error': str(e)}).encode('utf8'))
+
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080, unix_socket=None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+async def read_request(reader):
+    """ Returns (method, target, body) of one HTTP/1.1 request """
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    if not request_line:
+        raise ValueError('empty request')
+    method, target, _ = request_line.split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, target, body
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def write_response(writer, status, body):
+    writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                 f'Content-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n'
+                 f'Connection: close\r\n\r\n'.encode('latin-1'))
+    writer.write(body)
+
+
+async def write_chunked(writer, first, chunks):
+    """ Writes a 200 response with chunked transfer encoding, draining after every piece """
+    writer.write(b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: application/json\r\n'
+                 b'Transfer-Encoding: chunked\r\n'
+                 b'Connection: close\r\n\r\n')
+    pending = [first]
+    async for chunk in chunks:
+        pending.append(chunk)
+        if len(chunk) > 1024:  # separators and brackets ride along with the next image
+            await _write_chunk(writer, ''.join(pending))
+            pending = []
+    if pending:
+        await _write_chunk(writer, ''.join(pending))
+    writer.write(b'0\r\n\r\n')
+
+
+async def _write_chunk(writer, text):
+    data = text.encode('utf8')
+    writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+    await writer.drain()
+
+
+async def iter_in_executor(iterator):
+    """ Drives a blocking iterator on the default executor """
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def load_service(stub_encoder=False, max_batch=32, max_wait=0.005):
+    """ Loads the models, clusters and features named in config """
+    root_dir = config.root_dir
+    feature_store_path = os.path.join(root_dir, config.feature_store_path)
+    ingest_store_path = os.path.join(root_dir, config.ingest_store_path)
+    quantized_path = os.path.join(root_dir, config.quantized_path)
+    ivf_index_path = os.path.join(root_dir, config.ivf_index_path)
+    kcluster_path = os.path.join(root_dir, config.kcluster_path)
+    kclusters = utils.load_pickle(kcluster_path)
+
+    store = None
+    if os.path.exists(os.path.join(ingest_store_path, ingest.MANIFEST)):
+        store = ingest.SegmentedStore(ingest_store_path, kclusters)
+        features = store.snapshot()
+    elif os.path.exists(feature_store_path):
+        if config.search_shards and not os.path.exists(quantized_path):
+            features = sharded.ShardedStore.open(feature_store_path).start(config.search_shards, kclusters,
+                                                                           kcluster_path)
+        else:
+            features = feature_store.FeatureStore.open(feature_store_path)
+        if os.path.exists(quantized_path):  # int8 scan, reranked against the memory-mapped store
+            features = quantize.QuantizedMatrix.load(quantized_path, exact=features)
+    else:
+        features = utils.FeatureMatrix.from_dict(utils.load_pickle(os.path.join(root_dir, config.features_path)))
+
+    if stub_encoder:
+        encoder = utils.StubEncoder(config.input_shape, dim=features.dim)
+    else:
+        encoder = utils.load_model(os.path.join(root_dir, config.encoder_path), compiled=True)
+
+    index = None
+    if os.path.exists(ivf_index_path):
+        index = ivf_index.IVFIndex.load(ivf_index_path).bind(features)
+
+    return SearchService(encoder=encoder,
+                         features=features,
+                         input_shape=config.input_shape,
+                         kmeans=utils.load_pickle(os.path.join(root_dir, config.kmeans_path)),
+                         kclusters=kclusters,
+                         index=index,
+                         nprobe=config.nprobe,
+                         db_cred=config.db_cred,
+                         fetcher=image_fetcher.ImageFetcher(
+                             max_workers=config.fetch_workers,
+                             cache=image_fetcher.ImageCache(config.image_cache_bytes, config.image_cache_dir,
+                                                            config.image_cache_disk_bytes),
+                             thumbnail_size=config.thumbnail_size),
+                         max_batch=max_batch,
+                         max_wait=max_wait,
+                         store=store,
+                         cache=cache.SearchCache(config.feature_cache_bytes, config.result_cache_bytes,
+                                                 config.cache_ttl))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the image search service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--max-batch', type=int, default=config.batch_size)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--stub-encoder', action='store_true', help='random projection instead of the Keras encoder')
+    args = parser.parse_args(argv)
+
+    service = load_service(args.stub_encoder, args.max_batch, args.max_wait_ms / 1000)
+    print(f'Serving on {args.unix_socket or f"http://{args.host}:{args.port}"}')
+    asyncio.run(service.serve(args.host, args.port, args.unix_socket))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -0,0 +1,150 @@
+""" Multi-process search over a feature store.
+
+The store's rows are split into contiguous shards, each owned by one worker process that
+memory-maps the store and keeps a FeatureMatrix view of its rows. A query batch is sent to every
+shard, each returns its local top max_results and the parent merges the sorted lists with a heap.
+Local lists are ordered exactly as FeatureMatrix.top_k orders them, so the merge equals the
+single-process search.
+
+    python sharded.py [--shards 4] [--queries 200] [--k 5]    # checks and times against FeatureStore.search
+"""
+import argparse
+import heapq
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+import config
+import feature_store
+import utils
+
+_SHARD = None
+_KCLUSTERS = None
+
+
+class ShardedStore(feature_store.FeatureStore):
+    """ FeatureStore whose search() fans out over worker processes once start() is called.
+    Everything else (lookups, IVF reranking) still runs in the calling process. """
+
+    def __init__(self, path, keys, vectors, norms, header):
+        super().__init__(path, keys, vectors, norms, header)
+        self.bounds = None
+        self._pools = []
+        self._cluster_ids = {}
+
+    def start(self, shards=None, kclusters=None, kcluster_path=None):
+        """ Starts one process per shard. With the kclusters dict and the pickle it was loaded from,
+        restrict lists that are kclusters values are sent to the workers as cluster ids. """
+        self.close()
+        shards = max(1, min(shards or os.cpu_count(), len(self) or 1))
+        self.bounds = np.linspace(0, len(self), shards + 1).astype('int64')
+        if kclusters is not None and kcluster_path is not None:
+            self._cluster_ids = {id(keys): c for c, keys in kclusters.items()}
+
+        # fork where available: the parent may be a script without a __main__ guard
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        threads = max(1, (os.cpu_count() or 1) // shards)
+        for start, stop in zip(self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+            pool = ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_open_shard,
+                                       initargs=(self.path, start, stop, kcluster_path, threads))
+            self._pools.append(pool)
+        return self
+
+    def close(self):
+        for pool in self._pools:
+            pool.shutdown(cancel_futures=True)
+        self._pools = []
+
+    def search(self, query_features, max_results, sim_func, restrict=None):
+        if not self._pools:
+            return super().search(query_features, max_results, sim_func, restrict)
+
+        query = np.asarray(query_features)
+        groups = None
+        if restrict is not None:
+            # one entry per distinct key list: a cluster id the workers resolve, or the keys themselves
+            groups = {}
+            for i, keys in enumerate(restrict):
+                spec = ('cluster', self._cluster_ids[id(keys)]) if id(keys) in self._cluster_ids else ('keys', keys)
+                groups.setdefault(id(keys), (spec, []))[1].append(i)
+            groups = list(groups.values())
+
+        futures = [pool.submit(_search_shard, query, max_results, sim_func, groups) for pool in self._pools]
+        return merge([f.result() for f in futures], max_results)
+
+
+def merge(shard_results, max_results):
+    """ Merges per-shard [[(score, key)] per query] lists, each sorted, into the global top 'max_results' """
+    return [list(islice(heapq.merge(*lists), max_results)) for lists in zip(*shard_results)]
+
+
+def _open_shard(path, start, stop, kcluster_path, threads):
+    global _SHARD, _KCLUSTERS
+    if threadpool_limits is not None:  # the shards share the cores instead of each running a full BLAS pool
+        threadpool_limits(threads)
+    store = feature_store.FeatureStore.open(path)
+    _SHARD = utils.FeatureMatrix(store.keys[start:stop], store.vectors[start:stop], store.norms[start:stop])
+    if kcluster_path is not None:
+        _KCLUSTERS = utils.load_pickle(kcluster_path)
+
+
+def _search_shard(query_features, max_results, sim_func, groups):
+    restrict = None
+    if groups is not None:
+        restrict = [None] * len(query_features)
+        for (kind, value), members in groups:
+            keys = _KCLUSTERS[value] if kind == 'cluster' else value
+            for i in members:
+                restrict[i] = keys
+    return _SHARD.search(query_features, max_results, sim_func, restrict)
+
+
+def main(argv=None):
+    root = config.root_dir
+    parser = argparse.ArgumentParser(description='Checks and times the sharded search against the in-process search.')
+    parser.add_argument('--store', default=os.path.join(root, config.feature_store_path))
+    parser.add_argument('--shards', type=int, default=None, help='worker processes; defaults to the CPU count')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=32, help='queries per fan-out')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--sim-func', default='cosine')
+    args = parser.parse_args(argv)
+
+    store = ShardedStore.open(args.store)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(store), min(args.queries, len(store)), replace=False)
+    queries = (store.vectors[rows].astype('float32') * store.norms[rows, None]).astype('float16')
+
+    t0 = time.perf_counter()
+    single = [r for s in range(0, len(queries), args.batch)
+              for r in store.search(queries[s:s + args.batch], args.k, args.sim_func)]
+    single_s = time.perf_counter() - t0
+
+    store.start(args.shards)
+    store.search(queries[:1], args.k, args.sim_func)  # workers open their shards
+    t0 = time.perf_counter()
+    sharded = [r for s in range(0, len(queries), args.batch)
+               for r in store.search(queries[s:s + args.batch], args.k, args.sim_func)]
+    sharded_s = time.perf_counter() - t0
+    store.close()
+
+    print(f'{len(store.bounds) - 1} shards: {len(queries) / sharded_s:.1f} qps, '
+          f'in-process: {len(queries) / single_s:.1f} qps, identical results: {sharded == single}')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -6,44 +6,258 @@ import pickle
 import psycopg2
 import base64
 import json
-import sys
 import requests
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import image_fetcher
+import preprocess
 
 
 class PGdB:
+    """ Thread-safe pool of connections to the metadata database.
+    Idle connections are health-checked before reuse and broken ones are replaced. """
 
-    def __init__(self, db_cred):
+    select_sql = 'SELECT * FROM metadata WHERE MediaNumber = ANY($1)'
+    retry_errors = (psycopg2.InterfaceError, psycopg2.OperationalError, psycopg2.InternalError)
+
+    def __init__(self, db_cred, minconn=1, maxconn=8, check_after=30.0, connect=None):
         self.hostName = db_cred['hostName']
         self.dbName = db_cred['dbName']
         self.userName = db_cred['userName']
         self.password = db_cred['password']
-        self.conn = psycopg2.connect(host=self.hostName,
-                                     database=self.dbName,
-                                     user=self.userName,
-                                     password=self.password)
-        self.cur = self.conn.cursor()
-
-    def reconnect(self):
-        self.conn = psycopg2.connect(host=self.hostName,
-                                     database=self.dbName,
-                                     user=self.userName,
-                                     password=self.password)
-        self.cur = self.conn.cursor()
+        self.check_after = check_after  # idle seconds after which a connection is pinged before reuse
+        self._connect = connect or self._psycopg2_connect
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = queue.LifoQueue()
+        self._prepared = set()
+        for _ in range(minconn):
+            self._idle.put((self._connect(), time.monotonic()))
+
+    def _psycopg2_connect(self):
+        return psycopg2.connect(host=self.hostName,
+                                database=self.dbName,
+                                user=self.userName,
+                                password=self.password)
+
+    @contextmanager
+    def connection(self):
+        """ Borrows a healthy connection; it is discarded instead of returned if the block raises """
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+                conn.rollback()  # ends the read transaction before the connection goes idle
+            except Exception:
+                self._discard(conn)
+                raise
+            self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if conn.closed:
+                self._discard(conn)
+            elif time.monotonic() - last_used < self.check_after or self._ping(conn):
+                return conn
+
+    def _ping(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except self.retry_errors:
+            self._discard(conn)
+            return False
+
+    def _discard(self, conn):
+        self._prepared.discard(id(conn))
+        try:
+            conn.close()
+        except Exception:
+            pass
 
     def select_rows(self, keys):
-        keys = tuple(keys)
-        sql = f"SELECT * FROM metadata WHERE MediaNumber in {keys}"
+        return list(self.select_rows_by_key(keys).values())
+
+    def select_rows_by_key(self, keys):
+        """ Returns {MediaNumber: row} for 'keys' in one round-trip through a prepared statement.
+        The lookup is retried once on a fresh connection if the connection broke. """
+        keys = list(dict.fromkeys(keys))
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    with conn.cursor() as cur:
+                        if id(conn) not in self._prepared:
+                            cur.execute(f'PREPARE select_metadata AS {self.select_sql}')
+                            self._prepared.add(id(conn))
+                        cur.execute('EXECUTE select_metadata (%s)', (keys,))
+                        rows = cur.fetchall()
+                return {r[0]: r for r in rows}
+            except self.retry_errors:
+                if attempt:
+                    raise
 
-        self.cur.execute(sql)
-        rows = self.cur.fetchall()
-        return rows
+    def reconnect(self):
+        """ Drops all idle connections; new ones are opened on demand """
+        self.close_connection()
 
     def close_connection(self):
-        try:
-            self.conn.close()
-            self.cur.close()
-        except Exception as e:
-            pass
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+def get_db(db_cred):
+    """ Returns the shared PGdB pool for 'db_cred' """
+    key = tuple(sorted(db_cred.items()))
+    with _DB_LOCK:
+        if key not in _DB_POOLS:
+            _DB_POOLS[key] = PGdB(db_cred)
+        return _DB_POOLS[key]
+
+
+class RankedRows:
+    """ Top-k ranking shared by FeatureMatrix and views over several matrices (ingest.Snapshot).
+    Subclasses provide __len__, dim, keys_at, lookup and distances. """
+
+    block_rows = 65536  # rows scored per matrix product; bounds float32 temporaries
+
+    def rows_for(self, keys):
+        """ Returns the sorted, unique row numbers of 'keys' present in the matrix """
+        rows = self.lookup(keys)
+        return np.unique(rows[rows >= 0])
+
+    def top_k(self, distances, max_results, rows=None):
+        """ Returns the 'max_results' smallest (score, key) pairs of each row of 'distances',
+        ordered as sorted() orders the tuples """
+        results = []
+        for d in distances:
+            k = min(max_results, len(d))
+            if k <= 0:
+                results.append([])
+                continue
+            if k < len(d):
+                kth = d[np.argpartition(d, k - 1)[:k]].max()
+                candidates = np.flatnonzero(d <= kth)  # keeps ties at the boundary
+            else:
+                candidates = np.arange(len(d))
+            candidates = candidates[np.isfinite(d[candidates])]  # deleted rows score inf
+            keys = self.keys_at(candidates if rows is None else rows[candidates])
+            results.append(sorted(zip(d[candidates].tolist(), keys))[:k])
+        return results
+
+    def search(self, query_features, max_results, sim_func, restrict=None):
+        """ Ranks all rows for each query, or only the rows of restrict[i] keys for query i """
+        if restrict is None:
+            return self.top_k(self.distances(query_features, sim_func), max_results)
+
+        # queries sharing a key list (same cluster / category) are scored together
+        groups = {}
+        for i, keys in enumerate(restrict):
+            groups.setdefault(id(keys), (keys, []))[1].append(i)
+
+        results = [None] * len(restrict)
+        for keys, members in groups.values():
+            rows = self.rows_for(keys)
+            d = self.distances(query_features[members], sim_func, rows)
+            for i, r in zip(members, self.top_k(d, max_results, rows)):
+                results[i] = r
+        return results
+
+
+class FeatureMatrix(RankedRows):
+    """ Image vectors packed into one contiguous matrix of unit rows, with a parallel key array.
+    Cosine and euclidean scores for a batch of queries are a single matrix product. """
+
+    def __init__(self, keys, vectors, norms):
+        self.keys = keys
+        self.vectors = vectors
+        self.norms = norms
+        self._index = None
+
+    @classmethod
+    def from_dict(cls, features, dtype='float32'):
+        keys = np.empty(len(features), dtype=object)
+        keys[:] = list(features.keys())
+        dim = np.asarray(features[keys[0]]).size if len(keys) else 0
+        vectors = np.empty((len(keys), dim), dtype=dtype)
+        norms = np.empty(len(keys), dtype='float32')
+
+        for start in range(0, len(keys), cls.block_rows):
+            block_keys = keys[start:start + cls.block_rows]
+            block, block_norms = normalize_rows([features[k] for k in block_keys])
+            vectors[start:start + len(block_keys)] = block
+            norms[start:start + len(block_keys)] = block_norms
+        return cls(keys, vectors, norms)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def keys_at(self, rows):
+        """ Returns the keys of 'rows' as a list """
+        return self.keys[rows].tolist()
+
+    def lookup(self, keys):
+        """ Returns the row number of each key in 'keys', -1 where a key is absent """
+        if self._index is None:
+            self._index = {k: i for i, k in enumerate(self.keys.tolist())}
+        return np.fromiter((self._index.get(k, -1) for k in keys), dtype='int64')
+
+    def distances(self, query_features, sim_func, rows=None):
+        """ Returns (n_queries, n_rows) cosine distances or euclidean distances """
+        query = np.asarray(query_features, dtype='float32').reshape(len(query_features), -1)
+        q_norms = np.linalg.norm(query, axis=1)
+        q_unit = query / np.where(q_norms > 0, q_norms, 1)[:, None]
+
+        n = len(self) if rows is None else len(rows)
+        out = np.empty((len(query), n), dtype='float32')
+        for start in range(0, n, self.block_rows):
+            stop = min(start + self.block_rows, n)
+            selection = slice(start, stop) if rows is None else rows[start:stop]
+            norms = self.norms[selection]
+            cos = self.cosines(q_unit, selection)
+
+            if sim_func == 'cosine':
+                out[:, start:stop] = 1 - cos
+            else:
+                # |q - x|^2 = |q|^2 + |x|^2 - 2|q||x|cos
+                sq = q_norms[:, None] ** 2 + norms[None, :] ** 2 - 2 * q_norms[:, None] * norms[None, :] * cos
+                out[:, start:stop] = np.sqrt(np.maximum(sq, 0))
+        return out
+
+    def cosines(self, q_unit, selection):
+        """ Returns (n_queries, n_selected) cosines between unit queries and the rows in 'selection' """
+        return q_unit @ self.vectors[selection].astype('float32', copy=False).T
+
+
+def normalize_rows(vectors):
+    """ Returns (unit rows, norms) of a sequence of vectors, as float32 """
+    block = np.stack([np.asarray(v, dtype='float32').reshape(-1) for v in vectors])
+    norms = np.linalg.norm(block, axis=1)
+    block /= np.where(norms > 0, norms, 1)[:, None]
+    return block, norms
+
+
+_PACKED = {}
+_DB_POOLS = {}
+_DB_LOCK = threading.Lock()
+_FETCHER = None
 
 
 def load_pkl_from_bytes(b):
@@ -66,8 +280,24 @@ def cosine_similarity(query, x):
     return spatial.distance.cosine(query, x)
 
 
-def load_model(path):
-    return tf.keras.models.load_model(path, compile=False)
+class StubEncoder:
+    """ Deterministic stand-in for the Keras encoder: a fixed random projection of a coarse pixel grid.
+    Lets the search path run without TensorFlow weights """
+
+    def __init__(self, input_shape, dim=1024, grid=16, seed=0):
+        self.step = max(1, input_shape[0] // grid), max(1, input_shape[1] // grid)
+        n_pixels = len(range(0, input_shape[0], self.step[0])) * len(range(0, input_shape[1], self.step[1]))
+        rng = np.random.default_rng(seed)
+        self.projection = rng.standard_normal((n_pixels * input_shape[2], dim)).astype('float32')
+
+    def predict(self, batch):
+        pixels = np.asarray(batch, dtype='float32')[:, ::self.step[0], ::self.step[1]]
+        return pixels.reshape(len(pixels), -1) @ self.projection
+
+
+def load_model(path, compiled=False):
+    model = tf.keras.models.load_model(path, compile=False)
+    return CompiledEncoder(model) if compiled else model
 
 
 def load_image(query, shape=None, resize_image=True):
@@ -83,10 +313,42 @@ def load_image(query, shape=None, resize_image=True):
 
 def get_features(query, encoder, input_shape):
     """ Returns features : (1, 1024) """
-    image = standardize(load_image(query, input_shape))
-    image = np.expand_dims(image, axis=0)
-    image_features = np.stack(encoder.predict(image), axis=0).astype('float16')
-    return image_features.astype('float16')
+    return get_features_batch([query], encoder, input_shape)
+
+
+def get_features_batch(queries, encoder, input_shape, batch_size=32):
+    """ Returns features : (len(queries), 1024).
+    Each batch of 'batch_size' images is decoded and letterboxed concurrently into one reused
+    float32 buffer by preprocess.preprocess_batch, then encoded with one predict call """
+    queries = list(queries)
+    if not queries:
+        return np.empty((0, 0), dtype='float16')
+    buffer = np.empty((min(batch_size, len(queries)), input_shape[0], input_shape[1], 3), dtype='float32')
+    features = []
+    for start in range(0, len(queries), batch_size):
+        batch = preprocess.preprocess_batch(queries[start:start + batch_size], input_shape,
+                                            buffer[:len(queries) - start])
+        features.append(np.asarray(encoder.predict(batch)).reshape(len(batch), -1))
+    return np.concatenate(features).astype('float16')
+
+
+class CompiledEncoder:
+    """ Wraps a Keras encoder so predict() runs a traced tf.function instead of Model.predict,
+    which has a high fixed cost per call for small batches """
+
+    def __init__(self, model):
+        self.model = model
+        self._call = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+
+    def predict(self, batch):
+        return self._call(tf.convert_to_tensor(batch, dtype=tf.float32)).numpy()
+
+
+def _default_fetcher():
+    global _FETCHER
+    if _FETCHER is None:
+        _FETCHER = image_fetcher.ImageFetcher()
+    return _FETCHER
 
 
 def get_img_string(image_url):
@@ -94,44 +356,49 @@ def get_img_string(image_url):
     return base64.b64encode(img.content).decode('ascii')
 
 
-def display_results(query, results, db_cred):
-    search_result = {'searchresult': []}
-    DB = PGdB(db_cred)
+def display_results(query, results, db_cred, fetcher=None):
+    return ''.join(iter_results_json(query, results, db_cred, fetcher))
+
 
+def iter_results_json(query, results, db_cred, fetcher=None):
+    """ Yields the display_results JSON piece by piece, one similar image at a time, as each image
+    arrives. The joined pieces are byte-identical to json.dumps of the whole result. """
+    DB = get_db(db_cred)
+    fetcher = fetcher or _default_fetcher()
+
+    try:
+        rows_by_key = DB.select_rows_by_key(r[1] for query_results in results for r in query_results)
+    except Exception as e:
+        raise RuntimeError(f'Metadata query failed: {e}') from e
+    images = fetcher.submit_many(r[8] for r in rows_by_key.values())
+
+    yield '{"searchresult": ['
     for i in range(len(query)):
         result_keys = [r[1] for r in results[i]]
 
         q_string = base64.b64encode(query[i]).decode('ascii')
-
-        try:
-            rows = DB.select_rows(result_keys)
-        except psycopg2.InternalError:
-            DB.reconnect()
-            rows = DB.select_rows(result_keys)
-        except psycopg2.InterfaceError:
-            DB.reconnect()
-            rows = DB.select_rows(result_keys)
-        except Exception as e:
-            print(e)
-            sys.exit(-1)
-        sub_results = [''] * len(result_keys)
-        for r in rows:
-            img_string = get_img_string(r[8])
-            formatted_row = {'MediaNumber': r[0],
-                             'CollectionTitle': r[1],
-                             'WorfRef': r[2],
-                             'OriginalFilename': r[3],
-                             'FileName': r[4],
-                             'LegacyAssetId': r[5],
-                             'AssetLibraryId': r[6],
-                             'ClusterName': r[7],
-                             'ImageUrl': r[8],
-                             'ImageContent': img_string}
-
-            sub_results[result_keys.index(r[0])] = formatted_row
-        search_result['searchresult'].append({'searchImage': q_string, 'similarImages': sub_results})
-        DB.close_connection()
-    return json.dumps(search_result)
+        yield (', ' if i else '') + '{"searchImage": ' + json.dumps(q_string) + ', "similarImages": ['
+
+        for j, key in enumerate(result_keys):
+            r = rows_by_key.get(key)
+            formatted_row = '' if r is None else format_row(r, images[r[8]].result())
+            yield (', ' if j else '') + json.dumps(formatted_row)
+        yield ']}'
+    yield ']}'
+
+
+def format_row(r, img_string):
+    """ Returns a metadata row as the 'similarImages' entry """
+    return {'MediaNumber': r[0],
+            'CollectionTitle': r[1],
+            'WorfRef': r[2],
+            'OriginalFilename': r[3],
+            'FileName': r[4],
+            'LegacyAssetId': r[5],
+            'AssetLibraryId': r[6],
+            'ClusterName': r[7],
+            'ImageUrl': r[8],
+            'ImageContent': img_string}
 
 
 def resize(image, shape, keep_aspect_ratio=True):
@@ -170,37 +437,73 @@ def kmeans_cluster(kmeans, img_features):
     return cluster[0]
 
 
-def search(query, features, encoder, input_shape, max_results, sim_func,
-                     user_input=None, cate=None, kmeans=None, kclusters=None):
-    keys = []
-
-    for i in range(len(query)):
-        if user_input:
-            for ui in user_input:
-                keys.append(cate[ui])
+def as_feature_matrix(features):
+    """ Packs a {key: vector} dict into a FeatureMatrix, reusing the last packed dict """
+    if isinstance(features, RankedRows):
+        return features
+    cached = _PACKED.get(id(features))
+    if cached is None or cached[0] is not features or len(features) != len(cached[1]):
+        _PACKED.clear()
+        cached = (features, FeatureMatrix.from_dict(features))
+        _PACKED[id(features)] = cached
+    return cached[1]
 
-        elif kmeans:
-            img_features = get_features(query[i], encoder, input_shape)
-            cl = kmeans_cluster(kmeans, img_features)
-            keys.append(kclusters[cl])
 
+def search(query, features, encoder, input_shape, max_results, sim_func,
+           user_input=None, cate=None, kmeans=None, kclusters=None, index=None, nprobe=8, batch_size=32, cache=None):
+    """ Returns the 'max_results' closest (score, key) pairs for each image in 'query'.
+    An IVF 'index' replaces the single-cluster kmeans restriction with an nprobe-cluster search.
+    A cache.SearchCache skips encoding and scanning for images and vectors seen before. """
+    query = list(query)
+    if not query:
+        return []
+    if cache is None:
+        query_features = get_features_batch(query, encoder, input_shape, batch_size)
     else:
-        keys = features.keys()
-
-    results = []
-    query_features = []
-    for q in query:
-        x = get_features(q, encoder, input_shape)
-        query_features.append(x)
-
-    for q_f in query_features:
-        r = []
-        for key in keys:
-            feature = np.stack(features[key], axis=0)
-            if sim_func == 'cosine':
-                result = cosine_similarity(q_f.flatten(), feature.flatten())
-            else:
-                result = euclidean_distance(q_f, feature)
-            r.append((result, key))
-        results.append(sorted(r)[:max_results])
-    return results
+        query_features = cache.encode(query, lambda q: get_features_batch(q, encoder, input_shape, batch_size))
+    return search_features(query_features, features, max_results, sim_func,
+                           user_input, cate, kmeans, kclusters, index, nprobe, cache)
+
+
+def search_features(query_features, features, max_results, sim_func,
+                    user_input=None, cate=None, kmeans=None, kclusters=None, index=None, nprobe=8, cache=None):
+    """ search() for query vectors already encoded : (n_queries, 1024) """
+    if len(query_features) == 0:
+        return []
+    matrix = as_feature_matrix(features)
+    if cache is None:
+        return _search_matrix(query_features, matrix, max_results, sim_func,
+                              user_input, cate, kmeans, kclusters, index, nprobe)
+
+    use_index = index is not None and not user_input
+    params = (max_results, sim_func, tuple(user_input or ()), nprobe if use_index else None,
+              kmeans is not None and not use_index)
+    return cache.search(query_features, corpus_version(matrix, index if use_index else None), params,
+                        lambda missing: _search_matrix(missing, matrix, max_results, sim_func,
+                                                       user_input, cate, kmeans, kclusters, index, nprobe))
+
+
+def corpus_version(matrix, index=None):
+    """ Identifies the corpus results are computed on: the ingest generation (if any), the matrix and the index """
+    return getattr(matrix, 'generation', None), id(matrix), len(matrix), None if index is None else id(index)
+
+
+def _search_matrix(query_features, matrix, max_results, sim_func,
+                   user_input=None, cate=None, kmeans=None, kclusters=None, index=None, nprobe=8):
+    if index is not None and not user_input:
+        if getattr(matrix, 'exact', None) is not None:  # quantize.QuantizedMatrix: score the few probed rows exactly
+            matrix = matrix.exact
+        if index.matrix is not matrix:
+            index = index.bound_to(matrix)
+        return index.search(query_features, max_results, sim_func, nprobe)
+
+    restrict = None
+    if user_input:
+        keys = []
+        for ui in user_input:
+            keys.extend(cate[ui])
+        restrict = [keys] * len(query_features)
+    elif kmeans:
+        restrict = [kclusters[kmeans_cluster(kmeans, q_f)] for q_f in query_features]
+
+    return matrix.search(query_features, max_results, sim_func, restrict)
@@ -0,0 +1,402 @@
+"""Offline benchmarks on stub clients and synthetic Textract blocks.
+
+    python benchmark.py jobs [--documents 20] [--job-seconds 2] [--max-in-flight 5]
+    python benchmark.py layout [--pages 50] [--tables-per-page 2]
+    python benchmark.py stream [--pages 10,40,160]
+    python benchmark.py table [--rows 5000] [--cols 5]
+    python benchmark.py sync [--pages 1,3,5] [--job-seconds 8] [--page-seconds 2] [--workers 4]
+    python benchmark.py check
+
+check runs the regression checks instead: each asserts on synthetic input and prints 'ok'.
+"""
+import argparse
+import asyncio
+import codecs
+import io
+import sys
+import time
+import tracemalloc
+import zipfile
+import zlib
+from xml.etree import ElementTree
+
+import numpy as np
+import pypdf
+
+import jobs
+import stubs
+import utils
+
+
+def bench_jobs(args):
+    """One document after another (as extract_content2docx.py does) against JobOrchestrator"""
+    keys = [f'doc-{i}.pdf' for i in range(args.documents)]
+    blocks = stubs.synthetic_blocks(pages=args.pages)
+
+    textract = stubs.StubTextract(blocks, args.job_seconds, args.throttle_rate, args.service_limit)
+    aws = utils.AWSRef('bench', 'region', s3=stubs.StubS3(), textract=textract)
+    t0 = time.perf_counter()
+    for key in keys:
+        job_id = aws.start_analysis(key)
+        aws.wait_for_job(job_id, poll=args.poll, max_poll=args.poll * 16)
+        list(aws.iter_blocks(job_id))
+    sequential = time.perf_counter() - t0
+    sequential_calls = sum(textract.calls.values())
+
+    textract = stubs.StubTextract(blocks, args.job_seconds, args.throttle_rate, args.service_limit)
+    aws = utils.AWSRef('bench', 'region', s3=stubs.StubS3(), textract=textract)
+    orchestrator = jobs.JobOrchestrator(jobs.TextractAdapter(aws), args.max_in_flight, args.poll, args.poll * 16)
+
+    async def run():
+        first = None
+        async for key, result in orchestrator.run(keys):
+            if isinstance(result, Exception):
+                raise result
+            first = first or time.perf_counter() - t0
+        return first
+
+    t0 = time.perf_counter()
+    first = asyncio.run(run())
+    concurrent = time.perf_counter() - t0
+
+    print(f'sequential:   {sequential:7.2f}s  {sequential_calls} calls')
+    print(f'orchestrated: {concurrent:7.2f}s  {sum(textract.calls.values())} calls, first result after {first:.2f}s, '
+          f'{orchestrator.stats}')
+
+
+class RecordingDoc:
+    """Records the write_paragraph and write_table calls a Docx would receive"""
+    def __init__(self):
+        self.calls = []
+
+    def write_paragraph(self, text, extract=True):
+        self.calls.append(('paragraph', text, extract))
+
+    def write_table(self, table, extract=True):
+        self.calls.append(('table', table.tolist(), extract))
+
+
+def legacy_write_to_docx(response, doc_instance, tags=None):
+    """write_to_docx as it was before LayoutEngine: part_of_table walks per line, kept as the reference"""
+    blocks_map = {}
+    table_blocks = []
+    line_blocks = []
+    for block in response:
+        blocks_map[block['Id']] = block
+        if block['BlockType'] == "TABLE":
+            table_blocks.append(block)
+        if block['BlockType'] == 'LINE':
+            line_blocks.append(block)
+
+    text = ''
+    writing = False
+    in_table = False
+    extract = True
+    if tags:
+        extract = False
+
+    for b, block in enumerate(line_blocks):
+        if tags:
+            if tags[0] in block['Text'].lower():
+                extract = True
+            if tags[1].lower() in block['Text'].lower():
+                extract = False
+
+        if len(table_blocks) > 0:
+            if not in_table:
+                in_table = utils.part_of_table(block, table_blocks[0], blocks_map)
+                writing = True
+            if in_table and writing:
+                t = utils.make_table(table_blocks[0], blocks_map)
+                doc_instance.write_paragraph(text)
+                text = ''
+                doc_instance.write_table(t, extract)
+                writing = False
+            elif not in_table:
+                if extract:
+                    text = text + block['Text'] + '\n'
+            elif in_table and (not writing):
+                if b < (len(line_blocks) - 1 ):
+                    if not utils.part_of_table(line_blocks[b + 1], table_blocks[0], blocks_map):
+                        table_blocks.pop(0)
+                        in_table = False
+        else:
+            if extract:
+                text = text + block['Text'] + '\n'
+    doc_instance.write_paragraph(text)
+
+
+
+def bench_layout(args):
+    """write_to_docx against the original line-by-line layout on the same blocks; the calls must match"""
+    blocks = stubs.synthetic_blocks(pages=args.pages, lines_per_page=args.lines_per_page,
+                                    tables_per_page=args.tables_per_page, table_rows=args.table_rows)
+    tags = args.tags.split(',') if args.tags else None
+    lines = sum(1 for block in blocks if block['BlockType'] == 'LINE')
+    tables = sum(1 for block in blocks if block['BlockType'] == 'TABLE')
+    print(f'{len(blocks)} blocks, {lines} lines, {tables} tables')
+
+    results = {}
+    for name, layout in [('original', legacy_write_to_docx), ('layout engine', utils.write_to_docx)]:
+        doc = RecordingDoc()
+        t0 = time.perf_counter()
+        layout(blocks, doc, tags)
+        print(f'{name:<14} {time.perf_counter() - t0:8.3f}s  {len(doc.calls)} writes')
+        results[name] = doc.calls
+    print('identical output:', results['original'] == results['layout engine'])
+
+
+def legacy_make_table(table_block, blocks_map):
+    """make_table before the preallocated array: a rows->cols dict sized by the first row, text
+    concatenated word by word"""
+    rows = {}
+    for relationship in table_block['Relationships']:
+        if relationship['Type'] == 'CHILD':
+            for child_id in relationship['Ids']:
+                cell = blocks_map[child_id]
+                if cell['BlockType'] == 'CELL':
+                    text = ''
+                    for rela in cell.get('Relationships', []):
+                        for i in rela['Ids']:
+                            if blocks_map[i]['BlockType'] == 'WORD':
+                                text += blocks_map[i]['Text'] + ' '
+                    rows.setdefault(cell['RowIndex'], {})[cell['ColumnIndex']] = text
+    n_cols = len(rows[list(rows.keys())[0]].keys())
+    return np.array([[rows[r + 1][c + 1] for c in range(n_cols)] for r in range(len(rows))])
+
+
+class LegacyDocx(utils.Docx):
+    def write_table(self, arr, extract=False):
+        """Docx.write_table before the bulk path: python-docx cell.text one cell at a time"""
+        if extract:
+            table = self.doc.add_table(rows=arr.shape[0], cols=arr.shape[1])
+            for row in range(arr.shape[0]):
+                row_cells = table.rows[row].cells
+                for col in range(arr.shape[1]):
+                    row_cells[col].text = arr[row][col]
+
+
+def document_xml(doc):
+    with io.BytesIO() as fileobj:
+        doc.save_doc(fileobj)
+        return zipfile.ZipFile(fileobj).read('word/document.xml')
+
+
+def bench_table(args):
+    """make_table and Docx.write_table on one large table, old and new"""
+    blocks = stubs.synthetic_blocks(pages=1, lines_per_page=0, table_rows=args.rows, table_cols=args.cols)
+    blocks_map = {block['Id']: block for block in blocks}
+    table_block = next(block for block in blocks if block['BlockType'] == 'TABLE')
+
+    arrays, documents = {}, {}
+    for name, build, doc_class in [('original', legacy_make_table, LegacyDocx), ('new', utils.make_table, utils.Docx)]:
+        t0 = time.perf_counter()
+        arrays[name] = build(table_block, blocks_map)
+        built = time.perf_counter() - t0
+        doc = doc_class()
+        t0 = time.perf_counter()
+        doc.write_table(arrays[name], True)
+        written = time.perf_counter() - t0
+        documents[name] = document_xml(doc)
+        print(f'{name:<9} make_table {built:7.3f}s  write_table {written:7.3f}s')
+
+    print(f'{args.rows}x{args.cols} cells, same table: {arrays["original"].tolist() == arrays["new"].tolist()}, '
+          f'same document.xml: {documents["original"] == documents["new"]}')
+
+
+def blank_pdf(pages):
+    """A pdf of blank pages, each a little taller than the last so that every page's bytes differ"""
+    writer = pypdf.PdfWriter()
+    for page in range(pages):
+        writer.add_blank_page(612, 792 + page)
+    with io.BytesIO() as fileobj:
+        writer.write(fileobj)
+        return fileobj.getvalue()
+
+
+def bench_sync(args):
+    """The async S3 job against concurrent analyze_document calls on the split pages"""
+    for pages in [int(p) for p in args.pages.split(',')]:
+        pdf_bytes = blank_pdf(pages)
+        textract = stubs.StubTextract(lambda key: stubs.synthetic_blocks(pages=pages), args.job_seconds,
+                                      page_seconds=args.page_seconds)
+        aws = utils.AWSRef('bench', 'region', s3=stubs.StubS3(), textract=textract)
+
+        t0 = time.perf_counter()
+        aws.upload_obj(pdf_bytes, 'doc.pdf', 'private')
+        job_id = aws.start_analysis('doc.pdf')
+        aws.wait_for_job(job_id, poll=args.poll, max_poll=args.poll * 16)
+        job_blocks = list(aws.iter_blocks(job_id))
+        job_time = time.perf_counter() - t0
+
+        textract.blocks = lambda data: stubs.synthetic_blocks(pages=1, seed=zlib.crc32(data))
+        t0 = time.perf_counter()
+        sync_blocks = list(aws.analyze_pages(pdf_bytes, max_workers=args.workers))
+        sync_time = time.perf_counter() - t0
+
+        doc = RecordingDoc()
+        utils.write_to_docx(sync_blocks, doc)
+        numbers = [block['Page'] for block in sync_blocks]
+        print(f'{pages:3d} pages  job {job_time:6.2f}s  sync {sync_time:6.2f}s  '
+              f'pages in order: {numbers == sorted(numbers) and set(numbers) == set(range(1, pages + 1))}, '
+              f'blocks {len(sync_blocks)} vs {len(job_blocks)}, '
+              f"tables {sum(1 for call in doc.calls if call[0] == 'table')}")
+
+
+def buffered_docx(aws, job_id, name, tags):
+    """extract_content2docx.py before streaming: all blocks, the whole Document, then one put_object"""
+    blocks = list(aws.iter_blocks(job_id))
+    doc = utils.Docx()
+    utils.write_to_docx(blocks, doc, tags)
+    with io.BytesIO() as fileobj:
+        doc.save_doc(fileobj)
+        aws.upload_obj(fileobj.getvalue(), name, 'public-read')
+
+
+def streamed_docx(aws, job_id, name, tags):
+    with aws.open_upload(name, 'public-read') as fileobj:
+        doc = utils.StreamingDocx(fileobj)
+        utils.stream_to_docx(utils.group_pages(aws.iter_blocks(job_id)), doc, tags)
+        doc.close()
+
+
+def buffered_text(aws, job_id, name, tags):
+    aws.upload_obj(utils.write_to_text(list(aws.iter_blocks(job_id)), tags).encode('utf-8'), name, 'public-read')
+
+
+def streamed_text(aws, job_id, name, tags):
+    with aws.open_upload(name, 'public-read') as fileobj:
+        utils.stream_text(utils.group_pages(aws.iter_blocks(job_id)), codecs.getwriter('utf-8')(fileobj), tags)
+
+
+def bench_stream(args):
+    """Peak memory and time of the buffered and streaming writers as the page count grows"""
+    tags = args.tags.split(',') if args.tags else None
+    for pages in [int(p) for p in args.pages.split(',')]:
+        textract = stubs.StubTextract(stubs.synthetic_blocks(pages=pages, tables_per_page=args.tables_per_page))
+        aws = utils.AWSRef('bench', 'region', s3=stubs.StubS3(), textract=textract)
+        job_id = aws.start_analysis('doc.pdf')
+        outputs = {}
+        for name, write in [('buffered docx', buffered_docx), ('streamed docx', streamed_docx),
+                            ('buffered txt', buffered_text), ('streamed txt', streamed_text)]:
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            write(aws, job_id, name, tags)
+            elapsed = time.perf_counter() - t0
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            outputs[name] = aws.s3.buckets['bench'].pop(name)
+            print(f'{pages:5d} pages  {name:<14} {elapsed:8.2f}s  peak {peak / 2 ** 20:8.1f} MiB  '
+                  f'output {len(outputs[name]) / 2 ** 20:6.2f} MiB')
+
+        documents = [zipfile.ZipFile(io.BytesIO(outputs[name])).read('word/document.xml')
+                     for name in ['buffered docx', 'streamed docx']]
+        print(f'{pages:5d} pages  same document.xml: {documents[0] == documents[1]}, '
+              f"same txt: {outputs['buffered txt'] == outputs['streamed txt']}")
+
+
+def check_control_characters():
+    """Text with characters XML 1.0 forbids gives the same, parseable document.xml from both writers"""
+    text = 'page\x0cbreak, vertical\x0btab, bell\x07 and a lone \ud800 surrogate'
+    table = np.array([[text, 'cell']], dtype=object)
+
+    doc = utils.Docx()
+    doc.write_paragraph(text)
+    doc.write_table(table, True)
+    buffered = document_xml(doc)
+    with io.BytesIO() as fileobj:
+        doc = utils.StreamingDocx(fileobj)
+        doc.write_paragraph(text)
+        doc.write_table(table, True)
+        doc.close()
+        streamed = zipfile.ZipFile(fileobj).read('word/document.xml')
+
+    ElementTree.fromstring(streamed)
+    assert buffered == streamed
+    assert b'<w:br/>' in streamed and b'\x07' not in streamed
+
+
+class FailingAbortS3(stubs.StubS3):
+    """StubS3 whose abort_multipart_upload is throttled once and then fails for good"""
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort_multipart_upload')
+        if self.calls.count('abort_multipart_upload') == 1:
+            raise stubs.StubClientError('ThrottlingException', 'AbortMultipartUpload')
+        raise stubs.StubClientError('AccessDenied', 'AbortMultipartUpload')
+
+
+def check_abort_keeps_error():
+    """A failed multipart abort is retried when throttled and never hides the error that caused it"""
+    s3 = FailingAbortS3()
+    try:
+        with utils.MultipartUploadWriter(s3, 'bucket', 'key', part_size=4) as fileobj:
+            fileobj.write(b'12345678')
+            raise KeyError('original')
+    except KeyError as e:
+        assert e.args == ('original',)
+    assert s3.calls.count('abort_multipart_upload') == 2
+
+
+CHECKS = [check_control_characters, check_abort_keeps_error]
+
+
+def run_checks(args):
+    for check in CHECKS:
+        check()
+        print(f'{check.__name__:<32} ok')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the ContentExtraction pipeline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    jobs_parser = commands.add_parser('jobs', help='concurrent Textract jobs on a stub client')
+    jobs_parser.add_argument('--documents', type=int, default=20)
+    jobs_parser.add_argument('--pages', type=int, default=2)
+    jobs_parser.add_argument('--job-seconds', type=float, default=2)
+    jobs_parser.add_argument('--poll', type=float, default=0.25, help='first poll interval in seconds')
+    jobs_parser.add_argument('--max-in-flight', type=int, default=5)
+    jobs_parser.add_argument('--service-limit', type=int, default=4, help='concurrent jobs the stub accepts')
+    jobs_parser.add_argument('--throttle-rate', type=float, default=0.05)
+    jobs_parser.set_defaults(run=bench_jobs)
+
+    layout_parser = commands.add_parser('layout', help='write_to_docx table detection on synthetic blocks')
+    layout_parser.add_argument('--pages', type=int, default=50)
+    layout_parser.add_argument('--lines-per-page', type=int, default=40)
+    layout_parser.add_argument('--tables-per-page', type=int, default=2)
+    layout_parser.add_argument('--table-rows', type=int, default=20)
+    layout_parser.add_argument('--tags', default=None, help='start,stop tags as for extract_content2docx.py')
+    layout_parser.set_defaults(run=bench_layout)
+
+    stream_parser = commands.add_parser('stream', help='buffered against streaming docx/txt output')
+    stream_parser.add_argument('--pages', default='10,40,160', help='comma separated page counts')
+    stream_parser.add_argument('--tables-per-page', type=int, default=1)
+    stream_parser.add_argument('--tags', default=None, help='start,stop tags as for extract_content2docx.py')
+    stream_parser.set_defaults(run=bench_stream)
+
+    table_parser = commands.add_parser('table', help='make_table and Docx.write_table on one large table')
+    table_parser.add_argument('--rows', type=int, default=5000)
+    table_parser.add_argument('--cols', type=int, default=5)
+    table_parser.set_defaults(run=bench_table)
+
+    sync_parser = commands.add_parser('sync', help='async Textract job against per-page analyze_document')
+    sync_parser.add_argument('--pages', default='1,3,5', help='comma separated page counts')
+    sync_parser.add_argument('--job-seconds', type=float, default=8, help='async job latency')
+    sync_parser.add_argument('--page-seconds', type=float, default=2, help='analyze_document latency')
+    sync_parser.add_argument('--poll', type=float, default=1, help='first poll interval in seconds')
+    sync_parser.add_argument('--workers', type=int, default=4)
+    sync_parser.set_defaults(run=bench_sync)
+
+    check_parser = commands.add_parser('check', help='regression checks')
+    check_parser.set_defaults(run=run_checks)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -0,0 +1,105 @@
+"""Local cache of Textract results, so reruns with other TAGS or OUTPUT_FORMAT skip the upload and the job.
+Entries are keyed by the sha256 of the pdf bytes and the feature types, and hold the block list as
+compressed json lines (zstd if the zstandard package is installed, else gzip). Blocks are written and
+read back one at a time, so caching does not hold the document in memory. The least recently used
+entries are evicted once the directory grows past max_bytes.
+
+    Cache = cache.BlockCache('textract_cache')
+    key = Cache.key(pdf_bytes, ['FORMS'])
+    blocks = Cache.load(key) if Cache.has(key) else Cache.record(key, Aws.iter_blocks(job_id))
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SUFFIXES = ['.jsonl.zst', '.jsonl.gz']
+
+
+class BlockCache:
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(pdf_bytes, feature_types):
+        digest = hashlib.sha256(pdf_bytes)
+        digest.update(('\0' + ','.join(sorted(feature_types))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        for suffix in SUFFIXES:
+            path = os.path.join(self.directory, key + suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def has(self, key):
+        return self._path(key) is not None
+
+    def load(self, key):
+        """Yields the cached blocks in their original order"""
+        path = self._path(key)
+        if path is None:
+            raise KeyError(key)
+        os.utime(path)  # mtime doubles as the last use for eviction
+        with _open(path, 'rb') as f:
+            for line in io.TextIOWrapper(f, encoding='utf-8'):
+                yield json.loads(line)
+
+    def record(self, key, blocks):
+        """Yields blocks through while writing them to the cache; the entry is only stored once
+        blocks is exhausted, so an interrupted run leaves nothing behind"""
+        suffix = SUFFIXES[0] if zstandard is not None else SUFFIXES[1]
+        path = os.path.join(self.directory, key + suffix)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with _open(tmp, 'wb') as f:
+                for block in blocks:
+                    f.write((json.dumps(block, separators=(',', ':')) + '\n').encode('utf-8'))
+                    yield block
+            self.invalidate(key)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    def invalidate(self, key):
+        path = self._path(key)
+        while path is not None:
+            os.remove(path)
+            path = self._path(key)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(tuple(SUFFIXES)):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def _open(path, mode):
+    if '.jsonl.zst' not in os.path.basename(path):
+        return gzip.open(path, mode, compresslevel=6)
+    if zstandard is None:
+        raise RuntimeError(f'{path} needs the zstandard package')
+    f = open(path, mode)
+    if 'r' in mode:
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    return zstandard.ZstdCompressor(level=6).stream_writer(f, closefd=True)
@@ -3,4 +3,10 @@ bucket_name = 'aws-bucket-name'
 
 region = 'aws-region'
 access_key = 'your-access-key'
-secret_key = 'your-secret-key'
\ No newline at end of file
+secret_key = 'your-secret-key'
+
+cache_dir = 'textract_cache'  # local Textract results, keyed by pdf hash and feature types
+cache_max_bytes = 2 * 1024 ** 3  # least recently used results are evicted beyond this
+
+sync_page_limit = 5  # pdfs with up to this many pages are analyzed page by page without an S3 job
+sync_workers = 4  # concurrent analyze_document calls, keep within the account's AnalyzeDocument TPS
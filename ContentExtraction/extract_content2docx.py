@@ -3,9 +3,11 @@ Returns a Word doc retaining the structure of data present (such as tables).
 Input file could be normal text pdfs, scanned image pdfs or images (with minor modifications to the code)."""
 
 import utils
+import cache
+import codecs
 import config
-import io
 import os
+import sys
 
 
 BUCKET = config.bucket_name
@@ -18,6 +20,8 @@ os.environ['AWS_SECRET_ACCESS_KEY'] = config.secret_key
 #  User input
 TAGS = ['extract start', 'extract end']  # None if no tags are present
 OUTPUT_FORMAT = 'docx'  # docx | txt
+FEATURE_TYPES = ['FORMS']
+REFRESH = False  # True to rerun Textract even if the pdf is in the cache
 
 Aws = utils.AWSRef(BUCKET, REGION)
 
@@ -29,40 +33,40 @@ with open(pdf_path, 'rb') as f:
     pdf_bytes = f.read()
 ###########################
 
-Aws.upload_obj(pdf_bytes, input_filename, 'private')
-job_id = Aws.start_analysis(input_filename)
-response = Aws.check_progress(job_id, None)
-blocks = response['Blocks']
-
-while True:
-    if 'NextToken' in response.keys():
-        next_token = response['NextToken']
-        response = Aws.check_progress(job_id, next_token)
-        blocks.extend(response['Blocks'])
-    else:
-        break
+Cache = cache.BlockCache(config.cache_dir, config.cache_max_bytes)
+cache_key = Cache.key(pdf_bytes, FEATURE_TYPES)
+n_pages = utils.page_count(pdf_bytes)  # None without pypdf
+if Cache.has(cache_key) and not REFRESH:
+    print('Using cached document analysis.')
+    blocks = Cache.load(cache_key)
+elif n_pages is not None and n_pages <= config.sync_page_limit:
+    # small documents: pages analyzed concurrently, skipping the job scheduling latency
+    blocks = Cache.record(cache_key, Aws.analyze_pages(pdf_bytes, FEATURE_TYPES, config.sync_workers))
+else:
+    Aws.upload_obj(pdf_bytes, input_filename, 'private')
+    job_id = Aws.start_analysis(input_filename, FEATURE_TYPES)
+    try:
+        Aws.wait_for_job(job_id, TIMELIM)
+    except Exception as e:
+        print(e)
+        sys.exit(0)
+    blocks = Cache.record(cache_key, Aws.iter_blocks(job_id))  # cached once fully read
+pages = utils.group_pages(blocks)  # one page of blocks in memory at a time
 
 
 if OUTPUT_FORMAT == 'docx':
-    Docx = utils.Docx()
-    utils.write_to_docx(blocks, Docx, TAGS)
-
     output_filename = input_filename.split('.')[0] + '.docx'
 
-    with io.BytesIO() as fileobj:
-        Docx.save_doc(fileobj)
-        fileobj.seek(0)
-        Aws.upload_obj(fileobj.read(), output_filename, 'public-read')
+    with Aws.open_upload(output_filename, 'public-read') as fileobj:
+        Docx = utils.StreamingDocx(fileobj)
+        utils.stream_to_docx(pages, Docx, TAGS)
+        Docx.close()
 
 else:
-    text = utils.write_to_text(blocks, TAGS)
-
     output_filename = input_filename.split('.')[0] + '.txt'
-    with io.StringIO() as fileobj:
-        fileobj.write(text)
-        fileobj.seek(0)
 
-        Aws.upload_obj(fileobj.read(), output_filename, 'public-read')
+    with Aws.open_upload(output_filename, 'public-read') as fileobj:
+        utils.stream_text(pages, codecs.getwriter('utf-8')(fileobj), TAGS)
 
 public_url = Aws.get_url(output_filename)
 print(public_url)  # location of output file
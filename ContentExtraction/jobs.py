@@ -0,0 +1,28 @@
+"""Runs many Textract analysis jobs at once with the shared JobOrchestrator from common/aws_jobs.py.
+TextractAdapter maps its start/status/result calls onto the service.
+
+    results = jobs.run_jobs(jobs.TextractAdapter(Aws), ['doc1.pdf', 'doc2.pdf'], max_in_flight=5)
+"""
+import utils
+from aws_jobs import JobFailed, JobOrchestrator, run_jobs  # noqa: F401 (utils puts common/ on sys.path)
+
+
+class TextractAdapter:
+    """Document analysis jobs for S3 keys in aws_ref.bucket; the result is the full block list"""
+    def __init__(self, aws_ref, feature_types=None):
+        self.aws = aws_ref
+        self.feature_types = feature_types or ['FORMS']
+
+    def start(self, key):
+        response = self.aws.textract.start_document_analysis(
+            DocumentLocation={'S3Object': {'Bucket': self.aws.bucket, 'Name': key}},
+            FeatureTypes=self.feature_types
+        )
+        return response['JobId']
+
+    def status(self, job_id):
+        status = self.aws.textract.get_document_analysis(JobId=job_id, MaxResults=1)['JobStatus']
+        return 'SUCCEEDED' if status == 'PARTIAL_SUCCESS' else status
+
+    def result(self, job_id, key):
+        return list(self.aws.iter_blocks(job_id))
@@ -0,0 +1,184 @@
+"""In-memory stand-ins for the boto3 s3 and textract clients, and synthetic Textract block sets.
+Lets the pipeline run and be benchmarked offline: utils.AWSRef(bucket, region, s3=StubS3(), textract=StubTextract())"""
+import itertools
+import json
+import random
+import threading
+import time
+
+
+class StubClientError(Exception):
+    """Carries a botocore ClientError style 'response' dict"""
+    def __init__(self, code, operation):
+        super().__init__(f'An error occurred ({code}) when calling the {operation} operation')
+        self.response = {'Error': {'Code': code, 'Message': code}}
+
+
+class StubS3:
+    def __init__(self):
+        self.buckets = {}
+        self.uploads = {}
+        self.calls = []
+
+    def list_buckets(self):
+        return {'Buckets': [{'Name': name} for name in self.buckets]}
+
+    def create_bucket(self, Bucket, **kwargs):
+        self.buckets.setdefault(Bucket, {})
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.calls.append('put_object')
+        self.buckets.setdefault(Bucket, {})[Key] = Body if isinstance(Body, bytes) else Body.read()
+
+    def get_object(self, Bucket, Key):
+        return {'Body': _Body(self.buckets[Bucket][Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.buckets.get(Bucket, {}).pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.append('create_multipart_upload')
+        upload_id = f'upload-{len(self.calls)}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        self.calls.append('upload_part')
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append('complete_multipart_upload')
+        parts = self.uploads.pop(UploadId)
+        self.buckets.setdefault(Bucket, {})[Key] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort_multipart_upload')
+        self.uploads.pop(UploadId, None)
+
+
+class _Body:
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+class StubTextract:
+    """Jobs succeed 0.5 to 1.5 times 'job_seconds' after they start and analyze_document takes 'page_seconds';
+    a fraction 'throttle_rate' of calls raise a ThrottlingException and at most 'max_concurrent' jobs may run
+    at once (LimitExceededException). Every job returns 'blocks' (a list, or a function of the S3 key) in pages
+    of MaxResults, and analyze_document 'blocks' or 'blocks(document bytes)'; both decoded afresh from json for
+    each call as boto3 would."""
+
+    def __init__(self, blocks=None, job_seconds=0.0, throttle_rate=0.0, max_concurrent=None, seed=0,
+                 page_seconds=0.0):
+        self.blocks = blocks if blocks is not None else synthetic_blocks()
+        self.job_seconds = job_seconds
+        self.page_seconds = page_seconds
+        self.throttle_rate = throttle_rate
+        self.max_concurrent = max_concurrent
+        self.jobs = {}
+        self.calls = {}
+        self._ids = itertools.count()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self._random.random() < self.throttle_rate:
+                raise StubClientError('ThrottlingException', operation)
+
+    def _running(self):
+        now = time.monotonic()
+        return sum(1 for job in self.jobs.values() if job['done_at'] > now)
+
+    def _blocks_for(self, key):
+        return self.blocks(key) if callable(self.blocks) else self.blocks
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes, **kwargs):
+        self._call('StartDocumentAnalysis')
+        with self._lock:
+            if self.max_concurrent is not None and self._running() >= self.max_concurrent:
+                raise StubClientError('LimitExceededException', 'StartDocumentAnalysis')
+            job_id = f'job-{next(self._ids)}'
+            self.jobs[job_id] = {'key': DocumentLocation['S3Object']['Name'],
+                                 'done_at': time.monotonic() + self.job_seconds * self._random.uniform(0.5, 1.5)}
+        return {'JobId': job_id}
+
+    def get_document_analysis(self, JobId, MaxResults=1000, NextToken=None):
+        self._call('GetDocumentAnalysis')
+        job = self.jobs[JobId]
+        if time.monotonic() < job['done_at']:
+            return {'JobStatus': 'IN_PROGRESS', 'Blocks': []}
+        blocks = self._blocks_for(job['key'])
+        start = int(NextToken or 0)
+        response = {'JobStatus': 'SUCCEEDED', 'Blocks': json.loads(json.dumps(blocks[start:start + MaxResults])),
+                    'DocumentMetadata': {'Pages': max([b.get('Page', 1) for b in blocks], default=0)}}
+        if start + MaxResults < len(blocks):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def analyze_document(self, Document, FeatureTypes, **kwargs):
+        self._call('AnalyzeDocument')
+        time.sleep(self.page_seconds)
+        return {'Blocks': json.loads(json.dumps(self._blocks_for(Document.get('Bytes')))),
+                'DocumentMetadata': {'Pages': 1}}
+
+
+def synthetic_blocks(pages=2, lines_per_page=40, tables_per_page=1, table_rows=20, table_cols=5, words_per_line=8,
+                     seed=0):
+    """Returns a Textract-like block list: per page a PAGE block, its LINE and WORD blocks, then its TABLE
+    and CELL blocks. Every table row is also a LINE whose words are the row's cell words, as Textract
+    reports them. Free text lines and tables alternate on the page."""
+    rng = random.Random(seed)
+    ids = itertools.count()
+    vocabulary = ['alpha', 'beta', 'gamma', 'delta', 'total', 'name', 'age', 'ward', 'house', 'number']
+    blocks = []
+
+    def new_block(block_type, page, **fields):
+        block = {'BlockType': block_type, 'Id': f'{block_type.lower()}-{seed}-{next(ids)}', 'Page': page}
+        block.update(fields)
+        return block
+
+    def child(block, ids_):
+        if ids_:
+            block['Relationships'] = [{'Type': 'CHILD', 'Ids': ids_}]
+
+    for page in range(1, pages + 1):
+        page_block = new_block('PAGE', page)
+        page_blocks, table_blocks, page_children = [], [], []
+
+        for run in range(tables_per_page + 1):
+            for _ in range(lines_per_page // (tables_per_page + 1)):
+                words = [new_block('WORD', page, Text=rng.choice(vocabulary)) for _ in range(words_per_line)]
+                line = new_block('LINE', page, Text=' '.join(w['Text'] for w in words))
+                child(line, [w['Id'] for w in words])
+                page_blocks += [line] + words
+                page_children.append(line['Id'])
+            if run == tables_per_page:
+                break
+
+            table = new_block('TABLE', page)
+            cells = []
+            for r in range(1, table_rows + 1):
+                row_words = []
+                for c in range(1, table_cols + 1):
+                    words = [new_block('WORD', page, Text=f'{rng.choice(vocabulary)}{r}.{c}')]
+                    cell = new_block('CELL', page, RowIndex=r, ColumnIndex=c, RowSpan=1, ColumnSpan=1)
+                    child(cell, [w['Id'] for w in words])
+                    cells.append(cell)
+                    row_words += words
+                line = new_block('LINE', page, Text=' '.join(w['Text'] for w in row_words))
+                child(line, [w['Id'] for w in row_words])
+                page_blocks += [line] + row_words
+                page_children.append(line['Id'])
+            child(table, [c['Id'] for c in cells])
+            table_blocks += [table] + cells
+            page_children.append(table['Id'])
+
+        child(page_block, page_children)
+        blocks += [page_block] + page_blocks + table_blocks
+    return blocks
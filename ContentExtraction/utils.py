@@ -1,14 +1,36 @@
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+import docx
 from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+import io
 import numpy as np
+import os
+import re
 import sys
 import time
+from xml.sax.saxutils import escape
+import zipfile
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from aws_jobs import PART_SIZE, MultipartUploadWriter, call_with_backoff  # noqa: E402
+
+DOCX_TEMPLATE = os.path.join(os.path.dirname(docx.__file__), 'templates', 'default.docx')
+BLOCK_WIDTH = 5486400  # EMU between the margins of the default template, as python-docx sizes tables
+NON_XML_CHARS = re.compile('[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')  # outside XML 1.0
 
 
 class AWSRef:
-    def __init__(self, bucket, region):
-        self.s3 = boto3.client("s3")
-        self.textract = boto3.client("textract")
+    def __init__(self, bucket, region, s3=None, textract=None):
+        """s3 and textract default to boto3 clients; pass stubs to run offline"""
+        self.s3 = s3 or boto3.client("s3")
+        self.textract = textract or boto3.client("textract")
         self.bucket = bucket
         self.create_bucket()
         self.region = region
@@ -21,6 +43,10 @@ class AWSRef:
             Key=name
         )
 
+    def open_upload(self, name, acl):
+        """A writable file object streaming to s3 as a multipart upload, use in a with block"""
+        return MultipartUploadWriter(self.s3, self.bucket, name, acl)
+
     def cleanup(self, key):
         self.s3.delete_object(
             Bucket=self.bucket,
@@ -46,22 +72,35 @@ class AWSRef:
                 }
             )
 
-    def analyze_doc(self, bytes_obj):
-        response = self.textract.analyze_document(
+    def analyze_doc(self, bytes_obj, feature_types=None):
+        response = call_with_backoff(
+            self.textract.analyze_document,
             Document={'Bytes': bytes_obj},
-            FeatureTypes=['TABLES']
+            FeatureTypes=feature_types or ['TABLES']
         )
         return response['Blocks']
 
-    def start_analysis(self, key):
-        response = self.textract.start_document_analysis(
+    def analyze_pages(self, pdf_bytes, feature_types=None, max_workers=4):
+        """Synchronous analysis of a pdf without S3 or a job: each page is analyzed as a single page pdf,
+        max_workers at a time. Yields the blocks in page order with their 'Page' set to the page number"""
+        pages = split_pdf(pdf_bytes)
+        with ThreadPoolExecutor(max_workers) as executor:
+            results = executor.map(lambda page: self.analyze_doc(page, feature_types), pages)
+            for number, blocks in enumerate(results, 1):
+                for block in blocks:
+                    block['Page'] = number
+                    yield block
+
+    def start_analysis(self, key, feature_types=None):
+        response = call_with_backoff(
+            self.textract.start_document_analysis,
             DocumentLocation={
                 'S3Object': {
                     'Bucket': self.bucket,
                     'Name': key
                 }
             },
-            FeatureTypes=['FORMS']
+            FeatureTypes=feature_types or ['FORMS']
         )
         return response['JobId']
 
@@ -97,26 +136,154 @@ class AWSRef:
                 sys.exit(0)
 
 
+    def wait_for_job(self, job_id, timelim=300, poll=1, max_poll=20):
+        """Waits for an analysis job to finish, polling a single result with exponential backoff"""
+        deadline = time.monotonic() + timelim
+        while True:
+            response = call_with_backoff(self.textract.get_document_analysis, JobId=job_id, MaxResults=1)
+            if response['JobStatus'] in ['SUCCEEDED', 'PARTIAL_SUCCESS']:
+                print('Document analysis succeeded.')
+                return response['JobStatus']
+            if response['JobStatus'] == 'FAILED':
+                raise RuntimeError(f"Document analysis failed: {response.get('StatusMessage', '')}")
+            if time.monotonic() + poll > deadline:
+                raise TimeoutError('Timeout')
+            print('Document analysis in progress...')
+            time.sleep(poll)
+            poll = min(poll * 2, max_poll)
+
+    def iter_pages(self, job_id):
+        """Yields the Blocks of each result page of a finished job as soon as the page is fetched"""
+        kwargs = {'JobId': job_id, 'MaxResults': 1000}
+        while True:
+            response = call_with_backoff(self.textract.get_document_analysis, **kwargs)
+            yield response['Blocks']
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+    def iter_blocks(self, job_id):
+        for blocks in self.iter_pages(job_id):
+            yield from blocks
+
+
+def page_count(pdf_bytes):
+    """Number of pages in the pdf, None if pypdf is not installed or cannot read it"""
+    if pypdf is None:
+        return None
+    try:
+        return len(pypdf.PdfReader(io.BytesIO(pdf_bytes)).pages)
+    except Exception:
+        return None
+
+
+def split_pdf(pdf_bytes):
+    """Returns each page of the pdf as a pdf of its own"""
+    if pypdf is None:
+        raise RuntimeError('Splitting pdfs needs the pypdf package')
+    pages = []
+    for page in pypdf.PdfReader(io.BytesIO(pdf_bytes)).pages:
+        writer = pypdf.PdfWriter()
+        writer.add_page(page)
+        with io.BytesIO() as fileobj:
+            writer.write(fileobj)
+            pages.append(fileobj.getvalue())
+    return pages
+
+
 class Docx:
     def __init__(self):
         self.doc = Document()
 
     def write_paragraph(self, para, extract=True):
         if extract:
-            self.doc.add_paragraph(para)
+            self.doc.add_paragraph(xml_text(para))
 
     def write_table(self, arr, extract=False):
+        """Adds the table's rows as one parsed chunk of markup rather than setting each cell.text"""
         if extract:
-            table = self.doc.add_table(rows=arr.shape[0], cols=arr.shape[1])
-            for row in range(arr.shape[0]):
-                row_cells = table.rows[row].cells
-                for col in range(arr.shape[1]):
-                    row_cells[col].text = arr[row][col]
+            table = self.doc.add_table(rows=0, cols=arr.shape[1])
+            rows = parse_xml(f'<w:tbl {nsdecls("w")}>' + ''.join(table_rows_xml(arr)) + '</w:tbl>')
+            table._tbl.extend(rows)
 
     def save_doc(self, file_obj):
         self.doc.save(file_obj)
 
 
+class StreamingDocx:
+    """Docx that writes document.xml into the zip in fileobj as paragraphs and tables arrive, instead of
+    holding the whole document; the other parts are copied from python-docx's default template.
+    The markup matches what python-docx writes for Docx. Call close() to finish the file."""
+    def __init__(self, fileobj):
+        self.zip = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(DOCX_TEMPLATE) as template:
+            for item in template.infolist():
+                if item.filename != 'word/document.xml':
+                    self.zip.writestr(item, template.read(item.filename))
+            document = template.read('word/document.xml').decode('utf-8')
+        head, rest = document.split('<w:body>')
+        self.tail = re.sub(r'>\s+<', '><', rest.strip())  # the sectPr and closing tags
+        self.part = self.zip.open('word/document.xml', 'w', force_zip64=True)
+        self.part.write((head.rstrip() + '<w:body>').encode('utf-8'))
+
+    def write_paragraph(self, para, extract=True):
+        if extract:
+            self.part.write(paragraph_xml(para).encode('utf-8'))
+
+    def write_table(self, arr, extract=False):
+        if extract:
+            self.part.write(('<w:tbl><w:tblPr><w:tblW w:type="auto" w:w="0"/><w:tblLook w:firstColumn="1" '
+                             'w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" '
+                             'w:val="04A0"/></w:tblPr><w:tblGrid>' +
+                             f'<w:gridCol w:w="{column_width(arr.shape[1])}"/>' * arr.shape[1] +
+                             '</w:tblGrid>').encode('utf-8'))
+            for row in table_rows_xml(arr):
+                self.part.write(row.encode('utf-8'))
+            self.part.write(b'</w:tbl>')
+
+    def close(self):
+        self.part.write(self.tail.encode('utf-8'))
+        self.part.close()
+        self.zip.close()
+
+
+def column_width(n_cols):
+    """Column width in twips of an n_cols table spanning BLOCK_WIDTH, as python-docx computes it"""
+    return round((BLOCK_WIDTH // n_cols) / 635) if n_cols else 0
+
+
+def table_rows_xml(arr):
+    """Yields the <w:tr> markup of each row of arr, cells as python-docx writes them when cell.text is set"""
+    cell_start = f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{column_width(arr.shape[1])}"/></w:tcPr>'
+    for row in arr:
+        cells = [cell_start + paragraph_xml(text, run=True) + '</w:tc>' for text in row]
+        yield '<w:tr>' + ''.join(cells) + '</w:tr>'
+
+
+def xml_text(text):
+    """text with vertical tabs and form feeds as line breaks and the other characters XML 1.0 forbids dropped,
+    which python-docx would reject and a reader would refuse in a streamed document.xml"""
+    return NON_XML_CHARS.sub('', text.replace('\x0b', '\n').replace('\x0c', '\n'))
+
+
+def paragraph_xml(text, run=False):
+    """<w:p> for text as python-docx builds it: tabs and line breaks become <w:tab/> and <w:br/>.
+    Empty text gives an empty paragraph, or one with an empty run if run (as setting cell.text does)"""
+    text = xml_text(text) if text else text
+    if not text:
+        return '<w:p><w:r/></w:p>' if run else '<w:p/>'
+    content = []
+    for piece in re.split(r'([\t\r\n])', text):
+        if piece == '\t':
+            content.append('<w:tab/>')
+        elif piece in ['\r', '\n']:
+            content.append('<w:br/>')
+        elif piece:
+            space = ' xml:space="preserve"' if piece != piece.strip() else ''
+            content.append(f'<w:t{space}>{escape(piece)}</w:t>')
+    return '<w:p><w:r>' + ''.join(content) + '</w:r></w:p>'
+
+
 def part_of_table(line_block, table_block, blocks_map):
     """Checks whether block in part of table"""
     line_words = []
@@ -153,118 +320,189 @@ def part_of_table(line_block, table_block, blocks_map):
 
 
 def get_text(result, blocks_map):
-    text = ''
+    text = []
     if 'Relationships' in result:
         for relationship in result['Relationships']:
             if relationship['Type'] == 'CHILD':
                 for child_id in relationship['Ids']:
                     word = blocks_map[child_id]
                     if word['BlockType'] == 'WORD':
-                        text += word['Text'] + ' '
+                        text.append(word['Text'] + ' ')
                     if word['BlockType'] == 'SELECTION_ELEMENT':
                         if word['SelectionStatus'] =='SELECTED':
-                            text +=  'X '
-    return text
+                            text.append('X ')
+    return ''.join(text)
 
 
-def get_rows_columns_map(table_result, blocks_map):
-    rows = {}
-    for relationship in table_result['Relationships']:
+def table_cells(table_result, blocks_map):
+    cells = []
+    for relationship in table_result.get('Relationships', []):
         if relationship['Type'] == 'CHILD':
             for child_id in relationship['Ids']:
                 cell = blocks_map[child_id]
                 if cell['BlockType'] == 'CELL':
-                    row_index = cell['RowIndex']
-                    col_index = cell['ColumnIndex']
-                    if row_index not in rows:
-                        # create new row
-                        rows[row_index] = {}
-
-                    # get the text value
-                    rows[row_index][col_index] = get_text(cell, blocks_map)
-    return rows
+                    cells.append(cell)
+    return cells
 
 
 def make_table(table_block, blocks_map):
-    table = get_rows_columns_map(table_block, blocks_map)
-    n_rows = len(table.keys())
-    n_cols = len(table[list(table.keys())[0]].keys())
-    arr_row = []
-    arr = []
-    for r in range(n_rows):
-        for c in range(n_cols):
-            arr_row.append(table[r+1][c+1])
-        arr.append(arr_row)
-        arr_row = []
-    return np.array(arr)
+    """Places each CELL's text at its RowIndex, ColumnIndex in an array sized to the cells' extent.
+    A merged cell (RowSpan or ColumnSpan > 1) keeps its text in its top left slot, the slots it covers
+    and any missing from ragged rows are ''"""
+    cells = table_cells(table_block, blocks_map)
+    n_rows = max([cell['RowIndex'] + cell.get('RowSpan', 1) - 1 for cell in cells], default=0)
+    n_cols = max([cell['ColumnIndex'] + cell.get('ColumnSpan', 1) - 1 for cell in cells], default=0)
+    arr = np.full((n_rows, n_cols), '', dtype=object)
+    for cell in cells:
+        arr[cell['RowIndex'] - 1, cell['ColumnIndex'] - 1] = get_text(cell, blocks_map)
+    return arr
 
 
 def write_to_docx(response, doc_instance, tags=None):
-    blocks_map = {}
-    table_blocks = []
-    line_blocks = []
-    for block in response:
-        blocks_map[block['Id']] = block
-        if block['BlockType'] == "TABLE":
-            table_blocks.append(block)
-        if block['BlockType'] == 'LINE':
-            line_blocks.append(block)
-
-    text = ''
-    writing = False
-    in_table = False
-    extract = True
-    if tags:
-        extract = False
-
-    for b, block in enumerate(line_blocks):
-        if tags:
-            if tags[0] in block['Text'].lower():
-                extract = True
-            if tags[1].lower() in block['Text'].lower():
-                extract = False
-
-        if len(table_blocks) > 0:
-            if not in_table:
-                in_table = part_of_table(block, table_blocks[0], blocks_map)
-                writing = True
-            if in_table and writing:
-                t = make_table(table_blocks[0], blocks_map)
-                doc_instance.write_paragraph(text)
-                text = ''
-                doc_instance.write_table(t, extract)
-                writing = False
-            elif not in_table:
-                if extract:
-                    text = text + block['Text'] + '\n'
-            elif in_table and (not writing):
-                if b < (len(line_blocks) - 1 ):
-                    if not part_of_table(line_blocks[b + 1], table_blocks[0], blocks_map):
-                        table_blocks.pop(0)
-                        in_table = False
+    stream_to_docx([response], doc_instance, tags)
+
+
+def stream_to_docx(pages, doc_instance, tags=None):
+    """write_to_docx for block lists fed one at a time, e.g. group_pages(Aws.iter_blocks(job_id))"""
+    engine = LayoutEngine(doc_instance, tags)
+    for blocks in pages:
+        engine.feed(blocks)
+    engine.close()
+
+
+def group_pages(blocks):
+    """Groups consecutive blocks by their 'Page' (Textract returns them in page order)"""
+    page, group = None, []
+    for block in blocks:
+        if block.get('Page', 1) != page and group:
+            yield group
+            group = []
+        page = block.get('Page', 1)
+        group.append(block)
+    if group:
+        yield group
+
+
+class LayoutEngine:
+    """Lays out LINE and TABLE blocks into doc_instance in one pass over the blocks.
+    Word->table indexes built once replace the per-line part_of_table walks; the output is the same
+    as the original line-by-line state machine. feed() may be called with consecutive slices of the
+    blocks (e.g. page by page) as long as a table arrives in the same slice as its words; only the
+    blocks of the last two slices are kept."""
+    def __init__(self, doc_instance, tags=None):
+        self.doc = doc_instance
+        self.tags = tags
+        self.tables = {}  # position: (table block, blocks map of its slice), for the last two slices
+        self.n_tables = 0
+        self.slice_start = 0  # position of the first table of the last slice
+        self.head = 0  # first table not yet passed
+        self.text = []
+        self.writing = False
+        self.in_table = False
+        self.extract = not tags
+        self.pending = None  # the last line and its tables, waiting for the next line as lookahead
+
+    def feed(self, blocks):
+        blocks_map = {}
+        table_blocks = []
+        lines = []
+        for block in blocks:
+            blocks_map[block['Id']] = block
+            if block['BlockType'] == 'TABLE':
+                table_blocks.append(block)
+            if block['BlockType'] == 'LINE':
+                lines.append(block)
+
+        # older tables can no longer be started: their lines, bar the pending one, are placed
+        self.tables = {t: table for t, table in self.tables.items() if t >= self.slice_start}
+        self.slice_start = self.n_tables
+        word_tables = {}  # word id: positions of the tables containing it
+        for table_block in table_blocks:
+            self.tables[self.n_tables] = (table_block, blocks_map)
+            for word in table_words(table_block, blocks_map):
+                word_tables.setdefault(word, set()).add(self.n_tables)
+            self.n_tables += 1
+
+        for line in lines:
+            line_tables = set()
+            for relationship in line.get('Relationships', []):
+                for idx in relationship['Ids']:
+                    if blocks_map[idx]['BlockType'] == 'WORD':
+                        line_tables.update(word_tables.get(idx, ()))
+            if self.pending is not None:
+                self._place(*self.pending, line_tables)
+            self.pending = (line, line_tables)
+
+    def close(self):
+        if self.pending is not None:
+            self._place(*self.pending, None)
+            self.pending = None
+        self.doc.write_paragraph(''.join(self.text))
+
+    def _place(self, block, line_tables, next_tables):
+        if self.tags:
+            if self.tags[0] in block['Text'].lower():
+                self.extract = True
+            if self.tags[1].lower() in block['Text'].lower():
+                self.extract = False
+
+        if self.head < self.n_tables:
+            if not self.in_table:
+                self.in_table = self.head in line_tables
+                self.writing = True
+            if self.in_table and self.writing:
+                t = make_table(*self.tables[self.head])
+                self.doc.write_paragraph(''.join(self.text))
+                self.text = []
+                self.doc.write_table(t, self.extract)
+                self.writing = False
+            elif not self.in_table:
+                if self.extract:
+                    self.text.append(block['Text'] + '\n')
+            elif next_tables is not None:
+                if self.head not in next_tables:
+                    self.head += 1
+                    self.in_table = False
         else:
-            if extract:
-                text = text + block['Text'] + '\n'
-    doc_instance.write_paragraph(text)
+            if self.extract:
+                self.text.append(block['Text'] + '\n')
+
+
+def table_words(table_block, blocks_map):
+    """The WORD children of the table and of its LINE and CELL children, as part_of_table collects them"""
+    words = set()
+    for relationship in table_block.get('Relationships', []):
+        for idx in relationship['Ids']:
+            child = blocks_map[idx]
+            if child['BlockType'] == 'WORD':
+                words.add(idx)
+            if child['BlockType'] in ['LINE', 'CELL']:
+                for rela in child.get('Relationships', []):
+                    for i in rela['Ids']:
+                        if blocks_map[i]['BlockType'] == 'WORD':
+                            words.add(i)
+    return words
 
 
 def write_to_text(response, tags=None):
-    line_blocks = []
-    for block in response:
-        if block['BlockType'] == 'LINE':
-            line_blocks.append(block)
+    with io.StringIO() as fileobj:
+        stream_text([response], fileobj, tags)
+        return fileobj.getvalue()
+
 
-    text = ''
+def stream_text(pages, fileobj, tags=None):
+    """Writes the LINE text of each block list to fileobj as it arrives"""
     extract = False
-    for b, block in enumerate(line_blocks):
-        if tags:
-            if tags[0].lower() in block['Text'].lower():
-                extract = True
-            if tags[1].lower() in block['Text'].lower():
-                extract = False
-            if not extract:
+    for blocks in pages:
+        for block in blocks:
+            if block['BlockType'] != 'LINE':
                 continue
-
-        text = text + block['Text'] + '\n'
-
-    return text
+            if tags:
+                if tags[0].lower() in block['Text'].lower():
+                    extract = True
+                if tags[1].lower() in block['Text'].lower():
+                    extract = False
+                if not extract:
+                    continue
+
+            fileobj.write(block['Text'] + '\n')
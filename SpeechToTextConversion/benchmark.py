@@ -0,0 +1,344 @@
+"""Offline benchmarks on stub clients and synthetic Transcribe output.
+
+    python benchmark.py jobs [--files 20] [--job-seconds 2] [--max-in-flight 5]
+    python benchmark.py chunked [--minutes 60] [--chunk-seconds 600] [--max-in-flight 5] [--known-speakers]
+    python benchmark.py upload [--minutes 60]
+    python benchmark.py transcript [--hours 10] [--speakers 3]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+from pydub import AudioSegment
+
+import chunking
+import jobs
+import stubs
+import utils
+
+
+def bench_jobs(args):
+    """The same transcription jobs one at a time and with up to --max-in-flight at once"""
+    requests = [(f'bench-job-{i}', f'audio-{i}.wav') for i in range(args.files)]
+
+    for max_in_flight in [1, args.max_in_flight]:
+        s3 = stubs.StubS3()
+        client = stubs.StubTranscribe(s3, job_seconds=args.job_seconds, throttle_rate=args.throttle_rate,
+                                      max_concurrent=args.service_limit)
+        aws_ref = utils.AwsRef('bench', None, s3=s3, transcribe_client=client)
+        orchestrator = jobs.JobOrchestrator(jobs.TranscribeAdapter(aws_ref), max_in_flight, args.poll,
+                                            args.poll * 16)
+
+        async def run():
+            first = None
+            async for request, result in orchestrator.run(requests):
+                if isinstance(result, Exception):
+                    raise result
+                first = first or time.perf_counter() - t0
+            return first
+
+        t0 = time.perf_counter()
+        first = asyncio.run(run())
+        wall = time.perf_counter() - t0
+        print(f'max_in_flight={max_in_flight:<3} {wall:7.2f}s  {sum(client.calls.values())} calls, '
+              f'first result after {first:.2f}s, {orchestrator.stats}')
+
+
+def synthetic_audio(seconds, rate=8000, seed=0):
+    """Mono 16 bit audio of noise bursts of 2 to 8 seconds separated by 0.3 to 1.5 seconds of silence"""
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(seconds * rate), dtype=np.int16)
+    t = 0.0
+    while t < seconds:
+        burst = rng.uniform(2, 8)
+        start, stop = int(t * rate), int(min(seconds, t + burst) * rate)
+        samples[start:stop] = rng.normal(0, 3000, stop - start).astype(np.int16)
+        t += burst + rng.uniform(0.3, 1.5)
+    return AudioSegment(samples.tobytes(), frame_rate=rate, sample_width=2, channels=1)
+
+
+def chunk_transcript(truth, offset, stop, seed):
+    """What Transcribe would return for the audio from offset to stop (seconds) of the truth transcript:
+    the words inside it, times relative to offset with up to 20 ms of jitter, speakers labelled afresh"""
+    rng = random.Random(seed)
+    speakers = {}
+    for segment in truth['results']['speaker_labels']['segments']:
+        for item in segment['items']:
+            speakers[item['start_time']] = item['speaker_label']
+    labels = sorted(set(speakers.values()))
+    relabel = dict(zip(labels, rng.sample([f'spk_{i}' for i in range(len(labels))], len(labels))))
+
+    items, segments, keep = [], [], False
+    for item in truth['results']['items']:
+        if item['type'] == 'pronunciation':
+            keep = offset <= float(item['start_time']) and float(item['end_time']) <= stop
+            if not keep:
+                continue
+            start = f"{max(0.0, float(item['start_time']) - offset + rng.uniform(-0.02, 0.02)):.2f}"
+            end = f"{float(item['end_time']) - offset + rng.uniform(-0.02, 0.02):.2f}"
+            speaker = relabel[speakers[item['start_time']]]
+            items.append(dict(item, start_time=start, end_time=end))
+            if not segments or segments[-1]['speaker_label'] != speaker:
+                segments.append({'start_time': start, 'speaker_label': speaker, 'items': []})
+            segments[-1]['end_time'] = end
+            segments[-1]['items'].append({'start_time': start, 'speaker_label': speaker, 'end_time': end})
+        elif keep:
+            items.append(item)
+    return {'results': {'transcripts': [{'transcript': ''}],
+                        'speaker_labels': {'speakers': len(labels), 'segments': segments}, 'items': items}}
+
+
+def bench_chunked(args):
+    """One job for the whole recording against chunked jobs merged back; checks the merged words,
+    timestamps and speakers against the transcript the stub chunks were cut from"""
+    seconds = args.minutes * 60
+    audio = synthetic_audio(seconds)
+    truth = stubs.synthetic_transcript(seconds, speakers=args.speakers)
+    t0 = time.perf_counter()
+    levels, duration_ms = chunking.audio_levels(audio)
+    plan = chunking.plan_chunks(duration_ms, chunking.find_cuts(levels, duration_ms, args.chunk_seconds * 1000),
+                                args.overlap * 1000)
+    print(f'{args.minutes} min of audio, {len(plan)} chunks planned in {time.perf_counter() - t0:.2f}s')
+
+    def transcript(job_name):
+        if job_name == 'bench-whole':
+            return truth
+        i = int(job_name.split('-')[2])
+        offset, start, end = plan[i]
+        return chunk_transcript(truth, offset / 1000, end / 1000 + args.overlap, seed=i)
+
+    def job_seconds(job_name):
+        if job_name == 'bench-whole':
+            return seconds * args.seconds_per_minute / 60
+        offset, start, end = plan[int(job_name.split('-')[2])]
+        return (end + args.overlap * 1000 - offset) / 60000 * args.seconds_per_minute
+
+    s3 = stubs.StubS3()
+    client = stubs.StubTranscribe(s3, transcript, job_seconds)
+    aws_ref = utils.AwsRef('bench', 'bench-whole', s3=s3, transcribe_client=client)
+    t0 = time.perf_counter()
+    jobs.run_jobs(jobs.TranscribeAdapter(aws_ref), [('bench-whole', 'whole.wav')], poll=args.poll,
+                  max_poll=args.poll * 16)
+    print(f'single job: {time.perf_counter() - t0:7.2f}s')
+
+    t0 = time.perf_counter()
+    merged = chunking.transcribe_chunked(aws_ref, audio, 'bench.wav', 'bench-chunk', args.chunk_seconds * 1000,
+                                         args.overlap * 1000, args.max_in_flight,
+                                         speakers=args.speakers if args.known_speakers else None, poll=args.poll,
+                                         max_poll=args.poll * 16)
+    print(f'chunked:    {time.perf_counter() - t0:7.2f}s  ({len(plan)} jobs, {args.max_in_flight} at once)')
+
+    truth_words = chunking.chunk_words(truth, 0)
+    merged_words = chunking.chunk_words(merged, 0)
+    same = [a['item']['alternatives'][0]['content'] for a in truth_words] == \
+           [b['item']['alternatives'][0]['content'] for b in merged_words]
+    print(f'words: {len(merged_words)} merged, {len(truth_words)} in the recording, same sequence: {same}')
+    if same:
+        error = max(abs(a['start'] - b['start']) for a, b in zip(truth_words, merged_words))
+        pairs = Counter((a['speaker'], b['speaker']) for a, b in zip(truth_words, merged_words))
+        agree = sum(max(n for (t, _), n in pairs.items() if t == speaker)
+                    for speaker in {a['speaker'] for a in truth_words})
+        turns = sum((a['speaker'] == c['speaker']) == (b['speaker'] == d['speaker'])
+                    for a, b, c, d in zip(truth_words, merged_words, truth_words[1:], merged_words[1:]))
+        print(f'largest timestamp error {error:.3f}s, speaker changes kept at {turns / (len(truth_words) - 1):.2%} '
+              f'of words, {agree / len(truth_words):.1%} of words under one label per speaker '
+              f'({merged["results"]["speaker_labels"]["speakers"]} labels for {args.speakers} speakers'
+              f'{"" if args.known_speakers else ": speakers not heard in an overlap get new labels"})')
+
+    if shutil.which(AudioSegment.converter) is None:
+        print(f'{AudioSegment.converter} not found, skipping chunking from a file')
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.wav')
+        audio.export(path, format='wav')
+        tracemalloc.start()
+        levels, duration_ms = chunking.stream_levels(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        same_plan = chunking.plan_chunks(duration_ms, chunking.find_cuts(levels, duration_ms,
+                                                                         args.chunk_seconds * 1000),
+                                         args.overlap * 1000) == plan
+        print(f'from the file: silences found with a peak of {peak / 2 ** 20:.1f} MiB '
+              f'({len(audio.raw_data) / 2 ** 20:.1f} MiB decoded), same chunks: {same_plan}')
+        from_file = chunking.transcribe_chunked(aws_ref, path, 'bench.wav', 'bench-file', args.chunk_seconds * 1000,
+                                                args.overlap * 1000, args.max_in_flight,
+                                                speakers=args.speakers if args.known_speakers else None, poll=args.poll,
+                                                max_poll=args.poll * 16)
+        print(f'from the file: same words as in memory: '
+              f'{[w["item"] for w in chunking.chunk_words(from_file, 0)] == [w["item"] for w in merged_words]}')
+    finally:
+        shutil.rmtree(directory)
+
+
+class CountingS3(stubs.StubS3):
+    """StubS3 keeping only object sizes, so memory measurements see the uploader and not the stored copy"""
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.objects[Bucket, Key] = len(Body if isinstance(Body, bytes) else Body.read())
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        self.uploads[UploadId][PartNumber] = len(Body)
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Bucket, Key] = sum(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+
+def measure(label, upload):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    upload()
+    wall = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{label:<28} {wall:7.2f}s  peak {peak / 2 ** 20:8.1f} MiB')
+
+
+def bench_upload(args):
+    """Reading the file and uploading it with one put_object, as transcribe.py did, against streaming it
+    in multipart uploads; with ffmpeg installed also decoding to wav in memory against piping it to flac"""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.wav')
+        synthetic_audio(args.minutes * 60, rate=16000).export(path, format='wav')
+        print(f'{args.minutes} min of 16 kHz wav, {os.path.getsize(path) / 2 ** 20:.1f} MiB')
+
+        s3 = CountingS3()
+        aws_ref = utils.AwsRef('bench', None, s3=s3)
+
+        def buffered():
+            with open(path, 'rb') as f:
+                aws_ref.upload_to_s3(f.read(), 'buffered.wav')
+
+        measure('read + put_object', buffered)
+        measure('multipart stream', lambda: aws_ref.upload_file(path, 'streamed.wav'))
+        print(f"uploaded sizes match: {s3.objects['bench', 'buffered.wav'] == s3.objects['bench', 'streamed.wav']}")
+
+        if shutil.which(AudioSegment.converter) is None:
+            print(f'{AudioSegment.converter} not found, skipping the conversion comparison')
+            return
+        measure('convert_file_to_wav + put', lambda: aws_ref.upload_to_s3(
+            utils.convert_file_to_wav(path).getvalue(), 'converted.wav'))
+        measure('ffmpeg pipe to flac', lambda: aws_ref.upload_file(path, 'transcoded.flac', transcode=True))
+        print(f"wav {s3.objects['bench', 'converted.wav'] / 2 ** 20:.1f} MiB, "
+              f"flac {s3.objects['bench', 'transcoded.flac'] / 2 ** 20:.1f} MiB")
+    finally:
+        shutil.rmtree(directory)
+
+
+def legacy_speaker_tagged_text(transcript):
+    """speaker_tagged_text as it was: exact start_time lookups and string concatenation"""
+    segments = transcript['results']['speaker_labels']['segments']
+    items = transcript['results']['items']
+
+    seg = []
+    for i in segments:
+        seg.extend(i['items'])
+
+    time_speaker = {}
+    for i in seg:
+        key = i['start_time']
+        value = i['speaker_label']
+
+        time_speaker[key] = value
+
+    curr_spk = None
+    text = ''
+
+    for item in items:
+        if item['type'] == 'pronunciation':
+            speaker = time_speaker[item['start_time']]
+            if curr_spk != speaker:
+                text += f'\n{speaker}: '
+                curr_spk = speaker
+            text = text + ' ' + item['alternatives'][0]['content']
+        else:
+            text += item['alternatives'][0]['content']
+
+    return text
+
+
+def bench_transcript(args):
+    """The old and new speaker tagged text on a long synthetic transcript, then on a copy whose word
+    start times are written with three decimals and so no longer match the segment items"""
+    t0 = time.perf_counter()
+    transcript = json.loads(json.dumps(stubs.synthetic_transcript(args.hours * 3600, speakers=args.speakers)))
+    words = sum(item['type'] == 'pronunciation' for item in transcript['results']['items'])
+    print(f'{args.hours} h transcript, {words} words, built in {time.perf_counter() - t0:.2f}s')
+
+    t0 = time.perf_counter()
+    legacy = legacy_speaker_tagged_text(transcript)
+    print(f'legacy:  {time.perf_counter() - t0:7.2f}s')
+    t0 = time.perf_counter()
+    text = utils.speaker_tagged_text(transcript)
+    print(f'linear:  {time.perf_counter() - t0:7.2f}s  identical output: {text == legacy}')
+    t0 = time.perf_counter()
+    turns = sum(1 for _ in utils.speaker_turns(transcript))
+    print(f'turns:   {time.perf_counter() - t0:7.2f}s  {turns} turns')
+
+    for item in transcript['results']['items']:
+        if item['type'] == 'pronunciation':
+            item['start_time'] = f"{float(item['start_time']):.3f}"
+    try:
+        legacy_speaker_tagged_text(transcript)
+        print('legacy on reformatted start times: ok')
+    except KeyError as e:
+        print(f'legacy on reformatted start times: KeyError {e}')
+    print(f'linear on reformatted start times: identical output: {utils.speaker_tagged_text(transcript) == legacy}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the SpeechToTextConversion pipeline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    jobs_parser = commands.add_parser('jobs', help='concurrent Transcribe jobs on a stub client')
+    jobs_parser.add_argument('--files', type=int, default=20)
+    jobs_parser.add_argument('--job-seconds', type=float, default=2)
+    jobs_parser.add_argument('--poll', type=float, default=0.25, help='first poll interval in seconds')
+    jobs_parser.add_argument('--max-in-flight', type=int, default=5)
+    jobs_parser.add_argument('--service-limit', type=int, default=4, help='concurrent jobs the stub accepts')
+    jobs_parser.add_argument('--throttle-rate', type=float, default=0.05)
+    jobs_parser.set_defaults(run=bench_jobs)
+
+    chunked_parser = commands.add_parser('chunked', help='one long job against chunked transcription')
+    chunked_parser.add_argument('--minutes', type=float, default=60)
+    chunked_parser.add_argument('--chunk-seconds', type=int, default=600)
+    chunked_parser.add_argument('--overlap', type=int, default=30, help='chunk overlap in seconds')
+    chunked_parser.add_argument('--speakers', type=int, default=3)
+    chunked_parser.add_argument('--known-speakers', action='store_true',
+                                help='tell the merge how many speakers there are')
+    chunked_parser.add_argument('--seconds-per-minute', type=float, default=0.2,
+                                help='stub job time per minute of audio')
+    chunked_parser.add_argument('--poll', type=float, default=0.25, help='first poll interval in seconds')
+    chunked_parser.add_argument('--max-in-flight', type=int, default=5)
+    chunked_parser.set_defaults(run=bench_chunked)
+
+    upload_parser = commands.add_parser('upload', help='buffered against streamed uploads of an audio file')
+    upload_parser.add_argument('--minutes', type=float, default=60)
+    upload_parser.set_defaults(run=bench_upload)
+
+    transcript_parser = commands.add_parser('transcript', help='speaker tagged text of a long transcript')
+    transcript_parser.add_argument('--hours', type=float, default=10)
+    transcript_parser.add_argument('--speakers', type=int, default=3)
+    transcript_parser.set_defaults(run=bench_transcript)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        sys.exit(-1)
@@ -0,0 +1,246 @@
+"""Chunked transcription of long audio.
+The audio is cut near every 'chunk_ms' at the middle of a silence, each chunk is extended by 'overlap_ms' on
+both sides and transcribed as its own job, up to max_in_flight at once. The chunk transcripts are merged
+into one Transcribe style json: timestamps are shifted by the chunk offsets, a word is kept only from the
+chunk whose cut range contains its start (the overlaps are transcribed twice), and each chunk's speaker
+labels are mapped onto the previous chunk's by voting over the words both chunks heard in the overlap.
+A speaker who does not talk in an overlap cannot be matched that way: they get a new label, or, when the
+number of speakers is given and that many labels exist, the most recently heard label still unmatched.
+
+A media file path is never decoded whole: silences are found on the loudness of FRAME_MS frames from a
+streamed 8 kHz decode, and each chunk is cut out by ffmpeg and streamed to s3 as flac. A pydub AudioSegment
+already in memory is cut and uploaded as wav instead.
+
+    transcript = chunking.transcribe_chunked(aws_ref, 'hearing.mp4', 'hearing.flac', 'job-name')
+    text = utils.speaker_tagged_text(transcript)
+"""
+import bisect
+import io
+import math
+from collections import Counter
+
+import numpy as np
+
+import jobs
+import utils
+
+FRAME_MS = 50  # loudness is measured per frame of this length
+LEVELS_RATE = 8000  # sample rate of the decode silences are found on
+
+
+def frame_levels(samples, sample_rate, frame_ms=FRAME_MS):
+    """dBFS of each whole frame_ms frame of 16 bit mono samples"""
+    n = sample_rate * frame_ms // 1000
+    frames = np.asarray(samples[:len(samples) // n * n], dtype=np.float64).reshape(-1, n)
+    power = np.mean(frames ** 2, axis=1) / 32768 ** 2
+    return 10 * np.log10(np.maximum(power, 1e-12))
+
+
+def stream_levels(path, frame_ms=FRAME_MS, sample_rate=LEVELS_RATE):
+    """Returns (frame levels, duration in ms) of the media file at path, decoded by ffmpeg a block at a time"""
+    frame_bytes = sample_rate * frame_ms // 1000 * 2
+    levels = []
+    pending = b''
+    total = 0
+    for data in utils.decode_pcm(path, sample_rate):
+        total += len(data)
+        pending += data
+        whole = len(pending) // frame_bytes * frame_bytes
+        if whole:
+            levels.append(frame_levels(np.frombuffer(pending[:whole], dtype='<i2'), sample_rate, frame_ms))
+            pending = pending[whole:]
+    levels = np.concatenate(levels) if levels else np.empty(0)
+    return levels, total // 2 * 1000 // sample_rate
+
+
+def audio_levels(audio, frame_ms=FRAME_MS):
+    """Returns (frame levels, duration in ms) of a pydub AudioSegment"""
+    mono = audio.set_channels(1).set_sample_width(2)
+    return frame_levels(np.frombuffer(mono.raw_data, dtype='<i2'), mono.frame_rate, frame_ms), len(audio)
+
+
+def find_cuts(levels, duration_ms, chunk_ms=600000, window_ms=30000, min_silence_ms=500, silence_thresh=None,
+              frame_ms=FRAME_MS):
+    """Cut points in ms about chunk_ms apart, each at the middle of the silence (at least min_silence_ms of
+    frames quieter than silence_thresh dBFS, by default 16 dB under the average) nearest its target within
+    window_ms, or at the target itself when that stretch has no silence"""
+    if silence_thresh is None:
+        mean_power = np.mean(10 ** (levels / 10)) if len(levels) else 1e-12
+        silence_thresh = 10 * math.log10(max(mean_power, 1e-12)) - 16
+    quiet = np.concatenate([[0], (levels < silence_thresh).astype(np.int8), [0]])
+    edges = np.flatnonzero(np.diff(quiet))
+    starts, ends = edges[::2], edges[1::2]
+    runs = ends - starts >= math.ceil(min_silence_ms / frame_ms)
+    middles = ((starts[runs] + ends[runs]) * frame_ms // 2).tolist()
+
+    cuts = []
+    previous = 0
+    while duration_ms - previous > chunk_ms + window_ms:
+        target = previous + chunk_ms
+        near = middles[bisect.bisect_right(middles, max(previous, target - window_ms)):
+                       bisect.bisect_left(middles, target + window_ms)]
+        cut = min(near, key=lambda m: abs(m - target)) if near else target
+        cuts.append(cut)
+        previous = cut
+    return cuts
+
+
+def plan_chunks(duration_ms, cuts, overlap_ms=30000):
+    """Returns (offset, start, end) in ms per chunk: the chunk audio runs from offset to end + overlap and
+    its words are kept if they start in [start, end)"""
+    bounds = [0] + list(cuts) + [duration_ms]
+    return [(max(0, start - overlap_ms), start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def transcribe_chunked(aws_ref, audio, key, job_name, chunk_ms=600000, overlap_ms=30000, max_in_flight=5,
+                       retries=1, speakers=None, **kwargs):
+    """Transcribes audio (a media file path, or a pydub AudioSegment) in chunks and returns the merged
+    transcript json. Chunks are uploaded as '<key stem>_partN.flac' (.wav for an AudioSegment) and run as
+    jobs '<job_name>-N'; failed chunks are retried 'retries' times under new job names. The chunk audio
+    and json outputs are deleted afterwards. See map_speakers for 'speakers'."""
+    if isinstance(audio, str):
+        levels, duration_ms = stream_levels(audio)
+    else:
+        levels, duration_ms = audio_levels(audio)
+    plan = plan_chunks(duration_ms, find_cuts(levels, duration_ms, chunk_ms), overlap_ms)
+    del levels
+    stem = key.rsplit('.', 1)[0]
+    keys = []
+    try:
+        for i, (offset, start, end) in enumerate(plan):
+            stop = min(duration_ms, end + overlap_ms)
+            if isinstance(audio, str):
+                keys.append(f'{stem}_part{i}.flac')
+                aws_ref.upload_file(audio, keys[-1], transcode=True, start_ms=offset, duration_ms=stop - offset)
+            else:
+                with io.BytesIO() as fileobj:
+                    audio[offset:stop].export(fileobj, format='wav')
+                    keys.append(f'{stem}_part{i}.wav')
+                    aws_ref.upload_to_s3(fileobj.getvalue(), keys[-1])
+    except Exception:
+        aws_ref.cleanup(keys)
+        raise
+
+    transcripts = {}
+    outputs = []
+    pending = list(range(len(plan)))
+    try:
+        for attempt in range(retries + 1):
+            requests = [(f'{job_name}-{i}' + (f'-retry{attempt}' if attempt else ''), keys[i]) for i in pending]
+            failed = {}
+            for (name, chunk_key), result in jobs.run_jobs(jobs.TranscribeAdapter(aws_ref), requests,
+                                                           max_in_flight=max_in_flight, **kwargs):
+                i = keys.index(chunk_key)
+                outputs.append(name + '.json')
+                if isinstance(result, Exception):
+                    failed[i] = result
+                else:
+                    transcripts[i] = result
+            pending = sorted(failed)
+            if not pending:
+                break
+        if pending:
+            raise RuntimeError(f'Transcription of chunks {pending} failed: {failed[pending[0]]}')
+    finally:
+        aws_ref.cleanup(keys + outputs)
+
+    return merge_transcripts([(offset / 1000, start / 1000, end / 1000, transcripts[i])
+                              for i, (offset, start, end) in enumerate(plan)], speakers)
+
+
+def chunk_words(transcript, offset):
+    """Returns the chunk's words as dicts with absolute start/end, speaker (as utils.aligned_items assigns
+    it), the original item and the punctuation items that follow it"""
+    words = []
+    for speaker, item in utils.aligned_items(transcript):
+        if item['type'] == 'pronunciation':
+            words.append({'start': float(item['start_time']) + offset, 'end': float(item['end_time']) + offset,
+                          'speaker': speaker, 'item': item, 'punctuation': []})
+        elif words:
+            words[-1]['punctuation'].append(item)
+    return words
+
+
+def match_words(words, previous):
+    """For each word, the index of the same word in the previous chunk (starting within 0.25 s, matched in
+    order and at most once) or None when the previous chunk did not hear it"""
+    starts = [word['start'] for word in previous]
+    matches = []
+    last = -1
+    for word in words:
+        j = bisect.bisect_left(starts, word['start'])
+        near = [k for k in (j - 1, j) if last < k < len(starts) and abs(starts[k] - word['start']) < 0.25]
+        if near:
+            last = min(near, key=lambda k: abs(starts[k] - word['start']))
+            matches.append(last)
+        else:
+            matches.append(None)
+    return matches
+
+
+def map_speakers(words, previous, matches, labels, speakers=None, heard=None):
+    """Maps the chunk's own speaker labels to merged labels: each word the previous chunk also heard votes
+    for the label it got there. labels is the merged label count so far. Speakers without a match get new
+    labels, unless 'speakers' (the number of people in the recording) labels exist already: they then take
+    the merged labels this chunk has not matched, most recently heard first (heard maps merged labels to the
+    last time they spoke)"""
+    votes = Counter()
+    for word, match in zip(words, matches):
+        if match is not None:
+            votes[word['speaker'], previous[match]['speaker']] += 1
+
+    mapping = {}
+    for (own, merged), _ in votes.most_common():
+        if own not in mapping and merged not in mapping.values():
+            mapping[own] = merged
+    unmatched = Counter(word['speaker'] for word in words if word['speaker'] not in mapping)
+    free = sorted(set((heard or {})) - set(mapping.values()), key=lambda label: -heard[label])
+    for own, _ in unmatched.most_common():
+        if speakers is not None and labels >= speakers and free:
+            mapping[own] = free.pop(0)
+        else:
+            mapping[own] = f'spk_{labels}'
+            labels += 1
+    return mapping, labels
+
+
+def merge_transcripts(chunks, speakers=None):
+    """Merges [(offset, start, end, transcript json)] in seconds, as planned by plan_chunks, into one json.
+    A word is taken from the chunk whose [start, end) holds its start; a word both chunks heard near a cut
+    is taken from the later chunk only if the earlier one did not keep it, so timestamp jitter across the
+    cut neither drops nor repeats it. See map_speakers for 'speakers'."""
+    merged = []
+    previous, previous_kept = [], []
+    labels = 0
+    heard = {}
+    for offset, start, end, transcript in chunks:
+        words = chunk_words(transcript, offset)
+        matches = match_words(words, previous)
+        mapping, labels = map_speakers(words, previous, matches, labels, speakers, heard)
+        kept = []
+        for word, match in zip(words, matches):
+            word['speaker'] = mapping[word['speaker']]
+            heard[word['speaker']] = word['start']
+            if match is None:
+                kept.append(start <= word['start'] < end)
+            else:
+                kept.append(not previous_kept[match] and word['start'] < end)
+        merged += [word for word, keep in zip(words, kept) if keep]
+        previous, previous_kept = words, kept
+
+    items, segments, text = [], [], []
+    for word in merged:
+        start_time, end_time = f"{word['start']:.3f}", f"{word['end']:.3f}"
+        items.append(dict(word['item'], start_time=start_time, end_time=end_time))
+        items += word['punctuation']
+        text.append(word['item']['alternatives'][0]['content'] +
+                    ''.join(p['alternatives'][0]['content'] for p in word['punctuation']))
+        if not segments or segments[-1]['speaker_label'] != word['speaker']:
+            segments.append({'start_time': start_time, 'speaker_label': word['speaker'], 'items': []})
+        segments[-1]['end_time'] = end_time
+        segments[-1]['items'].append({'start_time': start_time, 'speaker_label': word['speaker'],
+                                      'end_time': end_time})
+
+    return {'results': {'transcripts': [{'transcript': ' '.join(text)}],
+                        'speaker_labels': {'speakers': labels, 'segments': segments},
+                        'items': items}}
@@ -2,7 +2,12 @@ import uuid
 
 BUCKET = 'bucket-name'
 SUPPORTED_FORMAT = ['mp3', 'mp4', 'wav', 'flac', 'ogg', 'amr', 'webm']
+VIDEO_FORMAT = ['mp4', 'webm', 'mkv', 'mov', 'avi']  # only their audio track is uploaded, as flac
 JOB_NAME = str(uuid.uuid4())
+CHUNK_SECONDS = 600  # long audio is transcribed in chunks of about this length, None for a single job
+CHUNK_OVERLAP_SECONDS = 30  # audio shared by neighbouring chunks, words there are kept once and match up speakers
+SPEAKERS = None  # number of speakers if known, lets chunks reuse labels of speakers silent in an overlap
+MAX_JOBS = 5  # chunk jobs running at once
 
 # Temporary vars
 ROOT_DIR = 'root-dir'
@@ -0,0 +1,26 @@
+"""Runs many Transcribe jobs at once with the shared JobOrchestrator from common/aws_jobs.py.
+TranscribeAdapter maps its start/status/result calls onto the service.
+
+    results = jobs.run_jobs(jobs.TranscribeAdapter(aws_ref), [(job_name, key), ...], max_in_flight=5)
+"""
+import utils
+from aws_jobs import JobFailed, JobOrchestrator, run_jobs  # noqa: F401 (utils puts common/ on sys.path)
+
+
+class TranscribeAdapter:
+    """Transcription jobs for (job name, S3 key) requests; the result is the parsed transcript json"""
+    def __init__(self, aws_ref):
+        self.aws = aws_ref
+
+    def start(self, request):
+        job_name, key = request
+        self.aws.start_transcription(key, job_name)
+        return job_name
+
+    def status(self, job_name):
+        job = self.aws.transcribe.get_transcription_job(TranscriptionJobName=job_name)['TranscriptionJob']
+        status = job['TranscriptionJobStatus']
+        return {'COMPLETED': 'SUCCEEDED', 'FAILED': 'FAILED'}.get(status, 'IN_PROGRESS')
+
+    def result(self, job_name, request):
+        return self.aws.load_transcript(job_name)
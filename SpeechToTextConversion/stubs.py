@@ -0,0 +1,146 @@
+"""In-memory stand-ins for the boto3 s3 and transcribe clients, and synthetic Transcribe output.
+Lets the pipeline run and be benchmarked offline: utils.AwsRef(bucket, job_name, StubS3(), StubTranscribe(s3))"""
+import itertools
+import json
+import random
+import threading
+import time
+
+VOCABULARY = ['the', 'patient', 'reported', 'pain', 'in', 'left', 'knee', 'since', 'last', 'week', 'we', 'will',
+              'review', 'scan', 'results', 'and', 'follow', 'up', 'on', 'monday', 'okay', 'thank', 'you', 'doctor']
+
+
+class StubClientError(Exception):
+    """Carries a botocore ClientError style 'response' dict"""
+    def __init__(self, code, operation):
+        super().__init__(f'An error occurred ({code}) when calling the {operation} operation')
+        self.response = {'Error': {'Code': code, 'Message': code}}
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self._upload_ids = itertools.count()
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.objects[Bucket, Key] = Body if isinstance(Body, bytes) else Body.read()
+
+    def get_object(self, Bucket, Key):
+        return {'Body': _Body(self.objects[Bucket, Key])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = f'upload-{next(self._upload_ids)}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Bucket, Key] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+
+class _Body:
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+class StubTranscribe:
+    """Jobs complete 0.5 to 1.5 times 'job_seconds' (a number or a function of the job name) after they
+    start and write transcript(job name) to '<job name>.json' in the stub s3 output bucket. A fraction
+    'throttle_rate' of calls raise a ThrottlingException and at most 'max_concurrent' jobs may run at once
+    (LimitExceededException)."""
+
+    def __init__(self, s3, transcript=None, job_seconds=0.0, throttle_rate=0.0, max_concurrent=None, seed=0):
+        self.s3 = s3
+        self.transcript = transcript or (lambda job_name: synthetic_transcript(60, job_name=job_name))
+        self.job_seconds = job_seconds
+        self.throttle_rate = throttle_rate
+        self.max_concurrent = max_concurrent
+        self.jobs = {}
+        self.calls = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self._random.random() < self.throttle_rate:
+                raise StubClientError('ThrottlingException', operation)
+
+    def _job_seconds(self, job_name):
+        return self.job_seconds(job_name) if callable(self.job_seconds) else self.job_seconds
+
+    def start_transcription_job(self, TranscriptionJobName, Media, MediaFormat, LanguageCode, OutputBucketName,
+                                **kwargs):
+        self._call('StartTranscriptionJob')
+        with self._lock:
+            now = time.monotonic()
+            running = sum(1 for job in self.jobs.values() if job['done_at'] > now)
+            if self.max_concurrent is not None and running >= self.max_concurrent:
+                raise StubClientError('LimitExceededException', 'StartTranscriptionJob')
+            duration = self._job_seconds(TranscriptionJobName) * self._random.uniform(0.5, 1.5)
+            self.jobs[TranscriptionJobName] = {'bucket': OutputBucketName, 'media': Media['MediaFileUri'],
+                                               'done_at': now + duration, 'written': False}
+        return {'TranscriptionJob': {'TranscriptionJobName': TranscriptionJobName,
+                                     'TranscriptionJobStatus': 'IN_PROGRESS'}}
+
+    def get_transcription_job(self, TranscriptionJobName):
+        self._call('GetTranscriptionJob')
+        job = self.jobs[TranscriptionJobName]
+        if time.monotonic() < job['done_at']:
+            return {'TranscriptionJob': {'TranscriptionJobName': TranscriptionJobName,
+                                         'TranscriptionJobStatus': 'IN_PROGRESS'}}
+        key = TranscriptionJobName + '.json'
+        if not job['written']:
+            self.s3.put_object(Body=json.dumps(self.transcript(TranscriptionJobName)).encode('utf-8'),
+                               Bucket=job['bucket'], Key=key)
+            job['written'] = True
+        return {'TranscriptionJob': {'TranscriptionJobName': TranscriptionJobName,
+                                     'TranscriptionJobStatus': 'COMPLETED',
+                                     'Transcript': {'TranscriptFileUri': f"https://s3.amazonaws.com/{job['bucket']}/{key}"}}}
+
+
+def synthetic_transcript(seconds=600, speakers=3, job_name='job', start=0.0, seed=0):
+    """Returns Transcribe json output for 'seconds' of speech from 'start': speaker turns of 2 to 20
+    seconds, words of 0.15 to 0.6 seconds, and punctuation items after about one word in eight"""
+    rng = random.Random(seed)
+    items, segments, words = [], [], []
+    t = start
+    while t < start + seconds:
+        speaker = f'spk_{rng.randrange(speakers)}'
+        turn_end = min(start + seconds, t + rng.uniform(2, 20))
+        segment_items = []
+        segment_start = t
+        while t < turn_end:
+            duration = rng.uniform(0.15, 0.6)
+            word = rng.choice(VOCABULARY)
+            start_time, end_time = f'{t:.2f}', f'{t + duration:.2f}'
+            items.append({'start_time': start_time, 'end_time': end_time, 'type': 'pronunciation',
+                          'alternatives': [{'confidence': '0.99', 'content': word}]})
+            segment_items.append({'start_time': start_time, 'speaker_label': speaker, 'end_time': end_time})
+            words.append(word)
+            if rng.random() < 0.125:
+                mark = rng.choice([',', '.', '?'])
+                items.append({'type': 'punctuation', 'alternatives': [{'confidence': '0.0', 'content': mark}]})
+                words[-1] += mark
+            t += duration + rng.uniform(0.0, 0.1)
+        segments.append({'start_time': f'{segment_start:.2f}', 'speaker_label': speaker,
+                         'end_time': segment_items[-1]['end_time'], 'items': segment_items})
+
+    return {'jobName': job_name, 'accountId': '000000000000', 'status': 'COMPLETED',
+            'results': {'transcripts': [{'transcript': ' '.join(words)}],
+                        'speaker_labels': {'speakers': speakers, 'segments': segments},
+                        'items': items}}
@@ -1,8 +1,10 @@
 """ Transcribes an audio/video file """
 import sys
+import chunking
 import utils
 import config
 import os
+from pydub.utils import mediainfo
 
 BUCKET = config.BUCKET  # s3 bucket
 JOB_NAME = config.JOB_NAME  # should be unique for each transcription job
@@ -10,35 +12,63 @@ JOB_NAME = config.JOB_NAME  # should be unique for each transcription job
 KEY = 'key'
 ROOT_DIR =   config.ROOT_DIR
 ABS_PATH = os.path.join(ROOT_DIR, KEY)
-with open(ABS_PATH, 'rb') as f:
-    FILE_OBJ = f.read()
 
 file_format = KEY.split('.')[-1]
 
-# Converts file to supported path if not so
-if file_format not in config.SUPPORTED_FORMAT:
+# Long audio is transcribed in chunks, cut from the file by ffmpeg without decoding it whole
+CHUNKED = False
+if config.CHUNK_SECONDS:
+    try:
+        CHUNKED = float(mediainfo(ABS_PATH)['duration']) > config.CHUNK_SECONDS * 1.5
+    except Exception as e:
+        print(e)
+        print('Could not read the audio duration, transcribing it as one job.')
+
+# Unsupported formats and video are streamed through ffmpeg into flac, supported audio is uploaded as is
+TRANSCODE = file_format not in config.SUPPORTED_FORMAT or file_format in config.VIDEO_FORMAT
+if TRANSCODE:
     print('Converting file to a supported format...')
-    KEY = KEY.split('.')[0] + '.wav'
-    FILE_OBJ = utils.convert_file_to_wav(FILE_OBJ)
+    KEY = KEY.split('.')[0] + '.flac'
 
 aws_ref = utils.AwsRef(BUCKET, JOB_NAME)
 
-try:
-    aws_ref.upload_to_s3(FILE_OBJ, KEY)
-except Exception as e:
-    print(e)
-    print('Upload Failed')
-    sys.exit(-1)
+if CHUNKED:
+    # long audio: chunks cut at silences, transcribed concurrently and merged
+    try:
+        transcript = chunking.transcribe_chunked(aws_ref, ABS_PATH, KEY, JOB_NAME, config.CHUNK_SECONDS * 1000,
+                                                 config.CHUNK_OVERLAP_SECONDS * 1000, config.MAX_JOBS,
+                                                 speakers=config.SPEAKERS)
+    except Exception as e:
+        print(e)
+        print('Transcription Failed')
+        sys.exit(-1)
+    if config.SPEAKERS is None:
+        print(f"{transcript['results']['speaker_labels']['speakers']} speaker labels: chunks only share the speakers "
+              f"heard in their {config.CHUNK_OVERLAP_SECONDS}s overlaps, so one speaker may appear under several "
+              f"labels. Set SPEAKERS in config.py if the number of speakers is known.")
+    speaker_tagged_transcript = utils.speaker_tagged_text(transcript)
+    objs_to_delete = []  # transcribe_chunked removes its chunks and outputs
+
+else:
+    try:
+        aws_ref.upload_file(ABS_PATH, KEY, TRANSCODE)
+    except Exception as e:
+        print(e)
+        print('Upload Failed')
+        sys.exit(-1)
 
-try:
-    aws_ref.transcribe_file(KEY)
-except Exception as e:
-    print(e)
-    print('Transcription Failed')
-    sys.exit(-1)
+    try:
+        aws_ref.transcribe_file(KEY)
+    except Exception as e:
+        print(e)
+        print('Transcription Failed')
+        sys.exit(-1)
 
-# raw_transcript = aws_ref.get_raw_transcript()
-speaker_tagged_transcript = aws_ref.get_speaker_tagged_transcript()
+    # raw_transcript = aws_ref.get_raw_transcript()
+    speaker_tagged_transcript = aws_ref.get_speaker_tagged_transcript()
+    objs_to_delete = [KEY,  # audio file
+                      JOB_NAME + '.json',  # json output of transcribe
+                      ]
 
 # Uncomment the block below to upload results to cloud
 # raw_transcript_obj = bytes(raw_transcript, 'utf8')
@@ -58,7 +88,4 @@ with open(os.path.join(ROOT_DIR, '/transcripts.txt'), 'w') as f:
     f.write(speaker_tagged_transcript)
 
 # delete objects from s3
-objs_to_delete = [KEY,  # audio file
-                  JOB_NAME + '.json',  # json output of transcribe
-                  ]
 aws_ref.cleanup(objs_to_delete)
@@ -1,32 +1,60 @@
+import bisect
 import boto3
 import json
 import time
+import subprocess
 import sys
+import tempfile
 import io
+import os
 from pydub import AudioSegment
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from aws_jobs import MultipartUploadWriter  # noqa: E402
+
 
 s3_client = boto3.client('s3')
 s3_resource = boto3.resource('s3')
 transcribe = boto3.client('transcribe')
 
+READ_SIZE = 1024 * 1024  # bytes read from a file or ffmpeg at a time
+
 
 class AwsRef:
 
-    def __init__(self, bucket, job_name):
+    def __init__(self, bucket, job_name, s3=None, transcribe_client=None):
+        """s3 and transcribe_client default to the module's boto3 clients; pass stubs to run offline"""
         self.bucket = bucket
         self.job_name = job_name
+        self.s3 = s3 or s3_client
+        self.transcribe = transcribe_client or transcribe
 
     def upload_to_s3(self, obj, key):
         """Uploads the file specified by file_name to s3 bucket as file_bucket"""
         print('Uploading to s3...')
-        s3_client.put_object(Body=obj, Bucket=self.bucket, Key=key)
+        self.s3.put_object(Body=obj, Bucket=self.bucket, Key=key)
+        print('Upload complete.')
+
+    def open_upload(self, key):
+        """A writable file object streaming to s3 as a multipart upload, use in a with block"""
+        return MultipartUploadWriter(self.s3, self.bucket, key)
+
+    def upload_file(self, path, key, transcode=False, start_ms=None, duration_ms=None):
+        """Uploads the file at path without reading it whole; with transcode only its audio, as flac,
+        optionally just the part from start_ms lasting duration_ms"""
+        print('Uploading to s3...')
+        with self.open_upload(key) as fileobj:
+            if transcode:
+                transcode_audio(path, fileobj, start_ms=start_ms, duration_ms=duration_ms)
+            else:
+                with open(path, 'rb') as f:
+                    copy_stream(f, fileobj)
         print('Upload complete.')
 
     def cleanup(self, objs):
         for ob in objs:
             try:
-                s3_client.delete_object(
+                self.s3.delete_object(
                     Bucket=self.bucket,
                     Key=ob
                 )
@@ -34,25 +62,28 @@ class AwsRef:
                 print(e)
                 print(f'Failed to delete {ob}. Please use console.')
 
-    def transcribe_file(self, key):
-        """Starts transcription job"""
+    def start_transcription(self, key, job_name):
         file_format = key.split('.')[-1]
         file_uri = 's3://' + self.bucket + '/' + key
 
-        transcribe.start_transcription_job(TranscriptionJobName=self.job_name,
-                                           Media={'MediaFileUri': file_uri},
-                                           MediaFormat=file_format,
-                                           LanguageCode='en-IN',
-                                           OutputBucketName=self.bucket,
-                                           Settings={
-                                              'MaxSpeakerLabels': 10,
-                                              'ShowSpeakerLabels': True
-                                           })
+        self.transcribe.start_transcription_job(TranscriptionJobName=job_name,
+                                                Media={'MediaFileUri': file_uri},
+                                                MediaFormat=file_format,
+                                                LanguageCode='en-IN',
+                                                OutputBucketName=self.bucket,
+                                                Settings={
+                                                   'MaxSpeakerLabels': 10,
+                                                   'ShowSpeakerLabels': True
+                                                })
+
+    def transcribe_file(self, key):
+        """Starts transcription job"""
+        self.start_transcription(key, self.job_name)
 
         print(f'{self.job_name} started')
         while True:
             try:
-                status = transcribe.get_transcription_job(TranscriptionJobName=self.job_name)
+                status = self.transcribe.get_transcription_job(TranscriptionJobName=self.job_name)
                 if status['TranscriptionJob']['TranscriptionJobStatus'] in ['COMPLETED', 'FAILED']:
                     print(f"Transcription job {self.job_name} {status['TranscriptionJob']['TranscriptionJobStatus']}")
                     break
@@ -65,57 +96,134 @@ class AwsRef:
         result_uri = str(status['TranscriptionJob']['Transcript']['TranscriptFileUri'])
         return result_uri
 
-    def get_raw_transcript(self):
-        filename = self.job_name + '.json'
-        obj = s3_resource.Object(self.bucket, filename).get()['Body'].read()
-        transcript = obj.decode('utf-8')
-        # transcript = json.load(obj.decode('utf8').replace("'", '"'))
+    def load_transcript(self, job_name=None):
+        """Returns the parsed json output of a transcription job"""
+        key = (job_name or self.job_name) + '.json'
+        obj = self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        return json.loads(obj.decode('utf-8'))
 
+    def get_raw_transcript(self):
+        transcript = self.load_transcript()
         text = transcript['results']['transcripts'][0]['transcript']
-        return transcript
+        return text
 
     def get_speaker_tagged_transcript(self):
-        filename = self.job_name + '.json'
-        obj = s3_resource.Object(self.bucket, filename).get()['Body'].read()
-        # transcript = json.loads(obj.decode('utf8').replace("'", '"'))
-        transcript = obj.decode('utf-8')
-        segments = transcript['results']['speaker_labels']['segments']
-        items = transcript['results']['items']
-
-        seg = []
-        for i in segments:
-            seg.extend(i['items'])
-
-        time_speaker = {}
-        for i in seg:
-            key = i['start_time']
-            value = i['speaker_label']
-
-            time_speaker[key] = value
-
-        curr_spk = None
-        text = ''
-
-        for item in items:
-            if item['type'] == 'pronunciation':
-                speaker = time_speaker[item['start_time']]
-                if curr_spk != speaker:
-                    text += f'\n{speaker}: '
-                    curr_spk = speaker
-                text = text + ' ' + item['alternatives'][0]['content']
-            else:
-                text += item['alternatives'][0]['content']
-
-        return text
+        return speaker_tagged_text(self.load_transcript())
+
+
+def speaker_tagged_text(transcript):
+    """Transcript text with a '<speaker>: ' line at every change of speaker, from Transcribe json output"""
+    text = io.StringIO()
+    curr_spk = None
+    for speaker, item in aligned_items(transcript):
+        if item['type'] == 'pronunciation':
+            if curr_spk != speaker:
+                text.write(f'\n{speaker}: ')
+                curr_spk = speaker
+            text.write(' ')
+        text.write(item['alternatives'][0]['content'])
+    return text.getvalue()
+
+
+def speaker_turns(transcript):
+    """Yields (speaker, start, end, text) per run of words by one speaker, times in seconds and
+    punctuation attached to the word before it"""
+    turn = None
+    for speaker, item in aligned_items(transcript):
+        content = item['alternatives'][0]['content']
+        if item['type'] != 'pronunciation':
+            if turn is not None:
+                turn[3][-1] += content
+            continue
+        if turn is not None and turn[0] != speaker:
+            yield turn[0], turn[1], turn[2], ' '.join(turn[3])
+            turn = None
+        if turn is None:
+            turn = [speaker, float(item['start_time']), float(item['end_time']), [content]]
+        else:
+            turn[2] = float(item['end_time'])
+            turn[3].append(content)
+    if turn is not None:
+        yield turn[0], turn[1], turn[2], ' '.join(turn[3])
+
+
+def aligned_items(transcript):
+    """Yields (speaker, item) for the transcript items in order. A word gets the speaker of the last
+    segment item starting at or before it (found by bisection, so start times need not match exactly),
+    punctuation gets None. Without speaker labels every speaker is None."""
+    labelled = sorted([(float(i['start_time']), i['speaker_label'])
+                       for segment in transcript['results'].get('speaker_labels', {}).get('segments', [])
+                       for i in segment['items']], key=lambda pair: pair[0])
+    starts = [start for start, _ in labelled]
+    for item in transcript['results']['items']:
+        if item['type'] != 'pronunciation':
+            yield None, item
+        elif labelled:
+            index = bisect.bisect_right(starts, float(item['start_time'])) - 1
+            yield labelled[max(index, 0)][1], item
+        else:
+            yield None, item
 
 
 def convert_file_to_wav(obj):
     try:
         x = io.BytesIO()
         AudioSegment.from_file(obj).export(x, format='wav')
+        x.seek(0)
 
     except Exception as e:
         print(e)
         print('Conversion failed. File format not supported.')
         sys.exit(-1)
     return x
+
+
+def transcode_audio(path, fileobj, codec='flac', sample_rate=16000, channels=1, start_ms=None, duration_ms=None):
+    """Pipes the first audio track of the media file at path through ffmpeg (pydub's converter) into
+    fileobj as codec ('flac' or 'ogg' for opus), READ_SIZE bytes at a time. Video tracks are dropped.
+    start_ms and duration_ms cut out a part of it."""
+    encoder, container = {'flac': ('flac', 'flac'), 'ogg': ('libopus', 'ogg')}[codec]
+    for data in ffmpeg_stream(path, ['-ac', str(channels), '-ar', str(sample_rate), '-c:a', encoder,
+                                     '-f', container], start_ms, duration_ms):
+        fileobj.write(data)
+
+
+def decode_pcm(path, sample_rate=8000, start_ms=None, duration_ms=None):
+    """Yields the first audio track of the media file at path as mono 16 bit little endian samples,
+    READ_SIZE bytes at a time"""
+    return ffmpeg_stream(path, ['-ac', '1', '-ar', str(sample_rate), '-f', 's16le'], start_ms, duration_ms)
+
+
+def ffmpeg_stream(path, output_args, start_ms=None, duration_ms=None):
+    """Yields ffmpeg's output for the first audio track of path in READ_SIZE blocks; raises RuntimeError
+    with ffmpeg's message if it fails"""
+    command = [AudioSegment.converter, '-hide_banner', '-loglevel', 'error']
+    if start_ms is not None:
+        command += ['-ss', f'{start_ms / 1000:.3f}']
+    if duration_ms is not None:
+        command += ['-t', f'{duration_ms / 1000:.3f}']
+    command += ['-i', path, '-vn', '-map', '0:a:0'] + output_args + ['pipe:1']
+    # stderr goes to a file: a pipe read only after stdout would fill up and stall ffmpeg on noisy input
+    with tempfile.TemporaryFile() as log:
+        with subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log) as process:
+            try:
+                while True:
+                    data = process.stdout.read(READ_SIZE)
+                    if not data:
+                        break
+                    yield data
+            finally:
+                if process.poll() is None:  # the caller stopped early, ffmpeg would block on a full pipe
+                    process.kill()
+        if process.returncode != 0:
+            log.seek(0)
+            message = log.read().decode(errors='replace').strip()
+            raise RuntimeError(f'ffmpeg failed on {path}: {message[-2000:]}')
+
+
+def copy_stream(source, fileobj):
+    while True:
+        data = source.read(READ_SIZE)
+        if not data:
+            break
+        fileobj.write(data)
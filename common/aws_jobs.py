@@ -0,0 +1,193 @@
+"""AWS helpers shared by ContentExtraction and SpeechToTextConversion: throttling-aware retries,
+a write-only multipart S3 upload stream, and an asyncio orchestrator for many Textract/Transcribe jobs.
+JobOrchestrator starts jobs up to max_in_flight at a time, polls each with exponential backoff and jitter,
+and yields every result as soon as its job completes. Throttling and concurrency-limit errors slow all
+jobs down (the shared penalty doubles) and are retried; successful calls let the penalty decay again.
+
+Each project's utils.py puts this directory on sys.path, and its jobs.py adds the service adapter:
+
+    results = jobs.run_jobs(jobs.TextractAdapter(Aws), ['doc1.pdf', 'doc2.pdf'], max_in_flight=5)
+    with utils.MultipartUploadWriter(s3, bucket, key) as fileobj:
+        fileobj.write(data)
+"""
+import asyncio
+import random
+import time
+
+PART_SIZE = 8 * 1024 * 1024  # multipart upload part size, S3 needs at least 5 MB for all but the last
+
+# error codes worth retrying with backoff, from S3, Textract and Transcribe
+THROTTLING_ERRORS = ['ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException',
+                     'RequestLimitExceeded', 'InternalServerError', 'InternalFailureException']
+
+
+def call_with_backoff(fn, retries=8, base=0.5, cap=20, **kwargs):
+    """Calls fn(**kwargs), retrying throttled calls with full-jitter exponential backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return fn(**kwargs)
+        except Exception as e:
+            if attempt == retries or not is_throttled(e):
+                raise
+            time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
+def is_throttled(e):
+    """True for botocore ClientErrors (or look-alikes) whose error code is in THROTTLING_ERRORS"""
+    response = getattr(e, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+
+class MultipartUploadWriter:
+    """Write-only stream to s3: buffers part_size bytes at a time and uploads each as a part of a
+    multipart upload. Small objects go up with a single put_object. Leaving a with block on an
+    exception aborts the upload."""
+    def __init__(self, s3, bucket, key, acl='private', part_size=PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.acl = acl
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = call_with_backoff(self.s3.create_multipart_upload, Bucket=self.bucket, Key=self.key,
+                                               ACL=self.acl)['UploadId']
+        number = len(self.parts) + 1
+        response = call_with_backoff(self.s3.upload_part, Body=body, Bucket=self.bucket, Key=self.key,
+                                     PartNumber=number, UploadId=self.upload_id)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            call_with_backoff(self.s3.put_object, Body=bytes(self.buffer), ACL=self.acl, Bucket=self.bucket,
+                              Key=self.key)
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            call_with_backoff(self.s3.complete_multipart_upload, Bucket=self.bucket, Key=self.key,
+                              UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """Best effort: a failed abort leaves the parts to the bucket's lifecycle rules, so that the
+        exception which ended the with block is the one that propagates"""
+        if self.upload_id is not None:
+            try:
+                call_with_backoff(self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key,
+                                  UploadId=self.upload_id)
+            except Exception:
+                pass
+        self.buffer = bytearray()
+        self.closed = True
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JobFailed(Exception):
+    pass
+
+
+class JobOrchestrator:
+    def __init__(self, adapter, max_in_flight=5, poll=2, max_poll=30, timelim=3600, max_retries=10):
+        """adapter has start(request) -> job id, status(job id) -> 'IN_PROGRESS' | 'SUCCEEDED' | 'FAILED'
+        and result(job id, request), all blocking boto3 calls run on the default executor"""
+        self.adapter = adapter
+        self.max_in_flight = max_in_flight
+        self.poll = poll
+        self.max_poll = max_poll
+        self.timelim = timelim
+        self.max_retries = max_retries
+        self.penalty = 1  # grows on throttling, scales every wait
+        self.stats = {'started': 0, 'polls': 0, 'throttled': 0, 'succeeded': 0, 'failed': 0}
+
+    def _delay(self, delay):
+        return random.uniform(0.5, 1) * min(self.max_poll, delay * self.penalty)
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await loop.run_in_executor(None, fn, *args)
+                self.penalty = max(1, self.penalty * 0.9)
+                return result
+            except Exception as e:
+                if attempt == self.max_retries or not is_throttled(e):
+                    raise
+                self.stats['throttled'] += 1
+                self.penalty = min(self.penalty * 2, 64)
+                await asyncio.sleep(self._delay(self.poll * 2 ** attempt))
+
+    async def _run_one(self, request, semaphore):
+        async with semaphore:
+            job_id = await self._call(self.adapter.start, request)
+            self.stats['started'] += 1
+            deadline = time.monotonic() + self.timelim
+            delay = self.poll
+            while True:
+                await asyncio.sleep(self._delay(delay))
+                status = await self._call(self.adapter.status, job_id)
+                self.stats['polls'] += 1
+                if status == 'SUCCEEDED':
+                    result = await self._call(self.adapter.result, job_id, request)
+                    self.stats['succeeded'] += 1
+                    return request, result
+                if status == 'FAILED':
+                    raise JobFailed(f'Job {job_id} for {request} failed')
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Job {job_id} for {request} timed out')
+                delay = min(delay * 2, self.max_poll)
+
+    async def _run_guarded(self, request, semaphore):
+        try:
+            return await self._run_one(request, semaphore)
+        except Exception as e:
+            self.stats['failed'] += 1
+            return request, e
+
+    async def run(self, requests):
+        """Yields (request, result) as each job completes; result is the exception if the job failed"""
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        tasks = [asyncio.ensure_future(self._run_guarded(request, semaphore)) for request in requests]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def run_jobs(adapter, requests, **kwargs):
+    """Blocking JobOrchestrator.run; returns [(request, result)] in completion order"""
+    async def collect():
+        return [item async for item in JobOrchestrator(adapter, **kwargs).run(requests)]
+    return asyncio.run(collect())